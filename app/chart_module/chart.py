@@ -1,7 +1,35 @@
-from skimage.measure import label, regionprops
+import weakref
 import pandas as pd
 import numpy as np
-from typing import Any
+from typing import Any, Iterator
+from app.utils_module.writer import DATA_SHEET, PREVIEW_SHEET, write_frame
+from app.utils_module.timing import stage
+
+# Formats of every chart workbook, dropped with the workbook
+_formats = weakref.WeakKeyDictionary()
+
+def iter_chart_sheets(df_charts:Any)->Iterator[tuple[str, pd.DataFrame]]:
+    '''
+    A generator to read the crosstab sheets of a workbook one at a time.
+    The workbook is opened once in read-only mode and the raw data sheets are never parsed.
+
+    Args:
+        - df_charts: Filepath or buffer(Streamlit dataframe/SpooledTemporaryFile)
+
+    Return:
+        - sheet_name, df: Name of the sheet and its cells, without header [str, pandas dataframe]
+    '''
+    with stage('load_chart.open'):
+        workbook = pd.ExcelFile(df_charts)
+    with workbook:
+        for sheet_name in workbook.sheet_names:
+            # Skip the raw data sheet, wherever it is (or if it is omitted)
+            if sheet_name in [DATA_SHEET, PREVIEW_SHEET]:
+                continue
+            with stage('load_chart.parse', sheets=1) as counts:
+                df = workbook.parse(sheet_name=sheet_name, header=None)
+                counts['rows'] = len(df)
+            yield sheet_name, df
 
 def load_chart(df_charts: pd.DataFrame, filename: bool = False)->tuple[list[pd.DataFrame], list[str], str]:
     '''
@@ -19,24 +47,95 @@ def load_chart(df_charts: pd.DataFrame, filename: bool = False)->tuple[list[pd.D
     df_chartsname = ''
     if filename:
         df_chartsname = df_charts.name
-    
-    # Read all sheet names in the Excel file
-    all_sheet_names = pd.ExcelFile(df_charts).sheet_names
-
-    # Exclude the first sheet (raw data)
-    sheet_names_to_read = all_sheet_names[1:]
-
-    # Rename sheets based on initial sheet names
-    sheet_names = [name for name in sheet_names_to_read]
 
     # Read all tables from multiple sheets
-    dfs = []
-    for sheet_name in sheet_names_to_read:
-        df = pd.read_excel(df_charts, sheet_name=sheet_name, header=None)
+    sheet_names, dfs = [], []
+    for sheet_name, df in iter_chart_sheets(df_charts):
+        sheet_names.append(sheet_name)
         dfs.append(df)
     
     return dfs, sheet_names, df_chartsname
 
+def _runs(filled:np.ndarray)->list[tuple[int, int]]:
+    '''
+    Start and end (exclusive) of every run of True in a 1-D mask.
+    '''
+    edges = np.diff(np.concatenate(([0], filled.astype(np.int8), [0])))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+def _is_regular(block:np.ndarray)->bool:
+    '''
+    Check that a block is a single table: its first column is full, and every other
+    non-null cell is reached from the first column through its 8 neighbours, from left to right.
+    '''
+    if not block[:, 0].all():
+        return False
+    reached = block[:, 0]
+    for c in range(1, block.shape[1]):
+        # Cells touching a reached cell of the previous column, through a side or a corner
+        near = reached.copy()
+        near[1:] |= reached[:-1]
+        near[:-1] |= reached[1:]
+        column = block[:, c]
+        # A vertical run of cells is reached as soon as one of its cells is
+        run_id = np.cumsum(np.diff(np.concatenate(([0], column.astype(np.int8)))) == 1)
+        hit = np.bincount(run_id[column & near], minlength=run_id.max() + 1) > 0
+        reached = column & hit[run_id]
+        if (column & ~reached).any():
+            return False
+    return True
+
+def table_regions(mask:np.ndarray)->list[tuple[int, int, int, int]]:
+    '''
+    Find the tables of a sheet, like the bounding boxes of `skimage.measure.regionprops`
+    on the labeled non-null cells, by cutting the sheet along its blank rows and blank columns.
+    Sheets with an irregular table (eg. a table without a full first column) fall back to the labeling.
+
+    Args:
+        - mask: Non-null cells of the sheet [numpy array]
+
+    Return:
+        - regions: (top, left, bottom, right) of every table, bottom and right excluded, in reading order.
+    '''
+    regions = []
+    blocks = [(0, 0, mask.shape[0], mask.shape[1])]
+    while blocks:
+        top, left, bottom, right = blocks.pop()
+        block = mask[top:bottom, left:right]
+        rows = _runs(block.any(axis=1))
+        cols = _runs(block.any(axis=0))
+        if len(rows) == 1 and len(cols) == 1 and rows[0] == (0, block.shape[0]) and cols[0] == (0, block.shape[1]):
+            if not _is_regular(block):
+                return _label_regions(mask)
+            regions.append((top, left, bottom, right))
+        elif len(rows) > 1 or rows and rows[0] != (0, block.shape[0]):
+            blocks += [(top + start, left, top + end, right) for start, end in rows]
+        else:
+            blocks += [(top, left + start, bottom, left + end) for start, end in cols]
+    # The first cell of every table is its top left corner
+    return sorted(regions)
+
+def _label_regions(mask:np.ndarray)->list[tuple[int, int, int, int]]:
+    '''
+    Bounding boxes of the 8-connected non-null cells, for the sheets with irregular tables.
+    '''
+    from skimage.measure import label, regionprops
+    return [tuple(region.bbox) for region in regionprops(label(mask.astype("int")))]
+
+def chart_formats(workbook:Any)->dict[str, Any]:
+    '''
+    Formats of the chart workbook, added once per workbook and shared by all its sheets.
+
+    Args:
+        - workbook: Excel workbook [xlsxwriter Workbook]
+
+    Return:
+        - formats: dictionary of format name and xlsxwriter Format.
+    '''
+    if workbook not in _formats:
+        _formats[workbook] = {'bold': workbook.add_format({'bold': 1})}
+    return _formats[workbook]
+
 def generate_bar_chart(df:pd.DataFrame, start:int, workbook:pd.ExcelWriter, worksheet:pd.ExcelWriter)->Any:
     '''
     Generate the clustered bar chart based on the crosstab table.
@@ -90,23 +189,23 @@ def crosstab_reader(workbook:pd.ExcelWriter, df:pd.DataFrame, sheet_name:list[st
     '''
 
     worksheet = workbook.add_worksheet(sheet_name)
+    bold = chart_formats(workbook)['bold']
 
-    larr = label(np.array(df.notnull()).astype("int"))
     start_row = 0
     charts = []
-    for s in regionprops(larr):
-        sub_df = (df.iloc[s.bbox[0]:s.bbox[2], s.bbox[1]:s.bbox[3]].pipe(lambda df_: df_.rename(columns=df_.iloc[0]).drop(df_.index[0])))
+    with stage('draw_chart.detect') as counts:
+        regions = table_regions(np.array(df.notnull()))
+        counts['tables'] = len(regions)
+    for top, left, bottom, right in regions:
+        sub_df = (df.iloc[top:bottom, left:right].pipe(lambda df_: df_.rename(columns=df_.iloc[0]).drop(df_.index[0])))
 
-        # Bold the column name
-        bold = workbook.add_format({'bold': 1})
-        # Write the sub_df to the worksheet
-        for i, col in enumerate(sub_df.columns):
-            worksheet.write(start_row, i, col, bold)
-            for j, value in enumerate(sub_df[col]):
-                worksheet.write(start_row + j + 1, i, value)
+        # Write the sub_df to the worksheet, row by row with the column names in bold
+        with stage('draw_chart.write', rows=len(sub_df)):
+            write_frame(worksheet, sub_df, start_row, header_format=bold)
 
         # Create clustered bar chart for the current table
-        generate_bar_chart(sub_df, (start_row, 0), workbook, worksheet)
+        with stage('draw_chart.chart', charts=1):
+            generate_bar_chart(sub_df, (start_row, 0), workbook, worksheet)
 
         # Add some empty rows between tables
         start_row += sub_df.shape[0] + 3
@@ -1,6 +1,15 @@
 from io import BytesIO
 from app.utils_module.processor import get_row, get_column
+from app.crosstab_module.context import CrosstabContext
+from app.crosstab_module.cube import CrosstabCube
+from app.crosstab_module.parallel import parallel_counts
+from app.utils_module.writer import TableWriter, DATA_SHEET, PREVIEW_SHEET
+from app.utils_module.timing import stage
 import pandas as pd
+from typing import Callable
+
+# Number of respondents sampled into the preview of the raw data sheet
+PREVIEW_ROWS = 1000
 
 def write_table(
         df:pd.DataFrame, 
@@ -10,7 +19,13 @@ def write_table(
         multi:list[str], 
         name_sort:list[str], 
         weight:str,
-        col_seqs:dict
+        col_seqs:dict,
+        workers:int=1,
+        constant_memory:bool=False,
+        data_sheet:str='full',
+        progress:Callable[[int, int], None]=None,
+        cube:CrosstabCube=None,
+        charts:bool=False
         )->bytes:
     
     '''
@@ -28,55 +43,70 @@ def write_table(
         - col_seqs:
             - Key: Demography column
             - Value: Sorted unique value of the key demography column.
+        - workers: Number of processes to compute the tables with, sequential when 1 [int]
+        - constant_memory: Flush the rows of the workbook to disk as they are written, to keep the memory flat [bool]
+        - data_sheet: Raw data sheet of the workbook; 'full', 'preview' (sample of PREVIEW_ROWS respondents) or 'none' [str]
+        - progress: Called with (questions done, total questions) across all demos, before the first and after every question.
+                    An exception raised by it stops the generation (eg. to cancel a job) [callable]
+        - cube: Weighted counts materialized from the same survey and weight, to render the tables from [CrosstabCube]
+        - charts: Draw the clustered bar chart of every table next to it, like the chart generator does [bool]
 
     Return:
-        - df_xlsx: conversion result of pandas ExcelWriter that contains crosstabs table into bytes.
+        - df_xlsx: conversion result of the workbook that contains crosstabs table into bytes.
     '''
 
+    if data_sheet not in ['full', 'preview', 'none']:
+        raise ValueError(f"data_sheet should be 'full', 'preview' or 'none', got '{data_sheet}'")
+    if cube is not None and cube.weight != weight:
+        raise ValueError(f"cube is built on the weight '{cube.weight}', not '{weight}'")
+
+    done, total = 0, len(demos) * len(q_ls)
+    if progress:
+        progress(done, total)
+
     # Initialize excel file
     output = BytesIO()
-    writer = pd.ExcelWriter(output, engine='xlsxwriter')
-    df.to_excel(writer, index=False, sheet_name= 'data')
+    writer = TableWriter(output, constant_memory=constant_memory)
+    with stage('write_table.data_sheet') as stage_counts:
+        if data_sheet == 'full':
+            writer.write(df, sheet_name=DATA_SHEET)
+            stage_counts['rows'] = len(df)
+        elif data_sheet == 'preview':
+            preview = df.sample(n=min(PREVIEW_ROWS, len(df)), random_state=0).sort_index()
+            writer.write(preview, sheet_name=PREVIEW_SHEET)
+            stage_counts['rows'] = len(preview)
+
+    # Factorize the questions and demography once for all the tables, unless their counts are materialized
+    with stage('write_table.context', rows=len(df)):
+        if cube is not None:
+            context, workers = cube, 1
+        else:
+            context = CrosstabContext(df=df, weight=weight, columns=q_ls + demos, multi=multi)
+    if workers > 1:
+        with stage('write_table.counts', tables=len(demos) * len(q_ls)):
+            pool_counts = parallel_counts(context=context, q_ls=q_ls, multi=multi, demos=demos, workers=workers)
 
     # Write tables one by one according to the type of question
     for demo in demos:
-        if wise == 'Both':
-
-            # start: loop counter to build the crosstabs table
-            start = 1
-            for q in q_ls:
-                start, _, _ = get_column(
-                    df=df, 
-                    q=q, 
-                    multi=multi, 
-                    name_sort=name_sort, 
-                    demo=demo, 
-                    weight=weight, 
-                    col_seqs=col_seqs, 
-                    writer=writer, 
-                    start=start
-                    )
-
-            # start_2: loop counter to build the crosstabs table
-            start_2 = 1
-            for q in q_ls:
-                start_2, _, _ = get_row(
-                    df=df, 
-                    q=q, 
-                    multi=multi, 
-                    name_sort=name_sort, 
-                    demo=demo, 
-                    weight=weight, 
-                    col_seqs=col_seqs, 
-                    writer=writer, 
-                    start_2=start_2
-                    )
+        if workers > 1:
+            batch = {q: pool_counts[(demo, q)] for q in q_ls}
+        else:
+            # Weighted counts of all the single choice questions across demo in one sparse product
+            with stage('write_table.counts', tables=len(q_ls)):
+                batch = context.batch_counts(q_ls=[q for q in q_ls if q not in multi], column=demo)
 
-        elif wise == '% of Column Total':
+        # start / start_2: loop counters to build the crosstabs table
+        start = 1
+        start_2 = 1
+        for q in q_ls:
+            # Raw weighted counts shared by the (col) and (row) tables of q
+            if q in batch:
+                counts = batch[q]
+            else:
+                with stage('write_table.counts'):
+                    counts = context.counts(q=q, column=demo, multi=True)
 
-            # start: loop counter to build the crosstabs table
-            start = 1
-            for q in q_ls:
+            if wise in ['Both', '% of Column Total']:
                 start, _, _ = get_column(
                     df=df, 
                     q=q, 
@@ -86,13 +116,13 @@ def write_table(
                     weight=weight, 
                     col_seqs=col_seqs, 
                     writer=writer, 
-                    start=start
+                    start=start,
+                    context=context,
+                    counts=counts,
+                    charts=charts
                     )
 
-        else:
-            # start_2: loop counter to build the crosstabs table
-            start_2 = 1
-            for q in q_ls:
+            if wise != '% of Column Total':
                 start_2, _, _ = get_row(
                     df=df, 
                     q=q, 
@@ -102,9 +132,17 @@ def write_table(
                     weight=weight, 
                     col_seqs=col_seqs, 
                     writer=writer, 
-                    start_2=start_2
+                    start_2=start_2,
+                    context=context,
+                    counts=counts,
+                    charts=charts
                     )
-    writer.save()
+
+            done += 1
+            if progress:
+                progress(done, total)
+    with stage('write_table.save'):
+        writer.close()
     df_xlsx = output.getvalue()
     
     return df_xlsx
\ No newline at end of file
@@ -1,9 +1,10 @@
 from io import BytesIO
-import xlsxwriter
 import pandas as pd
+from typing import Iterable
 from app.chart_module.chart import crosstab_reader
+from app.utils_module.timing import stage
 
-def draw_chart(dfs:list[pd.DataFrame], sheet_names:list)-> bytes:
+def draw_chart(dfs:list[pd.DataFrame]=None, sheet_names:list=None, sheets:Iterable[tuple[str, pd.DataFrame]]=None)-> bytes:
     '''
     Backend function to draw the clustered column chart.
     This script serves as the top script for the back-end of the chart generator.
@@ -11,18 +12,24 @@ def draw_chart(dfs:list[pd.DataFrame], sheet_names:list)-> bytes:
     Args:
         - dfs: list of pandas DataFrame 
         - sheet_names: listof the sheet names in the crosstabs file. 
+        - sheets: sheet names and tables read one at a time (eg. iter_chart_sheets), instead of dfs and sheet_names.
 
     Return:
         - df_charts: crosstabs table that contains clustered column chart in bytes.
     '''
+    import xlsxwriter
     output = BytesIO()
     workbook = xlsxwriter.Workbook(output, {'in_memory': True})
 
+    if sheets is None:
+        sheets = zip(sheet_names, dfs)
+
     # Process each table separately
-    for _, (sheet_name, df) in enumerate(zip(sheet_names, dfs)):
+    for _, (sheet_name, df) in enumerate(sheets):
         workbook, _ = crosstab_reader(workbook, df, sheet_name)
             
-    workbook.close()
+    with stage('draw_chart.save'):
+        workbook.close()
     df_charts = output.getvalue()
     return df_charts
     
\ No newline at end of file
@@ -0,0 +1,316 @@
+import pandas as pd
+import numpy as np
+from dataclasses import dataclass
+
+# Upper bound of non-zero entries of the one-hot matrix built by CrosstabContext.batch_counts
+BATCH_SIZE = 2**24
+
+def _pairwise_bincount(codes:np.ndarray, weights:np.ndarray, minlength:int)->np.ndarray:
+    '''
+    Sum the weights of every code like `np.bincount`, but with the pairwise summation of `pd.Series.sum`.
+    The weights of each code are summed in respondent order, so the totals are the exact same floats as
+    summing the weight column of the rows with that code (eg. `df[df[q] == row][weight].sum()`), NaN counting as 0.
+
+    Args:
+        - codes: Code of each respondent, from 0 to minlength - 1 [numpy array]
+        - weights: Weight of each respondent [numpy array]
+        - minlength: Number of codes [int]
+
+    Return:
+        - sums: numpy array with the summed weights of each code.
+    '''
+    # Small unsigned codes are stable sorted with a radix sort, in linear time
+    order = np.argsort(codes.astype(np.min_scalar_type(minlength)), kind='stable')
+    codes = codes[order]
+    weights = np.where(np.isnan(weights), 0, weights)[order]
+    bounds = np.flatnonzero(np.diff(codes)) + 1
+    sums = np.zeros(minlength)
+    for begin, end in zip(np.r_[0, bounds], np.r_[bounds, len(codes)]):
+        if end > begin:
+            sums[codes[begin]] = np.add.reduce(weights[begin:end]) # np.add.reduceat sums sequentially
+    return sums
+
+def _weighted_matrix(
+        row_codes:np.ndarray, 
+        col_codes:np.ndarray, 
+        weights:np.ndarray, 
+        n_rows:int, 
+        n_cols:int, 
+        pairwise:bool=False
+        )->np.ndarray:
+    '''
+    Sum the weights of every (row code, column code) pair with a single bincount.
+
+    Args:
+        - row_codes: Row position of each respondent, -1 to skip [numpy array]
+        - col_codes: Column position of each respondent, -1 to skip [numpy array]
+        - weights: Weight of each respondent [numpy array]
+        - n_rows: Number of rows of the matrix [int]
+        - n_cols: Number of columns of the matrix [int]
+        - pairwise: Sum every pair like `pd.Series.sum` instead of in sequence (see _pairwise_bincount) [bool]
+
+    Return:
+        - matrix: numpy array of shape (n_rows, n_cols) with the weighted counts.
+    '''
+    keep = (row_codes >= 0) & (col_codes >= 0)
+    flat = row_codes[keep] * n_cols + col_codes[keep]
+    bincount = _pairwise_bincount if pairwise else np.bincount
+    return bincount(flat, weights=weights[keep], minlength=n_rows * n_cols).reshape(n_rows, n_cols)
+
+@dataclass
+class CrosstabCounts:
+    '''
+    Raw weighted counts of one question across one demographic column.
+    Both the % of Column Total and the % of Row Total tables are normalized from it.
+
+    labels: Answers (or options of a multi choice question) in order of first appearance.
+    demos: Demographic values in order of first appearance.
+    cells: Weight of each answer per demo, shape (len(labels), len(demos)).
+    label_total: Weight of each answer over all the respondents.
+    demo_total: Weight of the respondents that answered, per demo.
+    demo_count: Number of respondents that answered, per demo.
+    total: Weight of all the respondents that answered.
+    '''
+    labels: pd.Index
+    demos: pd.Index
+    cells: np.ndarray
+    label_total: np.ndarray
+    demo_total: np.ndarray
+    demo_count: np.ndarray
+    total: float
+
+    def take(self, labels:list, demos:list)->tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Select the counts of the requested answers and demographic values, in their order.
+
+        Args:
+            - labels: Ordered answers, may contain duplicates or answers nobody gave [list]
+            - demos: Ordered demographic values [list]
+
+        Return:
+            - cells: Weight of each label per demo [numpy array]
+            - label_total: Weight of each label over all the respondents [numpy array]
+            - demo_total: Weight of the respondents that answered, per demo [numpy array]
+            - demo_count: Number of respondents that answered, per demo [numpy array]
+        '''
+        rows = self.labels.get_indexer(pd.Index(labels))
+        cols = self.demos.get_indexer(pd.Index(demos))
+        cells = np.pad(self.cells, ((0, 1), (0, 1)))[rows][:, cols] # position -1 picks the zero padding
+        return (
+            cells,
+            np.append(self.label_total, 0)[rows],
+            np.append(self.demo_total, 0)[cols],
+            np.append(self.demo_count, 0)[cols]
+            )
+
+class CrosstabContext:
+    '''
+    Factorized view of the survey shared by all the crosstab tables of a workbook.
+    Every question and demographic column is encoded into integer codes once, so the
+    crosstab functions only work on cached numpy arrays instead of the raw dataframe.
+
+    Args:
+        - df: Whole dataframe [pandas dataframe]
+        - weight: Column name of your weights [str]
+        - columns: Question and demographic columns to factorize up front [list]
+        - multi: Question that has multiple choice answer, split up front [list]
+    '''
+    def __init__(self, df:pd.DataFrame, weight:str, columns:list[str]=None, multi:list[str]=None):
+        self.df = df
+        self.weight = weight
+        self.weights = df[weight].to_numpy(dtype=float)
+        self._codes = {}
+        self._answered = {}
+        self._options = {}
+        for column in columns or []:
+            self.answered(column)
+        for q in multi or []:
+            self.options(q)
+
+    @classmethod
+    def from_arrays(cls, weights:np.ndarray, codes:dict, answered:dict, options:dict)->'CrosstabContext':
+        '''
+        Rebuild a context from already factorized arrays, without the dataframe.
+        Used by the worker processes of the parallel crosstab generation.
+
+        Args:
+            - weights: Weight of each respondent [numpy array]
+            - codes: Column name and its (codes, uniques) [dict]
+            - answered: Column name and its answered mask [dict]
+            - options: Multi choice question and its (positions, codes, options) [dict]
+
+        Return:
+            - context: CrosstabContext that only works off the given arrays.
+        '''
+        context = cls.__new__(cls)
+        context.df = None
+        context.weight = None
+        context.weights = weights
+        context._codes = dict(codes)
+        context._answered = dict(answered)
+        context._options = dict(options)
+        return context
+
+    def codes(self, column:str)->tuple[np.ndarray, pd.Index]:
+        '''
+        Integer codes of a column, -1 for missing values.
+
+        Args:
+            - column: Column name [str]
+
+        Return:
+            - codes: Code of each respondent [numpy array]
+            - uniques: Unique values in order of first appearance [pandas index]
+        '''
+        if column not in self._codes:
+            codes, uniques = pd.factorize(self.df[column], sort=False)
+            self._codes[column] = (codes, pd.Index(uniques))
+        return self._codes[column]
+
+    def answered(self, column:str)->np.ndarray:
+        '''
+        Mask of the respondents that answered the question (neither blank nor NaN).
+
+        Args:
+            - column: Column name of the question [str]
+
+        Return:
+            - boolean numpy array, True where the respondent answered.
+        '''
+        if column not in self._answered:
+            codes, uniques = self.codes(column)
+            blank = np.flatnonzero(uniques == '')
+            self._answered[column] = (codes >= 0) & ~np.isin(codes, blank)
+        return self._answered[column]
+
+    def value_counts(self, column:str)->list:
+        '''
+        Unique values of a column sorted by their number of respondents, like `pd.Series.value_counts`.
+
+        Args:
+            - column: Column name [str]
+
+        Return:
+            - list of the unique values in descending order of count.
+        '''
+        codes, uniques = self.codes(column)
+        counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        return list(pd.Series(counts, index=uniques).sort_values(ascending=False).index)
+
+    def options(self, q:str)->tuple[np.ndarray, np.ndarray, pd.Index]:
+        '''
+        Split the multiple answers of every respondent once, keeping track of who gave each option.
+
+        Args:
+            - q: Column name of the multi choice question, options separated by ', ' [str]
+
+        Return:
+            - positions: Row position of the respondent behind each option [numpy array]
+            - codes: Code of each option [numpy array]
+            - options: Unique options in order of first appearance [pandas index]
+        '''
+        if q not in self._options:
+            positions = np.flatnonzero(self.answered(q))
+            text = self.df[q].iloc[positions].astype(str)
+            keep = (text != 'nan').to_numpy()
+            split = text[keep].str.split(', ')
+            positions = np.repeat(positions[keep], split.str.len().to_numpy(dtype=int))
+            codes, options = pd.factorize(split.explode(), sort=False)
+            self._options[q] = (positions, codes, pd.Index(options))
+        return self._options[q]
+
+    def counts(self, q:str, column:str, multi:bool=False)->CrosstabCounts:
+        '''
+        Weighted counts of a question across a demographic column, from one pass over the respondents.
+
+        Args:
+            - q: Column name of the question [str]
+            - column: Column name of the demographic column [str]
+            - multi: Whether the question has multiple choice answer [bool]
+
+        Return:
+            - counts: raw weighted counts [CrosstabCounts]
+        '''
+        weights = self.weights
+        answered = self.answered(q)
+        col_codes, demos = self.codes(column)
+        if multi:
+            positions, row_codes, labels = self.options(q)
+            row_weights, row_cols = weights[positions], col_codes[positions]
+        else:
+            row_codes, labels = self.codes(q)
+            row_weights, row_cols = weights, col_codes
+
+        listed = row_codes >= 0
+        in_demo = answered & (col_codes >= 0)
+        # Single choice answers are summed like the masked `.sum()` of the original tables,
+        # the options of a multi choice question in sequence like its running totals
+        bincount = np.bincount if multi else _pairwise_bincount
+        return CrosstabCounts(
+            labels=labels,
+            demos=demos,
+            cells=_weighted_matrix(row_codes, row_cols, row_weights, len(labels), len(demos), pairwise=not multi),
+            label_total=bincount(row_codes[listed], weights=row_weights[listed], minlength=len(labels)),
+            demo_total=np.bincount(col_codes[in_demo], weights=weights[in_demo], minlength=len(demos)),
+            demo_count=np.bincount(col_codes[in_demo], minlength=len(demos)),
+            total=np.bincount(answered.astype(int), weights=weights, minlength=2)[1]
+            )
+
+    def batch_counts(self, q_ls:list[str], column:str)->dict[str, CrosstabCounts]:
+        '''
+        Weighted counts of many single choice questions across one demographic column.
+        Whether each respondent answered every question is encoded side by side into a sparse
+        (respondents x questions) matrix, which is multiplied once with the one-hot demographic
+        for the demo totals. The answer totals are summed pairwise on their own, like CrosstabContext.counts.
+
+        Args:
+            - q_ls: Column names of the single choice questions [list]
+            - column: Column name of the demographic column [str]
+
+        Return:
+            - dictionary of question and its raw weighted counts [CrosstabCounts]
+        '''
+        from scipy import sparse
+
+        weights = self.weights
+        n = len(weights)
+        col_codes, demos = self.codes(column)
+
+        # One-hot demographic, plus a last column for all the respondents
+        demo_onehot = np.zeros((n, len(demos) + 1))
+        demo_onehot[np.flatnonzero(col_codes >= 0), col_codes[col_codes >= 0]] = 1
+        demo_onehot[:, -1] = 1
+
+        result = {}
+        step = max(1, BATCH_SIZE // max(n, 1))
+        for begin in range(0, len(q_ls), step):
+            chunk = q_ls[begin:begin + step]
+
+            # Every question takes one column for the respondents that answered it,
+            # the respondents that did not answer go to one extra column to discard
+            cols = np.empty((len(chunk), n), dtype=np.int32)
+            answered_mask = np.empty((len(chunk), n))
+            for j, q in enumerate(chunk):
+                answered = self.answered(q)
+                cols[j] = np.where(answered, j, len(chunk))
+                answered_mask[j] = answered
+
+            onehot = sparse.csr_matrix(
+                (np.repeat(weights, len(chunk)), cols.T.ravel(), np.arange(0, cols.size + 1, len(chunk))),
+                shape=(n, len(chunk) + 1)
+                )
+            matrix = onehot.T @ demo_onehot # respondents are summed in ascending order, like a bincount
+            frequency = answered_mask @ demo_onehot
+
+            for j, q in enumerate(chunk):
+                codes, labels = self.codes(q)
+                result[q] = CrosstabCounts(
+                    labels=labels,
+                    demos=demos,
+                    cells=_weighted_matrix(codes, col_codes, weights, len(labels), len(demos), pairwise=True),
+                    label_total=_pairwise_bincount(codes[codes >= 0], weights[codes >= 0], len(labels)),
+                    demo_total=matrix[j, :-1],
+                    demo_count=frequency[j, :-1].astype(int),
+                    total=matrix[j, -1]
+                    )
+        return result
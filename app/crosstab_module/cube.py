@@ -0,0 +1,90 @@
+import pandas as pd
+from app.crosstab_module.context import CrosstabContext, CrosstabCounts
+from app.utils_module.utils import demography, col_search
+
+# Columns with more unique values are not treated as questions (eg. respondent IDs, open ended answers)
+MAX_ANSWERS = 200
+
+class CrosstabCube(CrosstabContext):
+    '''
+    Crosstab context that materializes the raw weighted counts of every question across every
+    demographic once, so any wise, name_sort or col_seqs can be rendered from it by write_table
+    without going through the respondents again. Counts that were not built up front
+    (eg. a demographic that was not a candidate) are computed on first use and kept.
+
+    Args:
+        - df: Whole dataframe [pandas dataframe]
+        - weight: Column name of your weights [str]
+        - demos: Candidate demographic columns [list]
+        - q_ls: Question columns, every column with at most MAX_ANSWERS answers but the weight and demos when undefined [list]
+        - multi: Question that has multiple choice answer [list]
+    '''
+    def __init__(self, df:pd.DataFrame, weight:str, demos:list[str], q_ls:list[str]=None, multi:list[str]=None):
+        multi = multi or []
+        if q_ls is None:
+            q_ls = [
+                column for column in df.columns
+                if column != weight and column not in demos and (column in multi or df[column].nunique() <= MAX_ANSWERS)
+                ]
+        super().__init__(df=df, weight=weight, columns=q_ls + demos, multi=[q for q in multi if q in q_ls])
+        self.demos = list(demos)
+        self.q_ls = list(q_ls)
+        self.multi = [q for q in multi if q in q_ls]
+        self._counts = {}
+        self._value_counts = {}
+        for demo in self.demos:
+            self.batch_counts(q_ls=[q for q in self.q_ls if q not in self.multi], column=demo)
+            for q in self.multi:
+                self.counts(q=q, column=demo, multi=True)
+        for q in self.q_ls:
+            self.value_counts(q)
+
+    @property
+    def nbytes(self)->int:
+        '''
+        Memory of the arrays held by the cube, in bytes.
+        '''
+        arrays = [self.weights]
+        arrays += [codes for codes, _ in self._codes.values()]
+        arrays += list(self._answered.values())
+        arrays += [array for positions, codes, _ in self._options.values() for array in (positions, codes)]
+        arrays += [counts.cells for counts in self._counts.values()]
+        return int(sum(array.nbytes for array in arrays))
+
+    def value_counts(self, column:str)->list:
+        if column not in self._value_counts:
+            self._value_counts[column] = super().value_counts(column)
+        return list(self._value_counts[column])
+
+    def counts(self, q:str, column:str, multi:bool=False)->CrosstabCounts:
+        key = (q, column, multi)
+        if key not in self._counts:
+            self._counts[key] = super().counts(q=q, column=column, multi=multi)
+        return self._counts[key]
+
+    def batch_counts(self, q_ls:list[str], column:str)->dict[str, CrosstabCounts]:
+        missing = [q for q in q_ls if (q, column, False) not in self._counts]
+        if missing:
+            for q, counts in super().batch_counts(q_ls=missing, column=column).items():
+                self._counts[(q, column, False)] = counts
+        return {q: self._counts[(q, column, False)] for q in q_ls}
+
+def build_cubes(df:pd.DataFrame)->dict[str, CrosstabCube]:
+    '''
+    A function to build the cubes of a freshly loaded survey, for every weight column,
+    with the demographic and multiple answer columns auto-detected like the crosstabs UI does.
+
+    Args:
+        - df: Whole dataframe [pandas dataframe]
+
+    Return:
+        - cubes: dictionary of weight column name and its cube [CrosstabCube]
+    '''
+    demos = demography(df=df)
+    multi = col_search(df=df, key='[MULTI]')
+    weights = [column for column in col_search(df=df, key='weight') if pd.api.types.is_numeric_dtype(df[column])]
+    q_ls = [
+        column for column in df.columns
+        if column not in demos and column not in weights and (column in multi or df[column].nunique() <= MAX_ANSWERS)
+        ]
+    return {weight: CrosstabCube(df=df, weight=weight, demos=demos, q_ls=q_ls, multi=multi) for weight in weights}
@@ -0,0 +1,112 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from app.crosstab_module.context import CrosstabContext, CrosstabCounts
+
+# State of a worker process, set once by _init_worker
+_CONTEXT = None
+_BLOCKS = []
+
+def _share(array:np.ndarray, blocks:list[shared_memory.SharedMemory])->tuple[str, tuple, str]:
+    '''
+    Copy an array into a new shared memory block.
+
+    Args:
+        - array: Array to share [numpy array]
+        - blocks: Shared memory blocks created so far, the new block is appended [list]
+
+    Return:
+        - spec: (block name, shape, dtype) to attach to the array from another process.
+    '''
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    blocks.append(block)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+    return block.name, array.shape, array.dtype.str
+
+def _attach(spec:tuple[str, tuple, str])->np.ndarray:
+    '''
+    Attach to an array shared by _share, without copying it.
+
+    Args:
+        - spec: (block name, shape, dtype) [tuple]
+
+    Return:
+        - numpy array backed by the shared memory block.
+    '''
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    _BLOCKS.append(block) # keep the block open for the lifetime of the worker
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def _init_worker(spec:dict):
+    '''
+    Initializer of the worker processes: rebuild the factorized survey from shared memory.
+
+    Args:
+        - spec: Shared memory specs of the weights, codes, answered masks and options [dict]
+
+    Return:
+        - None
+    '''
+    global _CONTEXT
+    _CONTEXT = CrosstabContext.from_arrays(
+        weights=_attach(spec['weights']),
+        codes={column: (_attach(codes), uniques) for column, (codes, uniques) in spec['codes'].items()},
+        answered={column: _attach(answered) for column, answered in spec['answered'].items()},
+        options={q: (_attach(positions), _attach(codes), options) for q, (positions, codes, options) in spec['options'].items()}
+        )
+
+def _count(task:tuple[str, str, bool])->CrosstabCounts:
+    '''
+    Compute the weighted counts of one (question, demo) pair in a worker process.
+
+    Args:
+        - task: (question, demography column, multi choice) [tuple]
+
+    Return:
+        - counts: raw weighted counts [CrosstabCounts]
+    '''
+    q, demo, multi = task
+    return _CONTEXT.counts(q=q, column=demo, multi=multi)
+
+def parallel_counts(context:CrosstabContext, q_ls:list[str], multi:list[str], demos:list[str], workers:int)->dict[tuple[str, str], CrosstabCounts]:
+    '''
+    Compute the weighted counts of every (demo, question) pair across a process pool.
+    The factorized codes and weights are passed to the workers through shared memory,
+    so only the question and demography names are sent per task.
+    Workers are started by a fork server rather than forked from the caller, which may be a thread of a multi-threaded server.
+
+    Args:
+        - context: Factorized survey [CrosstabContext]
+        - q_ls: List of question column.
+        - multi: List of column that contains multiple answer option.
+        - demos: List of name of the selected demography columns.
+        - workers: Number of worker processes [int]
+
+    Return:
+        - dictionary of (demo, question) and its raw weighted counts [CrosstabCounts]
+    '''
+    blocks = []
+    try:
+        spec = {'weights': _share(context.weights, blocks), 'codes': {}, 'answered': {}, 'options': {}}
+        for column in list(dict.fromkeys(q_ls + demos)):
+            codes, uniques = context.codes(column)
+            spec['codes'][column] = (_share(codes, blocks), uniques)
+            spec['answered'][column] = _share(context.answered(column), blocks)
+        for q in [q for q in q_ls if q in multi]:
+            positions, codes, options = context.options(q)
+            spec['options'][q] = (_share(positions, blocks), _share(codes, blocks), options)
+
+        tasks = [(q, demo, q in multi) for demo in demos for q in q_ls]
+        chunksize = max(1, len(tasks) // (4 * workers))
+        with ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('forkserver'), initializer=_init_worker, initargs=(spec,)
+                ) as executor:
+            results = list(executor.map(_count, tasks, chunksize=chunksize))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return {(demo, q): counts for (q, demo, _), counts in zip(tasks, results)}
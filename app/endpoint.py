@@ -3,26 +3,240 @@ from fastapi import (
     status, 
     APIRouter,
     UploadFile,
-    File
+    File,
+    Form,
+    Header,
+    Response,
+    HTTPException
     )
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from typing import Any, Callable, Awaitable, TYPE_CHECKING
+import asyncio
 from io import StringIO
 import base64
 from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 import os
 import shutil
+import tempfile
 import pandas as pd
-from .utils_module.utils import load, demography, col_search, sorter
-from .chart_module.chart import load_chart
-from .component_module.table import write_table
-from .component_module.viz import draw_chart
+from .utils_module.utils import load, read_columnar, demography, col_search, sorter, export_data
+from .utils_module.store import DatasetStore
+from .utils_module.jobs import JobManager, JobQueueFull, JOB_TIMEOUT, DONE
+from .utils_module.executor import Executor, ExecutorSaturated
+from .utils_module.cache import ResultCache, fingerprint, result_key
+from .utils_module import timing
+from .utils_module.timing import stage
+from .utils_module import memory
+from .utils_module.memory import MemoryBudget, MemoryBudgetExceeded
 from .schema import (
     CrosstabSchema, 
+    CrosstabParams,
     ChartSchema, 
     DataframeSchema,
     ColumnSearchSchema,
     DemoSorterSchema
     )
 
+# The crosstab and chart stack is imported by the endpoints that use it, so the light endpoints start faster
+if TYPE_CHECKING:
+    from .crosstab_module.cube import CrosstabCube
+
+# Size of the chunks of a streamed xlsx file
+STREAM_CHUNK_SIZE = 1024**2
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def stream_xlsx(data:bytes, filename:str)->StreamingResponse:
+    '''
+    Stream a workbook as an xlsx file download, one chunk at a time.
+
+    Args:
+        - data: Workbook in bytes [bytes]
+        - filename: Name of the downloaded file [str]
+
+    Return:
+        - response: xlsx file response [StreamingResponse]
+    '''
+    chunks = (data[begin:begin + STREAM_CHUNK_SIZE] for begin in range(0, len(data), STREAM_CHUNK_SIZE))
+    return StreamingResponse(
+        chunks,
+        media_type=XLSX_MEDIA_TYPE,
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Content-Length": str(len(data))
+        }
+    )
+
+def source_fingerprint(parser:str, data:Any)->str:
+    '''
+    Fingerprint of a survey with the path that parses it: 'json' (df), 'read' (/read) or 'columnar' (/crosstabs/upload).
+    The paths parse the same bytes into different dataframes (eg. a Parquet '001' code kept as a string or read as 1),
+    so their crosstabs are cached under different keys.
+
+    Args:
+        - parser: Path that parses the survey [str]
+        - data: Content of the survey [str or bytes]
+
+    Return:
+        - fingerprint: parser and hash of the content [str]
+    '''
+    return f"{parser}:{fingerprint(data)}"
+
+def parse_dataset(df:str)->pd.DataFrame:
+    '''
+    Parse the survey sent as a JSON string.
+
+    Args:
+        - df: Whole dataframe in JSON string format [str]
+
+    Return:
+        - df: a pandas dataframe
+    '''
+    with stage('endpoint.read_json') as counts:
+        df = pd.read_json(StringIO(df), orient="records")
+        counts['rows'] = len(df)
+    return df
+
+def read_survey(path:str, cube:bool=False)->tuple[Any, pd.DataFrame, str, dict]:
+    '''
+    Load an uploaded survey for the /read endpoint.
+
+    Args:
+        - path: Filepath of the uploaded survey [str]
+        - cube: Build the weighted count cubes of the survey [bool]
+
+    Return:
+        - df_reader: the survey encoded for the JSON response.
+        - dataset: the parsed survey, with the column types of its file (eg. Arrow and Parquet dtypes).
+        - dataset_hash: fingerprint of the uploaded file, as parsed by /read.
+        - cubes: weight column name and its cube, empty when cube is false.
+    '''
+    with open(path, 'rb') as f:
+        dataset_hash = source_fingerprint('read', f.read())
+    read_df = load(df=path)
+    with stage('endpoint.to_json', rows=len(read_df)):
+        df_reader = jsonable_encoder(
+            read_df,
+            custom_encoder={
+                bytes: lambda value: base64.b64encode(value).decode("utf-8")
+            }
+        )
+    if not cube:
+        return df_reader, read_df, dataset_hash, {}
+    from .crosstab_module.cube import build_cubes
+    with stage('endpoint.cube') as counts:
+        cubes = build_cubes(read_df)
+        counts['cubes'] = len(cubes)
+    return df_reader, read_df, dataset_hash, cubes
+
+def read_chart_tables(path:str)->dict:
+    '''
+    Load the tables of an uploaded crosstabs file for the /read_crosstabs endpoint.
+
+    Args:
+        - path: Filepath of the uploaded crosstabs file [str]
+
+    Return:
+        - data: tables in JSON string format and their sheet names.
+    '''
+    from .chart_module.chart import iter_chart_sheets
+    data = {"df_list": [], "sheet_names": []}
+    for sheet_name, df in iter_chart_sheets(df_charts=path):
+        data["df_list"].append(df.to_json(orient="records"))
+        data["sheet_names"].append(sheet_name)
+    return data
+
+def chart_files(dfs:list[str], sheet_names:list[str])->bytes:
+    '''
+    Draw the charts of the crosstabs tables for the /chart endpoint.
+
+    Args:
+        - dfs: list of pandas DataFrame in JSON string format [list]
+        - sheet_names: list of the sheet names in the crosstabs file [list]
+
+    Return:
+        - charts: workbook of the charts in bytes.
+    '''
+    from .component_module.viz import draw_chart
+    return draw_chart(
+        dfs=[parse_dataset(df) for df in dfs],
+        sheet_names=sheet_names
+    )
+
+def crosstabs_files(
+        df:pd.DataFrame,
+        crosstabs:CrosstabParams,
+        progress:Callable[[int, int], None]=None,
+        cube:'CrosstabCube'=None,
+        constant_memory:bool=False
+        )->tuple[bytes, Any]:
+    '''
+    Generate the crosstabs of a survey, and the separate raw data file when requested.
+
+    Args:
+        - df: Whole dataframe [pandas dataframe]
+        - crosstabs: Parameters of the crosstabs [CrosstabParams]
+        - progress: Called with (questions done, total questions) by write_table [callable]
+        - cube: Weighted counts materialized from df for the weight of the crosstabs [CrosstabCube]
+        - constant_memory: Write the workbook with flat memory, as planned by the memory budget [bool]
+
+    Return:
+        - df_xlsx: crosstabs workbook in bytes.
+        - raw: raw data file in bytes, None when the raw data is not exported separately.
+    '''
+    from .component_module.table import write_table
+    df_xlsx = write_table(
+        df=df,
+        demos=crosstabs.demos,
+        wise=crosstabs.wise,
+        q_ls=crosstabs.q_ls,
+        multi=crosstabs.multi,
+        name_sort=crosstabs.name_sort,
+        weight=crosstabs.weight,
+        col_seqs=crosstabs.col_seqs,
+        workers=crosstabs.workers,
+        constant_memory=constant_memory,
+        data_sheet=crosstabs.data_sheet if crosstabs.data_sheet in ['full', 'preview', 'none'] else 'none',
+        progress=progress,
+        cube=cube,
+        charts=crosstabs.charts
+    )
+    raw = export_data(df=df, fmt=crosstabs.data_sheet) if crosstabs.data_sheet in ['csv', 'parquet'] else None
+    return df_xlsx, raw
+
+def crosstabs_response(df_xlsx:bytes, raw:Any, stream:bool)->Any:
+    '''
+    Wrap the generated crosstabs in the response requested.
+
+    Args:
+        - df_xlsx: crosstabs workbook in bytes [bytes]
+        - raw: raw data file in bytes, None when the raw data is not exported separately [bytes]
+        - stream: Return the workbook as a streamed xlsx file instead of base64 in JSON [bool]
+
+    Return:
+        - data: df_xlsx (and the raw data file) in encoded bytes, or the streamed crosstabs.xlsx file.
+    '''
+    if stream:
+        return stream_xlsx(df_xlsx, filename="crosstabs.xlsx")
+    with stage('endpoint.base64', bytes=len(df_xlsx) + len(raw or b'')):
+        data = {
+            "crosstabs": jsonable_encoder(
+                df_xlsx,
+                custom_encoder={
+                    bytes: lambda value: base64.b64encode(value).decode("utf-8")
+                }
+            )
+        }
+        if raw is not None:
+            data["data"] = jsonable_encoder(
+                raw,
+                custom_encoder={
+                    bytes: lambda value: base64.b64encode(value).decode("utf-8")
+                }
+            )
+    return data
+
 description = """
 This is a crosstabs generator API from crosstabs-generator-v3.
 """
@@ -38,6 +252,203 @@ app = FastAPI(
 
 router = APIRouter(prefix="/crossart")
 
+# Blocking work of the endpoints, configured by the CROSSTAB_EXECUTOR* environment variables
+executor = Executor.from_env()
+
+@app.exception_handler(ExecutorSaturated)
+async def saturated_handler(request, error:ExecutorSaturated):
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": f"Server is busy, {error}"},
+        headers={"Retry-After": "1"}
+    )
+
+@app.exception_handler(JobQueueFull)
+async def job_queue_handler(request, error:JobQueueFull):
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": f"Job queue is full, {error}"},
+        headers={"Retry-After": "1"}
+    )
+
+@app.exception_handler(MemoryBudgetExceeded)
+async def memory_handler(request, error:MemoryBudgetExceeded):
+    # 413 when the request is too large for the budget, 503 when it waited too long for the others to finish
+    return JSONResponse(
+        status_code=error.status_code,
+        content={"detail": str(error)},
+        headers={"Retry-After": "1"} if error.status_code == status.HTTP_503_SERVICE_UNAVAILABLE else None
+    )
+
+# Stages timed during the requests, returned in the Server-Timing header and added to /metrics
+app.add_middleware(timing.ServerTimingMiddleware)
+
+@app.get("/metrics", tags=["Metrics"])
+def get_metrics():
+    '''
+    Endpoint to scrape the durations of the stages and requests, in the Prometheus text format.
+    Stages are timed when the CROSSTAB_TIMING environment variable is 1.
+
+    Return:
+
+        - crosstab_stage_seconds: histogram of every stage of load, load_chart, write_table, draw_chart and the endpoints.
+        - crosstab_stage_items_total: rows, tables, charts, bytes... the stages went through.
+        - crosstab_http_request_seconds: histogram of the requests by method, route and status.
+        - crosstab_memory_requests_total: crosstabs by mode under the memory budget; normal, constant_memory or rejected.
+        - crosstab_memory_estimate_bytes_total / crosstab_memory_peak_bytes_total: estimated and measured peak memory
+          of the requests, when CROSSTAB_MEMORY_TRACE is 1.
+    '''
+    return PlainTextResponse(timing.metrics.render(), media_type="text/plain; version=0.0.4")
+
+# Peak memory the requests may reserve together, configured by the CROSSTAB_MEMORY* environment variables
+budget = MemoryBudget.from_env()
+
+async def budgeted(estimate:int, what:str, fn:Callable, *args, **kwargs)->Any:
+    '''
+    Run a function in the executor once its estimated peak memory fits in the budget,
+    and compare the estimate with the measured peak when CROSSTAB_MEMORY_TRACE is 1.
+
+    Args:
+        - estimate: Peak memory of the function in bytes [int]
+        - what: Name of the request for the error message [str]
+        - fn: Function to run [callable]
+        - args, kwargs: Arguments of the function
+
+    Return:
+        - result: Return value of the function.
+    '''
+    async with budget.reserve(estimate, what=what):
+        if not memory.tracing():
+            return await executor.run(fn, *args, **kwargs)
+        result, peak = await executor.run(memory.traced, fn, *args, **kwargs)
+    memory.record_peak(estimate, peak)
+    return result
+
+# Surveys parsed by /read, shared by the following requests of the session
+datasets = DatasetStore()
+
+# Crosstabs generated in the background by /crosstabs/jobs, configured by the CROSSTAB_JOB* environment variables
+jobs = JobManager.from_env()
+
+# Generated crosstabs by dataset and parameters, configured by the CROSSTAB_CACHE* environment variables
+cache = ResultCache.from_env()
+
+async def read_dataset(request:DataframeSchema)->pd.DataFrame:
+    '''
+    Get the survey of a request, from the dataset store or by parsing its JSON string in the executor.
+
+    Args:
+        - request: Request body with either df or dataset_id [DataframeSchema]
+
+    Return:
+        - df: a pandas dataframe
+    '''
+    if request.dataset_id is None:
+        return await budgeted(len(request.df) * memory.JSON_BYTES_FACTOR, 'survey', parse_dataset, request.df)
+    try:
+        return datasets.get(request.dataset_id)
+    except KeyError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Dataset {request.dataset_id} not found or expired, upload it again to /read"
+            )
+
+def crosstabs_key(request:DataframeSchema)->str:
+    '''
+    Key of the crosstabs of a request in the result cache, also used as their ETag.
+
+    Args:
+        - request: Request body with either df or dataset_id, and the crosstab parameters [CrosstabSchema]
+
+    Return:
+        - key: hash of the dataset content and the crosstab parameters [str]
+    '''
+    if request.dataset_id is None:
+        return result_key(source_fingerprint('json', request.df), request.cache_params())
+    try:
+        return result_key(datasets.fingerprint(request.dataset_id), request.cache_params())
+    except KeyError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Dataset {request.dataset_id} not found or expired, upload it again to /read"
+            )
+
+async def cached_crosstabs(key:str, crosstabs:CrosstabParams, read_df:Callable[[], Awaitable[pd.DataFrame]], cube:'CrosstabCube'=None)->tuple[bytes, Any]:
+    '''
+    Get the crosstabs from the result cache, or generate and cache them within the memory budget;
+    crosstabs too large for an in memory workbook are written with a constant memory one.
+
+    Args:
+        - key: Key of the crosstabs in the result cache [str]
+        - crosstabs: Parameters of the crosstabs [CrosstabParams]
+        - read_df: Coroutine function returning the survey, only called on a cache miss [callable]
+        - cube: Weighted counts materialized from the survey [CrosstabCube]
+
+    Return:
+        - df_xlsx: crosstabs workbook in bytes.
+        - raw: raw data file in bytes, None when the raw data is not exported separately.
+    '''
+    result = await asyncio.to_thread(cache.get, key)
+    if result is None:
+        df = await read_df()
+        mode, estimate = budget.plan(len(df), len(df.columns), crosstabs.q_ls, crosstabs.demos, crosstabs.data_sheet)
+        result = await budgeted(
+            estimate, 'crosstabs', crosstabs_files,
+            df=df, crosstabs=crosstabs, cube=cube, constant_memory=mode == memory.CONSTANT_MEMORY
+            )
+        await asyncio.to_thread(cache.put, key, result)
+    return result
+
+def etag_matches(etag:str, if_none_match:str)->bool:
+    '''
+    Check whether the client already holds the version of the ETag.
+
+    Args:
+        - etag: ETag of the response [str]
+        - if_none_match: If-None-Match header of the request [str]
+
+    Return:
+        - True when the If-None-Match header lists the ETag.
+    '''
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags
+
+def with_etag(data:Any, response:Response, etag:str)->Any:
+    '''
+    Set the ETag header on the response of an endpoint.
+
+    Args:
+        - data: Returned response or JSON data [Any]
+        - response: Response of the endpoint, which headers apply to returned JSON data [Response]
+        - etag: ETag of the response [str]
+
+    Return:
+        - data, unchanged.
+    '''
+    headers = data.headers if isinstance(data, Response) else response.headers
+    headers["ETag"] = etag
+    return data
+
+def read_job(job_id:str)->Any:
+    '''
+    Get a crosstabs job, or answer 404 when it is unknown.
+
+    Args:
+        - job_id: ID of the job [str]
+
+    Return:
+        - job: Job [Job]
+    '''
+    try:
+        return jobs.get(job_id)
+    except KeyError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Job {job_id} not found or expired"
+            )
+
 @router.get("/", status_code=status.HTTP_200_OK, tags=["test"])
 def root():
     return {"status": "ok",
@@ -45,35 +456,55 @@ def root():
 
 # --------------------------- Crosstab Generator Endpoint ------------------------------------------
 @router.post("/read", tags=["Read dataset"])
-async def read_data(file: UploadFile = File(...)):
+async def read_data(file: UploadFile = File(...), cube: bool = False):
     '''
     Endpoint to read and load the streamlit dataframe into pandas dataframe.
 
     Request:
 
-        - file: Filepath or buffer(Streamlit dataframe/SpooledTemporaryFile)
+        - file: Filepath or buffer(Streamlit dataframe/SpooledTemporaryFile) of a csv, xlsx, Parquet or Arrow IPC file.
+        - cube: Build the weighted counts of every question across the detected demographics and weights,
+                so /crosstabs renders the dataset_id without going through the respondents (query parameter).
+                Off by default, as building them costs more than a few /crosstabs requests on large surveys.
 
     Return:
 
         - df: a pandas dataframe
+        - dataset_id: ID of the dataset, to send to the other endpoints in place of df.
     '''
-    os.makedirs('temp', exist_ok=True)
-    path =  f"temp/{file.filename}"
-    with open(path, 'w+b') as f:
-        shutil.copyfileobj(file.file, f)
-    read_df = load(df=path)
+    # Every request saves its upload in its own folder, as requests run concurrently
+    with tempfile.TemporaryDirectory() as temp:
+        path = os.path.join(temp, os.path.basename(file.filename))
+        with open(path, 'w+b') as f:
+            # The upload spools to disk past 1 MB, so it is copied off the event loop
+            await asyncio.to_thread(shutil.copyfileobj, file.file, f)
+        # Counting the cells of a csv reads the whole file, so it runs in the executor too
+        estimate = await executor.run(memory.survey_cells, path) * memory.READ_BYTES_PER_CELL
+        df_reader, dataset, dataset_hash, cubes = await budgeted(estimate, 'survey', read_survey, path, cube=cube)
+    # The parsed survey is kept as is, so dataset_id callers get the column types of the file
+    dataset_id = datasets.put(dataset, fingerprint=dataset_hash, cubes=cubes)
     data = {
-        "df_reader": jsonable_encoder(
-            read_df,
-            custom_encoder={
-                bytes: lambda value: base64.b64encode(value).decode("utf-8")
-            }
-        )
+        "df_reader": df_reader,
+        "dataset_id": dataset_id
     }
-    os.remove(path)
-    shutil.rmtree('temp')
     return data
 
+@router.delete("/read/{dataset_id}", tags=["Read dataset"])
+async def delete_data(dataset_id: str):
+    '''
+    Endpoint to release a dataset registered by /read, once the session is over.
+
+    Request:
+
+        - dataset_id: ID of the dataset [str]
+
+    Return:
+
+        - status: ok
+    '''
+    datasets.delete(dataset_id)
+    return {"status": "ok"}
+
 @router.post("/demography", tags=["Auto-select demo"])
 async def autoselect_demography(demo: DataframeSchema):
     '''
@@ -82,12 +513,13 @@ async def autoselect_demography(demo: DataframeSchema):
     Request:
 
         - df: Whole dataframe in JSON string format.
+        - dataset_id: ID of the dataset from /read, in place of df.
 
     Return:
 
         - default_demo: list of the column that contains string like 'age', 'gender', 'eth', 'income', 'urban'.
     '''
-    df_json = pd.read_json(StringIO(demo.df), orient="records")
+    df_json = await read_dataset(demo)
     demo_list = demography(df=df_json)
     data = {
         "demo_list": demo_list
@@ -102,13 +534,14 @@ async def get_search_column(search_col: ColumnSearchSchema):
     Request:
 
         - df: Whole dataframe in JSON string format.
+        - dataset_id: ID of the dataset from /read, in place of df.
         - key: keyword to match [str]
 
     Return:
 
         - columns_with_string: list of the column that contains certain keyword.
     '''
-    df_json = pd.read_json(StringIO(search_col.df), orient="records")
+    df_json = await read_dataset(search_col)
     columns_with_string = col_search(
         df=df_json,
         key=search_col.key
@@ -127,12 +560,13 @@ async def get_demo_sorter(demo_sorter: DemoSorterSchema):
 
         - demo: Column name of the demography you're building the table on [str]
         - df: Whole dataframe in JSON string format.
+        - dataset_id: ID of the dataset from /read, in place of df.
 
     Return:
 
         - sorted list of unique values from specific column in the dataframe.
     '''
-    df_json = pd.read_json(StringIO(demo_sorter.df), orient="records")
+    df_json = await read_dataset(demo_sorter)
     sort_demo = sorter(
         demo=demo_sorter.demo,
         df=df_json
@@ -143,13 +577,14 @@ async def get_demo_sorter(demo_sorter: DemoSorterSchema):
     return data
 
 @router.post("/crosstabs", tags=["Crosstabs Generator"])
-async def generate_crosstabs(crosstabs: CrosstabSchema):
+async def generate_crosstabs(crosstabs: CrosstabSchema, response: Response, if_none_match: str = Header(None)):
     '''
     Endpoint to generate crosstabs based on the weighted survey file.
 
     Request:
 
         - df: Whole dataframe in JSON string format.
+        - dataset_id: ID of the dataset from /read, in place of df.
         - demos: List of name of the selected demography columns. 
         - wise: User selection of the value options. 
         - q_ls: List of question column. 
@@ -159,31 +594,170 @@ async def generate_crosstabs(crosstabs: CrosstabSchema):
         - col_seqs:
             - Key: Demography column
             - Value: Sorted unique value of the key demography column.
+        - workers: Number of processes to compute the tables with, sequential when 1, at most CROSSTAB_MAX_WORKERS (422 above).
+        - data_sheet: Raw data in the output; 'full' or 'preview' sheet, 'none', or a separate 'csv' (gzip) or 'parquet' file.
+        - stream: Return the workbook as a streamed xlsx file instead of base64 in JSON.
+        - charts: Draw the clustered bar chart of every table next to it.
+        - If-None-Match: ETag of crosstabs the client already has (header).
     
     Return:
     
-        - data: df_xlsx in encoded bytes.
+        - data: df_xlsx in encoded bytes, and the raw data file in encoded bytes when exported separately.
+        - crosstabs.xlsx file when stream is true.
+        - ETag: hash of the dataset and the parameters (header); 304 without body when it matches If-None-Match.
     '''
-    df_json = pd.read_json(StringIO(crosstabs.df), orient="records")
-    df_xlsx = write_table(
-        df=df_json,
-        demos=crosstabs.demos,
-        wise=crosstabs.wise,
-        q_ls=crosstabs.q_ls,
-        multi=crosstabs.multi,
-        name_sort=crosstabs.name_sort,
-        weight=crosstabs.weight,
-        col_seqs=crosstabs.col_seqs
-    )
-    data = {
-        "crosstabs": jsonable_encoder(
-            df_xlsx,
-            custom_encoder={
-                bytes: lambda value: base64.b64encode(value).decode("utf-8")
-            }
-        )
-    }
-    return data
+    key = crosstabs_key(crosstabs)
+    etag = f'"{key}"'
+    if etag_matches(etag, if_none_match):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    cube = datasets.cube(crosstabs.dataset_id, crosstabs.weight) if crosstabs.dataset_id is not None else None
+    df_xlsx, raw = await cached_crosstabs(key, crosstabs, read_df=lambda: read_dataset(crosstabs), cube=cube)
+    data = crosstabs_response(df_xlsx=df_xlsx, raw=raw, stream=crosstabs.stream)
+    return with_etag(data, response, etag)
+
+@router.post("/crosstabs/upload", tags=["Crosstabs Generator"])
+async def generate_crosstabs_upload(response: Response, file: UploadFile = File(...), params: str = Form(...), if_none_match: str = Header(None)):
+    '''
+    Endpoint to generate crosstabs based on the weighted survey sent as a file in a multipart body,
+    which keeps the column types and skips the JSON parsing of the survey.
+
+    Request:
+
+        - file: Survey in Arrow IPC (file or stream format) or Parquet.
+        - params: Crosstab parameters in JSON string format; demos, wise, q_ls, multi, name_sort, weight, col_seqs, workers, data_sheet, stream, charts (see /crosstabs).
+        - If-None-Match: ETag of crosstabs the client already has (header).
+
+    Return:
+
+        - Same response as /crosstabs, with its ETag.
+    '''
+    try:
+        crosstabs = CrosstabParams.model_validate_json(params)
+    except ValidationError as error:
+        raise RequestValidationError(error.errors())
+    content = await file.read()
+    key = result_key(source_fingerprint('columnar', content), crosstabs.cache_params())
+    etag = f'"{key}"'
+    if etag_matches(etag, if_none_match):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    async def read_df()->pd.DataFrame:
+        try:
+            estimate = await executor.run(memory.survey_cells, content) * memory.COLUMNAR_BYTES_PER_CELL
+            return await budgeted(estimate, 'survey', read_columnar, content)
+        except ValueError as error:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+
+    df_xlsx, raw = await cached_crosstabs(key, crosstabs, read_df=read_df)
+    data = crosstabs_response(df_xlsx=df_xlsx, raw=raw, stream=crosstabs.stream)
+    return with_etag(data, response, etag)
+
+@router.post("/crosstabs/jobs", status_code=status.HTTP_202_ACCEPTED, tags=["Crosstabs Jobs"])
+async def submit_crosstabs_job(crosstabs: CrosstabSchema, timeout: float = JOB_TIMEOUT):
+    '''
+    Endpoint to generate crosstabs in the background, returning a job to poll right away.
+
+    Request:
+
+        - Same body as /crosstabs.
+        - timeout: Seconds the generation may run before it is stopped (query parameter).
+
+    Return:
+
+        - job_id: ID of the job.
+        - state: queued, running, done, failed, cancelled or timeout.
+        - done / total: Number of questions done over all the demos.
+        - error: Error message when the job did not finish.
+        - 429 when CROSSTAB_JOB_QUEUE jobs are already queued or running; finished jobs expire after CROSSTAB_JOB_RESULT_TTL seconds.
+    '''
+    # An unknown dataset_id, or a dataset too large for the memory budget, is reported now; a JSON df is parsed in the job
+    key = crosstabs_key(crosstabs)
+    df = await read_dataset(crosstabs) if crosstabs.dataset_id is not None else None
+    cube = datasets.cube(crosstabs.dataset_id, crosstabs.weight) if crosstabs.dataset_id is not None else None
+    plan = budget.plan(len(df), len(df.columns), crosstabs.q_ls, crosstabs.demos, crosstabs.data_sheet) if df is not None else None
+    # The JSON df is only held by the job until it is parsed
+    pending = [crosstabs.df] if df is None else []
+    crosstabs = crosstabs.model_copy(update={"df": None})
+
+    def run(progress:Callable[[int, int], None])->tuple[bytes, Any, bool]:
+        result = cache.get(key)
+        if result is None:
+            # The job waits for memory in the budget, and stops waiting once it is cancelled or timed out
+            waiting = lambda: progress(0, len(crosstabs.demos) * len(crosstabs.q_ls))
+            frame = df
+            if frame is None:
+                with budget.hold(len(pending[0]) * memory.JSON_BYTES_FACTOR, waiting=waiting, what='survey'):
+                    frame = parse_dataset(pending.pop())
+            mode, estimate = plan if df is not None else budget.plan(
+                len(frame), len(frame.columns), crosstabs.q_ls, crosstabs.demos, crosstabs.data_sheet
+                )
+            with budget.hold(estimate, waiting=waiting, what='crosstabs'):
+                result = crosstabs_files(
+                    df=frame,
+                    crosstabs=crosstabs,
+                    progress=progress,
+                    cube=cube,
+                    constant_memory=mode == memory.CONSTANT_MEMORY
+                )
+            cache.put(key, result)
+        else:
+            total = len(crosstabs.demos) * len(crosstabs.q_ls)
+            progress(total, total)
+        df_xlsx, raw = result
+        return df_xlsx, raw, crosstabs.stream
+
+    job = jobs.submit(run, timeout=timeout)
+    return job.status()
+
+@router.get("/crosstabs/jobs/{job_id}", tags=["Crosstabs Jobs"])
+async def get_crosstabs_job(job_id: str):
+    '''
+    Endpoint to poll the state and progress of a crosstabs job.
+
+    Request:
+
+        - job_id: ID of the job [str]
+
+    Return:
+
+        - job_id, state, done, total, error (see /crosstabs/jobs).
+    '''
+    return read_job(job_id).status()
+
+@router.get("/crosstabs/jobs/{job_id}/result", tags=["Crosstabs Jobs"])
+async def get_crosstabs_job_result(job_id: str):
+    '''
+    Endpoint to fetch the crosstabs of a finished job.
+
+    Request:
+
+        - job_id: ID of the job [str]
+
+    Return:
+
+        - Same response as /crosstabs, 409 with the job status when the job is not done.
+    '''
+    job = read_job(job_id)
+    if job.state != DONE:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=job.status())
+    df_xlsx, raw, stream = job.result
+    return crosstabs_response(df_xlsx=df_xlsx, raw=raw, stream=stream)
+
+@router.delete("/crosstabs/jobs/{job_id}", tags=["Crosstabs Jobs"])
+async def cancel_crosstabs_job(job_id: str):
+    '''
+    Endpoint to cancel a crosstabs job; a running job stops after the question it is working on.
+
+    Request:
+
+        - job_id: ID of the job [str]
+
+    Return:
+
+        - job_id, state, done, total, error (see /crosstabs/jobs).
+    '''
+    read_job(job_id)
+    return jobs.cancel(job_id).status()
 
 # --------------------------- Chart Generator Endpoint ------------------------------------------
 @router.post("/read_crosstabs", tags=["Read"])
@@ -200,17 +774,11 @@ async def read_crosstabs(file: UploadFile = File(...)):
         - dfs: List of pandas dataframe.
         - sheet_names: List of name of the sheet 
     '''
-    os.makedirs('temp', exist_ok=True)
-    path =  f"temp/{file.filename}"
-    with open(path, 'w+b') as f:
-        shutil.copyfileobj(file.file, f)
-    dfs, sheet_names, _ = load_chart(df_charts=path)
-    data = {
-        "df_list": [df.to_json(orient="records") for df in dfs],
-        "sheet_names": sheet_names,
-    }
-    os.remove(path)
-    shutil.rmtree('temp')
+    with tempfile.TemporaryDirectory() as temp:
+        path = os.path.join(temp, os.path.basename(file.filename))
+        with open(path, 'w+b') as f:
+            await asyncio.to_thread(shutil.copyfileobj, file.file, f)
+        data = await executor.run(read_chart_tables, path)
     return data
 
 @router.post("/chart", tags=["Chart Generator"])
@@ -222,24 +790,25 @@ async def generate_chart(chart: ChartSchema):
 
         - dfs: list of pandas DataFrame in JSON string format -> List[str]
         - sheet_names: list of the sheet names in the crosstabs file. 
+        - stream: Return the charts as a streamed xlsx file instead of base64 in JSON.
 
     Return:
 
         - data: charts in encoded bytes.
+        - charts.xlsx file when stream is true.
     '''
-    dfs = [pd.read_json(StringIO(df), orient='records') for df in chart.dfs]
-    charts = draw_chart(
-        dfs=dfs,
-        sheet_names=chart.sheet_names
-    )
-    data = {
-        "charts": jsonable_encoder(
-            charts,
-            custom_encoder={
-                bytes: lambda value: base64.b64encode(value).decode("utf-8")
-            }
-        )
-    }
+    charts = await executor.run(chart_files, dfs=chart.dfs, sheet_names=chart.sheet_names)
+    if chart.stream:
+        return stream_xlsx(charts, filename="charts.xlsx")
+    with stage('endpoint.base64', bytes=len(charts)):
+        data = {
+            "charts": jsonable_encoder(
+                charts,
+                custom_encoder={
+                    bytes: lambda value: base64.b64encode(value).decode("utf-8")
+                }
+            )
+        }
     return data
 
 app.include_router(router)
\ No newline at end of file
@@ -1,14 +1,23 @@
-from pydantic import BaseModel
-from typing import List, Dict
+from pydantic import BaseModel, Field, model_validator
+from typing import List, Dict, Literal, Optional
+from app.utils_module.executor import MAX_CROSSTAB_WORKERS
 
 class DataframeSchema(BaseModel):
     '''
     df: JSON string that contains survey response in dictionary.
+    dataset_id: ID of the survey registered by the /read endpoint, in place of df.
 
     Eg: 
         - '{"1. [LIKERT] Opinions":"5)Very Negative","2. What is your dream job field?":"Entrepreneurship","Gender":"Male","IncomeGroup":"B40","untrimmed_weight":0.506694401,"trimmed_weight":1.14631426}'
     '''
-    df: str
+    df: Optional[str] = None
+    dataset_id: Optional[str] = None
+
+    @model_validator(mode='after')
+    def check_dataset(self):
+        if (self.df is None) == (self.dataset_id is None):
+            raise ValueError("Either df or dataset_id should be given")
+        return self
 
 class ColumnSearchSchema(DataframeSchema):
     '''
@@ -22,9 +31,8 @@ class DemoSorterSchema(DataframeSchema):
     '''
     demo: str
 
-class CrosstabSchema(DataframeSchema): 
+class CrosstabParams(BaseModel): 
     '''
-    df: dataframe in JSON string that contains survey response in dictionary.
     demos: List of name of the selected demography columns. 
     wise: User selection of the value options. 
     q_ls: List of question column. 
@@ -34,6 +42,10 @@ class CrosstabSchema(DataframeSchema):
     col_seqs:
         Key: Demography column
         Value: Sorted unique value of the key demography column.
+    workers: Number of processes to compute the tables with, sequential when 1, at most CROSSTAB_MAX_WORKERS.
+    data_sheet: Raw data in the output; 'full' or 'preview' sheet, 'none', or a separate 'csv' (gzip) or 'parquet' file.
+    stream: Return the workbook as a streamed xlsx file instead of base64 in JSON.
+    charts: Draw the clustered bar chart of every table next to it.
     '''
     demos: List[str] 
     wise: str
@@ -42,11 +54,40 @@ class CrosstabSchema(DataframeSchema):
     name_sort: List[str] = None
     weight: str
     col_seqs: Dict
+    workers: int = Field(1, ge=1, le=MAX_CROSSTAB_WORKERS)
+    data_sheet: Literal['full', 'preview', 'none', 'csv', 'parquet'] = 'full'
+    stream: bool = False
+    charts: bool = False
+
+    @model_validator(mode='after')
+    def check_stream(self):
+        if self.stream and self.data_sheet in ['csv', 'parquet']:
+            raise ValueError("A separate raw data file can only be returned in JSON, set stream to false")
+        return self
+
+    def cache_params(self)->dict:
+        '''
+        Parameters that change the generated crosstabs, normalized for the result cache key.
+        workers and stream only change how the same crosstabs are computed and returned.
+        '''
+        params = self.model_dump(include=set(CrosstabParams.model_fields), exclude={'workers', 'stream'})
+        params['multi'] = sorted(set(self.multi or []))
+        params['name_sort'] = sorted(set(self.name_sort or []))
+        return params
+
+class CrosstabSchema(DataframeSchema, CrosstabParams): 
+    '''
+    df: dataframe in JSON string that contains survey response in dictionary.
+    dataset_id: ID of the survey registered by the /read endpoint, in place of df.
+    Crosstab parameters: see CrosstabParams.
+    '''
 
 class ChartSchema(BaseModel):
     '''
     dfs: list of dataframe in JSON string
     sheet_names: list of the sheet names in the crosstabs file.
+    stream: Return the charts as a streamed xlsx file instead of base64 in JSON.
     '''
     dfs: List[str]
-    sheet_names: List[str]
\ No newline at end of file
+    sheet_names: List[str]
+    stream: bool = False
\ No newline at end of file
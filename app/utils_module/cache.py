@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Any
+import pandas as pd
+
+# Environment variables of the result cache, with their defaults
+CACHE_BYTES = 'CROSSTAB_CACHE_BYTES' # 256 MB in memory
+CACHE_DIR = 'CROSSTAB_CACHE_DIR' # no disk tier when unset
+CACHE_DISK_BYTES = 'CROSSTAB_CACHE_DISK_BYTES' # 2 GB on disk
+
+def fingerprint(data:Any)->str:
+    '''
+    Hash of raw content, eg. the JSON string or the file bytes of a survey.
+
+    Args:
+        - data: Content to hash [str or bytes]
+
+    Return:
+        - hexadecimal sha256 digest [str]
+    '''
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+def dataset_fingerprint(df:pd.DataFrame)->str:
+    '''
+    Hash of the content of a dataframe: its columns, dtypes and every value.
+
+    Args:
+        - df: Whole dataframe [pandas dataframe]
+
+    Return:
+        - hexadecimal sha256 digest [str]
+    '''
+    digest = hashlib.sha256()
+    digest.update(json.dumps([[str(column), str(dtype)] for column, dtype in df.dtypes.items()]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def result_key(dataset:str, params:dict)->str:
+    '''
+    Key of a generated result: the dataset fingerprint with the parameters that change the result.
+
+    Args:
+        - dataset: Fingerprint of the dataset [str]
+        - params: JSON serializable parameters, normalized by the caller [dict]
+
+    Return:
+        - hexadecimal sha256 digest [str]
+    '''
+    return fingerprint(dataset + json.dumps(params, sort_keys=True, default=str))
+
+def result_size(value:Any)->int:
+    # Size of the bytes in a result, eg. (df_xlsx, raw)
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(result_size(item) for item in value)
+    return 0
+
+class ResultCache:
+    '''
+    Bounded cache of generated results (eg. crosstab workbooks) by content-addressed key.
+    Results are kept in memory up to `max_bytes`, and also written to `directory` up to
+    `max_disk_bytes` when it is given; both tiers evict the least recently used results.
+
+    Args:
+        - max_bytes: Maximum size of the results kept in memory [int]
+        - directory: Folder of the disk tier, memory only when None [str]
+        - max_disk_bytes: Maximum size of the results kept on disk [int]
+    '''
+    def __init__(self, max_bytes:int=256 * 1024**2, directory:str=None, max_disk_bytes:int=2 * 1024**3):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict() # key: (result, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_env(cls)->'ResultCache':
+        '''
+        Build the cache from the CROSSTAB_CACHE* environment variables.
+
+        Args:
+            - None
+
+        Return:
+            - cache: ResultCache configured for the deployment.
+        '''
+        return cls(
+            max_bytes=int(os.environ.get(CACHE_BYTES, 256 * 1024**2)),
+            directory=os.environ.get(CACHE_DIR) or None,
+            max_disk_bytes=int(os.environ.get(CACHE_DISK_BYTES, 2 * 1024**3))
+        )
+
+    def get(self, key:str)->Any:
+        '''
+        Get a result and mark it as recently used.
+
+        Args:
+            - key: Key of the result [str]
+
+        Return:
+            - result, None when it is not cached.
+        '''
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key][0]
+        path = self._path(key)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+            os.utime(path) # the modification time orders the disk tier
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        self._remember(key, result)
+        return result
+
+    def put(self, key:str, result:Any):
+        '''
+        Cache a result.
+
+        Args:
+            - key: Key of the result [str]
+            - result: bytes or tuple of bytes [Any]
+
+        Return:
+            - None
+        '''
+        self._remember(key, result)
+        path = self._path(key)
+        if path is None:
+            return
+        temp = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, path) # readers never see a partial file
+        self._evict_disk()
+
+    def __contains__(self, key:str)->bool:
+        with self._lock:
+            if key in self._memory:
+                return True
+        path = self._path(key)
+        return path is not None and os.path.exists(path)
+
+    def _path(self, key:str)->str:
+        return os.path.join(self.directory, f"{key}.pkl") if self.directory else None
+
+    def _remember(self, key:str, result:Any):
+        size = result_size(result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._bytes -= self._memory.pop(key)[1]
+            self._memory[key] = (result, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._memory.popitem(last=False)
+                self._bytes -= evicted
+
+    def _evict_disk(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
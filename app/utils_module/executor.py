@@ -0,0 +1,258 @@
+import asyncio
+import contextvars
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable
+from app.utils_module import timing
+
+# Environment variables of the executor, with their defaults
+EXECUTOR_KIND = 'CROSSTAB_EXECUTOR' # 'thread' or 'process'
+EXECUTOR_WORKERS = 'CROSSTAB_EXECUTOR_WORKERS' # os.cpu_count()
+EXECUTOR_MAX_IN_FLIGHT = 'CROSSTAB_MAX_IN_FLIGHT' # twice the workers
+EXECUTOR_QUEUE_TIMEOUT = 'CROSSTAB_QUEUE_TIMEOUT' # 30 seconds
+CROSSTAB_WORKERS = 'CROSSTAB_MAX_WORKERS' # 4
+
+# Processes a crosstabs request may compute its tables with (workers parameter)
+MAX_CROSSTAB_WORKERS = int(os.environ.get(CROSSTAB_WORKERS, 4))
+
+class ExecutorSaturated(Exception):
+    '''
+    Raised when no slot of the executor frees up within the queue timeout.
+    '''
+
+class _Waiter:
+    # Call queued by Admission, woken up once it is admitted
+    __slots__ = ('size', 'wake', 'admitted')
+
+    def __init__(self, size:int, wake:Callable[[], None]):
+        self.size = size
+        self.wake = wake
+        self.admitted = False
+
+def _resolve(future:asyncio.Future):
+    # Wake up a coroutine waiting for admission, unless it already timed out or was cancelled
+    if not future.done():
+        future.set_result(None)
+
+class Admission:
+    '''
+    First come, first served admission of calls into a capacity, eg. the slots of the executor
+    or the bytes of the memory budget. A call is admitted once it fits next to the admitted calls
+    and the calls queued before it are admitted; queued calls are woken up when capacity is released.
+    Coroutines of any event loop and threads can wait on the same admission.
+
+    Args:
+        - capacity: Total size of the calls admitted at the same time, no limit when None [int]
+    '''
+    def __init__(self, capacity:int=None):
+        self.capacity = capacity
+        self.used = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    async def acquire(self, size:int, timeout:float)->bool:
+        '''
+        Wait for the call to be admitted, in the order the calls arrived.
+
+        Args:
+            - size: Size of the call, eg. 1 slot or its bytes [int]
+            - timeout: Seconds to wait before giving up [float]
+
+        Return:
+            - True once admitted, False when the timeout is over; release the size once the call is done.
+        '''
+        with self._lock:
+            if self._take(size):
+                return True
+            if timeout <= 0:
+                return False
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            waiter = _Waiter(size, partial(loop.call_soon_threadsafe, _resolve, future))
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            # Admitted between the timeout and the cancellation of the wait
+            return self._leave(waiter)
+        except BaseException:
+            if self._leave(waiter):
+                self.release(size)
+            raise
+        return True
+
+    def wait(self, size:int, waiting:Callable[[], None]=None, interval:float=0.1):
+        '''
+        Block the thread until the call is admitted, in the order the calls arrived.
+
+        Args:
+            - size: Size of the call, eg. 1 slot or its bytes [int]
+            - waiting: Called every `interval` seconds while the call waits, may raise to stop waiting [callable]
+            - interval: Seconds between two calls of waiting [float]
+
+        Return:
+            - None; release the size once the call is done.
+        '''
+        with self._lock:
+            if self._take(size):
+                return
+            event = threading.Event()
+            waiter = _Waiter(size, event.set)
+            self._waiters.append(waiter)
+        try:
+            while not event.wait(interval):
+                if waiting:
+                    waiting()
+        except BaseException:
+            if self._leave(waiter):
+                self.release(size)
+            raise
+
+    def release(self, size:int):
+        '''
+        Release the size of a call that is done, and admit the queued calls that fit in order.
+
+        Args:
+            - size: Size the call was admitted with [int]
+
+        Return:
+            - None
+        '''
+        with self._lock:
+            self.used -= size
+            self._admit()
+
+    def _fits(self, size:int)->bool:
+        return self.capacity is None or self.used + size <= self.capacity
+
+    def _take(self, size:int)->bool:
+        # Admit a new call right away when nothing is queued before it
+        if self._waiters or not self._fits(size):
+            return False
+        self.used += size
+        return True
+
+    def _admit(self):
+        while self._waiters and self._fits(self._waiters[0].size):
+            waiter = self._waiters.popleft()
+            self.used += waiter.size
+            waiter.admitted = True
+            waiter.wake()
+
+    def _leave(self, waiter:_Waiter)->bool:
+        # Take a waiter out of the queue, the calls behind it may fit now; True when it was already admitted
+        with self._lock:
+            if waiter.admitted:
+                return True
+            self._waiters.remove(waiter)
+            self._admit()
+            return False
+
+class Executor:
+    '''
+    Thread or process pool for the blocking pandas and xlsxwriter work of the endpoints,
+    so the event loop stays free for the light endpoints.
+    At most `max_in_flight` calls are running or waiting in the pool; further calls queue in arrival order
+    for up to `queue_timeout` seconds, then ExecutorSaturated is raised (answered with 429).
+    In the process pool the function and its arguments are pickled, so the function must be importable.
+
+    Args:
+        - kind: 'thread' or 'process' [str]
+        - workers: Number of threads or processes [int]
+        - max_in_flight: Number of calls admitted at the same time [int]
+        - queue_timeout: Seconds a call waits for a slot before it is rejected [float]
+    '''
+    def __init__(self, kind:str='thread', workers:int=None, max_in_flight:int=None, queue_timeout:float=30):
+        if kind not in ['thread', 'process']:
+            raise ValueError(f"kind should be 'thread' or 'process', got '{kind}'")
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+        self.max_in_flight = self.workers * 2 if max_in_flight is None else max_in_flight
+        self.queue_timeout = queue_timeout
+        self._admission = Admission(self.max_in_flight)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls)->'Executor':
+        '''
+        Build the executor from the CROSSTAB_EXECUTOR* environment variables.
+
+        Args:
+            - None
+
+        Return:
+            - executor: Executor configured for the deployment.
+        '''
+        workers = os.environ.get(EXECUTOR_WORKERS)
+        max_in_flight = os.environ.get(EXECUTOR_MAX_IN_FLIGHT)
+        return cls(
+            kind=os.environ.get(EXECUTOR_KIND, 'thread'),
+            workers=int(workers) if workers else None,
+            max_in_flight=int(max_in_flight) if max_in_flight else None,
+            queue_timeout=float(os.environ.get(EXECUTOR_QUEUE_TIMEOUT, 30))
+        )
+
+    @property
+    def pool(self)->Any:
+        # The pool is started on first use, so importing the app does not spawn processes (nor import multiprocessing)
+        with self._lock:
+            if self._pool is None:
+                if self.kind == 'thread':
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers)
+                else:
+                    from concurrent.futures import ProcessPoolExecutor
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    @property
+    def in_flight(self)->int:
+        # Calls admitted and not done yet
+        return self._admission.used
+
+    async def run(self, fn:Callable, *args, **kwargs)->Any:
+        '''
+        Run a blocking function in the pool once a slot is free.
+
+        Args:
+            - fn: Blocking function [callable]
+            - args, kwargs: Arguments of the function
+
+        Return:
+            - Return value of the function.
+
+        Raise:
+            - ExecutorSaturated: No slot freed up within the queue timeout.
+        '''
+        if not await self._admission.acquire(1, self.queue_timeout):
+            raise ExecutorSaturated(f"{self.max_in_flight} calls are already in flight")
+        loop = asyncio.get_running_loop()
+        try:
+            if self.kind == 'thread':
+                # The timed stages of the call are recorded into the request that made it
+                return await loop.run_in_executor(self.pool, partial(contextvars.copy_context().run, fn, *args, **kwargs))
+            if not timing.enabled():
+                return await loop.run_in_executor(self.pool, partial(fn, *args, **kwargs))
+            result, records = await loop.run_in_executor(self.pool, partial(timing.collected, fn, *args, **kwargs))
+            timing.replay(records)
+            return result
+        finally:
+            self._admission.release(1)
+
+    def shutdown(self):
+        '''
+        Wait for the calls in the pool and stop it.
+
+        Args:
+            - None
+
+        Return:
+            - None
+        '''
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
@@ -0,0 +1,251 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass, field
+from typing import Any, Callable
+from app.utils_module.cache import result_size
+
+# Environment variables of the job manager, with their defaults
+JOB_WORKERS = 'CROSSTAB_JOB_WORKERS' # MAX_WORKERS
+JOB_QUEUE = 'CROSSTAB_JOB_QUEUE' # MAX_PENDING
+JOB_RESULT_TTL = 'CROSSTAB_JOB_RESULT_TTL' # RESULT_TTL
+JOB_RESULT_BYTES = 'CROSSTAB_JOB_RESULT_BYTES' # MAX_RESULT_BYTES
+
+# Default bounds of the job manager
+MAX_WORKERS = 2
+MAX_PENDING = 8 # jobs queued or running
+MAX_JOBS = 100 # finished jobs
+RESULT_TTL = 60 * 60 # seconds since the job finished
+MAX_RESULT_BYTES = 256 * 1024**2
+JOB_TIMEOUT = 10 * 60 # seconds of running time
+
+# States of a job
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+TIMEOUT = 'timeout'
+FINISHED = [DONE, FAILED, CANCELLED, TIMEOUT]
+
+class JobCancelled(Exception):
+    '''
+    Raised from the progress callback of a job to stop it once it is cancelled or timed out.
+    '''
+
+class JobQueueFull(Exception):
+    '''
+    Raised when a job is submitted while `max_pending` jobs are already queued or running (answered with 429).
+    '''
+
+@dataclass
+class Job:
+    '''
+    Background generation submitted to the JobManager.
+
+    id: ID of the job.
+    state: queued, running, done, failed, cancelled or timeout.
+    done: Steps done (eg. crosstab questions).
+    total: Total steps, 0 until the job reports its progress.
+    timeout: Seconds the job may run before it is stopped, no limit when None.
+    result: Return value of the job once it is done.
+    size: Bytes of the result, counted against the max_result_bytes of the manager.
+    error: Error message once it failed.
+    '''
+    id: str
+    state: str = QUEUED
+    done: int = 0
+    total: int = 0
+    timeout: float = None
+    result: Any = None
+    size: int = 0
+    error: str = None
+    created: float = field(default_factory=time.monotonic)
+    started: float = None
+    finished: float = None
+    future: Future = None
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+
+    def status(self)->dict:
+        '''
+        Summary of the job to report to the client.
+
+        Args:
+            - None
+
+        Return:
+            - dictionary of the job id, state, progress and error.
+        '''
+        return {
+            "job_id": self.id,
+            "state": self.state,
+            "done": self.done,
+            "total": self.total,
+            "error": self.error
+        }
+
+class JobManager:
+    '''
+    In-process queue of background jobs, run by a bounded pool of threads.
+    A job is a function that takes a progress callback `progress(done, total)`; the callback
+    records the progress and raises JobCancelled once the job is cancelled or runs past its timeout.
+    At most `max_pending` jobs are queued or running, further jobs are rejected with JobQueueFull.
+    Finished jobs are kept to be polled and fetched for `result_ttl` seconds, and the oldest are dropped
+    beyond `max_jobs` jobs or `max_result_bytes` of results.
+
+    Args:
+        - max_workers: Number of jobs running at the same time [int]
+        - max_pending: Number of jobs queued or running [int]
+        - max_jobs: Number of finished jobs kept [int]
+        - result_ttl: Seconds a finished job is kept [float]
+        - max_result_bytes: Maximum size of the results of the finished jobs kept [int]
+    '''
+    def __init__(
+            self,
+            max_workers:int=MAX_WORKERS,
+            max_pending:int=MAX_PENDING,
+            max_jobs:int=MAX_JOBS,
+            result_ttl:float=RESULT_TTL,
+            max_result_bytes:int=MAX_RESULT_BYTES
+            ):
+        self.max_pending = max_pending
+        self.max_jobs = max_jobs
+        self.result_ttl = result_ttl
+        self.max_result_bytes = max_result_bytes
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='crosstab-job')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls)->'JobManager':
+        '''
+        Build the job manager from the CROSSTAB_JOB* environment variables.
+
+        Args:
+            - None
+
+        Return:
+            - jobs: JobManager configured for the deployment.
+        '''
+        return cls(
+            max_workers=int(os.environ.get(JOB_WORKERS, MAX_WORKERS)),
+            max_pending=int(os.environ.get(JOB_QUEUE, MAX_PENDING)),
+            result_ttl=float(os.environ.get(JOB_RESULT_TTL, RESULT_TTL)),
+            max_result_bytes=int(os.environ.get(JOB_RESULT_BYTES, MAX_RESULT_BYTES))
+        )
+
+    def submit(self, fn:Callable[[Callable[[int, int], None]], Any], timeout:float=JOB_TIMEOUT)->Job:
+        '''
+        Queue a job.
+
+        Args:
+            - fn: Job function, called with the progress callback [callable]
+            - timeout: Seconds the job may run before it is stopped, no limit when None [float]
+
+        Return:
+            - job: Queued job [Job]
+
+        Raise:
+            - JobQueueFull: max_pending jobs are already queued or running.
+        '''
+        job = Job(id=uuid.uuid4().hex, timeout=timeout)
+        with self._lock:
+            self._evict()
+            pending = sum(other.state not in FINISHED for other in self._jobs.values())
+            if pending >= self.max_pending:
+                raise JobQueueFull(f"{pending} jobs are already queued or running")
+            self._jobs[job.id] = job
+        job.future = self._executor.submit(self._run, job, fn)
+        return job
+
+    def get(self, job_id:str)->Job:
+        '''
+        Get a job by its ID.
+
+        Args:
+            - job_id: ID of the job [str]
+
+        Return:
+            - job: Job [Job]
+
+        Raise:
+            - KeyError: The job is unknown or has been evicted.
+        '''
+        with self._lock:
+            self._evict()
+            return self._jobs[job_id]
+
+    def cancel(self, job_id:str)->Job:
+        '''
+        Cancel a job; a queued job never starts and a running job stops at its next progress report.
+
+        Args:
+            - job_id: ID of the job [str]
+
+        Return:
+            - job: Cancelled job, or the job as is when it already finished [Job]
+        '''
+        job = self.get(job_id)
+        job.cancel_event.set()
+        if job.future.cancel():
+            self._finish(job, CANCELLED)
+        return job
+
+    def shutdown(self):
+        '''
+        Cancel the queued jobs and wait for the running ones.
+
+        Args:
+            - None
+
+        Return:
+            - None
+        '''
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _run(self, job:Job, fn:Callable)->None:
+        if job.cancel_event.is_set():
+            self._finish(job, CANCELLED)
+            return
+        job.state = RUNNING
+        job.started = time.monotonic()
+
+        def progress(done:int, total:int):
+            job.done, job.total = done, total
+            if job.cancel_event.is_set():
+                raise JobCancelled(f"Job {job.id} is cancelled")
+            if job.timeout is not None and time.monotonic() - job.started > job.timeout:
+                raise JobCancelled(f"Job {job.id} ran longer than {job.timeout} seconds")
+
+        try:
+            job.result = fn(progress)
+        except JobCancelled as error:
+            self._finish(job, CANCELLED if job.cancel_event.is_set() else TIMEOUT, str(error))
+        except Exception as error:
+            self._finish(job, FAILED, f"{type(error).__name__}: {error}")
+        else:
+            self._finish(job, DONE)
+
+    def _finish(self, job:Job, state:str, error:str=None):
+        with self._lock:
+            if job.state in FINISHED:
+                return
+            job.state = state
+            job.error = error
+            job.size = result_size(job.result)
+            job.finished = time.monotonic()
+            self._evict()
+
+    def _evict(self):
+        # Drop the expired finished jobs, then the oldest beyond max_jobs or max_result_bytes; queued and running jobs are always kept
+        now = time.monotonic()
+        finished = sorted((job for job in self._jobs.values() if job.state in FINISHED), key=lambda job: job.finished)
+        size = sum(job.size for job in finished)
+        for count, job in enumerate(finished):
+            if now - job.finished <= self.result_ttl and len(finished) - count <= self.max_jobs and size <= self.max_result_bytes:
+                break
+            size -= job.size
+            del self._jobs[job.id]
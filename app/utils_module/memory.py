@@ -0,0 +1,287 @@
+import os
+from io import BytesIO
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Callable
+from app.utils_module.utils import PARQUET_MAGIC, ARROW_FILE_MAGIC, ARROW_STREAM_MAGIC
+from app.utils_module.timing import metrics
+from app.utils_module.executor import Admission
+
+# Environment variables of the memory budget, with their defaults
+MEMORY_BUDGET = 'CROSSTAB_MEMORY_BUDGET' # bytes, no budget when 0
+MEMORY_QUEUE_TIMEOUT = 'CROSSTAB_MEMORY_QUEUE_TIMEOUT' # 30 seconds
+MEMORY_TRACE = 'CROSSTAB_MEMORY_TRACE' # measure the actual peak with tracemalloc when 1, slows the requests down
+
+# Peak memory per cell of the survey, measured with tracemalloc on synthetic surveys (rounded up)
+READ_BYTES_PER_CELL = 160 # /read; parsing, the JSON response and the cubes of the survey
+JSON_BYTES_FACTOR = 16 # parsing a survey sent as JSON, per byte of JSON
+COLUMNAR_BYTES_PER_CELL = 80 # parsing a Parquet or Arrow IPC survey
+GENERATION_BYTES_PER_CELL = 64 # write_table; factorized columns, counts and tables, per cell of q_ls and demos
+SHEET_BYTES_PER_CELL = 200 # raw data sheet held by an in memory workbook, per cell written
+EXPORT_BYTES_PER_CELL = 40 # separate csv or parquet file of the raw data
+
+# Surveys of unknown shape (eg. xlsx) are assumed to hold a cell per this many bytes of file
+FILE_BYTES_PER_CELL = 2
+
+# Modes of a crosstab generation under the budget
+NORMAL = 'normal'
+CONSTANT_MEMORY = 'constant_memory'
+
+# Seconds between two checks of the progress callback of a job while it waits for memory
+WAIT_INTERVAL = 0.1
+
+class MemoryBudgetExceeded(Exception):
+    '''
+    Raised when a request does not fit in the memory budget (413), or no memory frees up within the queue timeout (503).
+
+    Args:
+        - message: Explanation for the client [str]
+        - status_code: HTTP status of the response [int]
+    '''
+    def __init__(self, message:str, status_code:int=413):
+        super().__init__(message)
+        self.status_code = status_code
+
+def estimate_crosstabs(
+        rows:int,
+        columns:int,
+        q_ls:list[str],
+        demos:list[str],
+        data_sheet:str='full',
+        constant_memory:bool=False,
+        preview_rows:int=1000
+        )->int:
+    '''
+    Estimate the peak memory of generating crosstabs, on top of the survey itself.
+
+    Args:
+        - rows, columns: Shape of the survey [int]
+        - q_ls: Question columns of the crosstabs [list]
+        - demos: Demographic columns of the crosstabs [list]
+        - data_sheet: 'full', 'preview', 'none', 'csv' or 'parquet' [str]
+        - constant_memory: The workbook flushes its rows to disk as they are written [bool]
+        - preview_rows: Rows of the preview data sheet [int]
+
+    Return:
+        - estimate: Peak memory in bytes [int]
+    '''
+    estimate = rows * (len(q_ls) + len(demos) + 1) * GENERATION_BYTES_PER_CELL
+    if data_sheet in ['full', 'preview'] and not constant_memory:
+        sheet_rows = rows if data_sheet == 'full' else min(rows, preview_rows)
+        estimate += sheet_rows * columns * SHEET_BYTES_PER_CELL
+    elif data_sheet in ['csv', 'parquet']:
+        estimate += rows * columns * EXPORT_BYTES_PER_CELL
+    return estimate
+
+def survey_cells(source:Any)->int:
+    '''
+    Count the cells of a survey file without parsing it: from the metadata of Parquet and Arrow IPC files,
+    the lines and header of csv files, and the size of the other files.
+
+    Args:
+        - source: Filepath or content of the survey [str or bytes]
+
+    Return:
+        - cells: Rows times columns [int]
+    '''
+    import pyarrow as pa
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        size, f = len(source), BytesIO(source)
+        buffer = lambda: pa.BufferReader(source)
+    else:
+        size, f = os.path.getsize(source), open(source, 'rb')
+        buffer = lambda: pa.memory_map(source)
+    with f:
+        head = f.read(len(ARROW_FILE_MAGIC))
+        try:
+            if head.startswith(PARQUET_MAGIC):
+                import pyarrow.parquet as pq
+                metadata = pq.ParquetFile(buffer()).metadata
+                return metadata.num_rows * metadata.num_columns
+            # Arrow IPC batches are read without copying the data
+            if head == ARROW_FILE_MAGIC:
+                reader = pa.ipc.open_file(buffer())
+                rows = sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+                return rows * len(reader.schema)
+            if head.startswith(ARROW_STREAM_MAGIC):
+                reader = pa.ipc.open_stream(buffer())
+                return sum(batch.num_rows for batch in reader) * len(reader.schema)
+        except (pa.ArrowException, OSError):
+            pass
+        if head.startswith(b'PK') or b'\x00' in head or head.startswith((PARQUET_MAGIC, ARROW_STREAM_MAGIC)):
+            # xlsx, or a corrupted columnar file
+            return size // FILE_BYTES_PER_CELL
+        f.seek(0)
+        columns = f.readline().count(b',') + 1
+        rows = 1 + sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1024**2), b''))
+    return rows * columns
+
+class MemoryBudget:
+    '''
+    Admission control of the requests by their estimated peak memory, so concurrent large surveys do not
+    run the server out of memory. Requests reserve their estimate while they run; a request that does not fit
+    next to the running ones queues in arrival order for up to `queue_timeout` seconds, then MemoryBudgetExceeded (503)
+    is raised. A request larger than the whole budget is rejected right away (413), or routed to the
+    constant memory workbook when that fits (see plan). Every request fits when the budget is 0.
+
+    Args:
+        - budget: Memory the requests may use at the same time, in bytes [int]
+        - queue_timeout: Seconds a request waits for memory before it is rejected [float]
+    '''
+    def __init__(self, budget:int=0, queue_timeout:float=30):
+        self.budget = budget
+        self.queue_timeout = queue_timeout
+        self._admission = Admission(budget or None)
+
+    @classmethod
+    def from_env(cls)->'MemoryBudget':
+        '''
+        Build the budget from the CROSSTAB_MEMORY* environment variables.
+
+        Args:
+            - None
+
+        Return:
+            - budget: MemoryBudget configured for the deployment.
+        '''
+        return cls(
+            budget=int(os.environ.get(MEMORY_BUDGET, 0)),
+            queue_timeout=float(os.environ.get(MEMORY_QUEUE_TIMEOUT, 30))
+        )
+
+    @property
+    def reserved(self)->int:
+        # Memory reserved by the running requests, in bytes
+        return self._admission.used
+
+    def check(self, estimate:int, what:str='request'):
+        '''
+        Reject a request that would not fit in the budget even on its own.
+
+        Args:
+            - estimate: Peak memory of the request in bytes [int]
+            - what: Name of the request for the error message [str]
+
+        Return:
+            - None
+
+        Raise:
+            - MemoryBudgetExceeded: The estimate is larger than the budget (413).
+        '''
+        if self.budget and estimate > self.budget:
+            metrics.add('crosstab_memory_requests_total', {'mode': 'rejected'}, 1)
+            raise MemoryBudgetExceeded(
+                f"The {what} needs about {estimate / 1024**2:.0f} MB, over the memory budget of "
+                f"{self.budget / 1024**2:.0f} MB of the server, send a smaller survey"
+            )
+
+    def plan(self, rows:int, columns:int, q_ls:list[str], demos:list[str], data_sheet:str='full')->tuple[str, int]:
+        '''
+        Choose how to generate crosstabs under the budget: with an in memory workbook when it fits,
+        else with a constant memory workbook that flushes its rows to disk.
+
+        Args:
+            - rows, columns: Shape of the survey [int]
+            - q_ls: Question columns of the crosstabs [list]
+            - demos: Demographic columns of the crosstabs [list]
+            - data_sheet: 'full', 'preview', 'none', 'csv' or 'parquet' [str]
+
+        Return:
+            - mode: NORMAL or CONSTANT_MEMORY [str]
+            - estimate: Peak memory of the generation in that mode, in bytes [int]
+
+        Raise:
+            - MemoryBudgetExceeded: The generation does not fit even with a constant memory workbook (413).
+        '''
+        estimate = estimate_crosstabs(rows, columns, q_ls, demos, data_sheet)
+        mode = NORMAL
+        if self.budget and estimate > self.budget:
+            mode = CONSTANT_MEMORY
+            estimate = estimate_crosstabs(rows, columns, q_ls, demos, data_sheet, constant_memory=True)
+        self.check(estimate, what='crosstabs')
+        metrics.add('crosstab_memory_requests_total', {'mode': mode}, 1)
+        return mode, estimate
+
+    @asynccontextmanager
+    async def reserve(self, estimate:int, what:str='request'):
+        '''
+        Reserve memory for the request while it runs, once the running requests leave enough of the budget.
+
+        Args:
+            - estimate: Peak memory of the request in bytes [int]
+            - what: Name of the request for the error message [str]
+
+        Raise:
+            - MemoryBudgetExceeded: Too large for the budget (413), or no memory freed up within the queue timeout (503).
+        '''
+        self.check(estimate, what=what)
+        if not await self._admission.acquire(estimate, self.queue_timeout):
+            raise MemoryBudgetExceeded(
+                f"Server is busy, {self.reserved / 1024**2:.0f} MB of the memory budget is in use", status_code=503
+            )
+        try:
+            yield
+        finally:
+            self._admission.release(estimate)
+
+    @contextmanager
+    def hold(self, estimate:int, waiting:Callable[[], None]=None, what:str='job'):
+        '''
+        Reserve memory for a background job, waiting as long as it takes for the running requests to free it up.
+
+        Args:
+            - estimate: Peak memory of the job in bytes [int]
+            - waiting: Called while the job waits, may raise to stop waiting (eg. the progress callback of a job) [callable]
+            - what: Name of the job for the error message [str]
+
+        Raise:
+            - MemoryBudgetExceeded: The estimate is larger than the budget (413).
+        '''
+        self.check(estimate, what=what)
+        self._admission.wait(estimate, waiting=waiting, interval=WAIT_INTERVAL)
+        try:
+            yield
+        finally:
+            self._admission.release(estimate)
+
+def tracing()->bool:
+    '''
+    Whether the actual peak memory of the requests is measured (CROSSTAB_MEMORY_TRACE=1).
+    '''
+    return os.environ.get(MEMORY_TRACE, '0') not in ['', '0', 'false', 'False']
+
+def traced(fn:Callable, *args, **kwargs)->tuple[Any, int]:
+    '''
+    Run a function and measure its peak memory with tracemalloc, in the process of the executor.
+    The peak is only exact when no other request runs at the same time: their allocations are counted too,
+    and their start resets the peak of the process, so overlapping requests may read too high or too low.
+
+    Args:
+        - fn: Function to run [callable]
+        - args, kwargs: Arguments of the function
+
+    Return:
+        - result: Return value of the function.
+        - peak: Peak memory allocated while it ran, in bytes [int]
+    '''
+    import tracemalloc
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    begin = tracemalloc.get_traced_memory()[0]
+    result = fn(*args, **kwargs)
+    return result, max(0, tracemalloc.get_traced_memory()[1] - begin)
+
+def record_peak(estimate:int, peak:int):
+    '''
+    Add an estimate and the measured peak to the metrics, to check the estimates against.
+
+    Args:
+        - estimate: Estimated peak memory in bytes [int]
+        - peak: Measured peak memory in bytes [int]
+
+    Return:
+        - None
+    '''
+    metrics.add('crosstab_memory_estimate_bytes_total', {}, estimate)
+    metrics.add('crosstab_memory_peak_bytes_total', {}, peak)
+    metrics.add('crosstab_memory_traced_total', {}, 1)
@@ -1,8 +1,12 @@
 from app.crosstab_module.crosstab import single_choice_crosstab_column, single_choice_crosstab_row
 from app.crosstab_module.crosstab import multi_choice_crosstab_column, multi_choice_crosstab_row
+from app.crosstab_module.context import CrosstabContext, CrosstabCounts
+from app.utils_module.writer import TableWriter
+from app.chart_module.chart import generate_bar_chart
+from app.utils_module.timing import stage
 import pandas as pd
 
-def get_column(df:pd.DataFrame, q:str, multi:list[str], name_sort:list[str], demo:str, weight:str, col_seqs:list[list[str]], writer:pd.ExcelWriter, start:int)->tuple[int,pd.ExcelWriter,pd.ExcelWriter]:
+def get_column(df:pd.DataFrame, q:str, multi:list[str], name_sort:list[str], demo:str, weight:str, col_seqs:list[list[str]], writer:TableWriter, start:int, context:CrosstabContext=None, counts:CrosstabCounts=None, charts:bool=False)->tuple[int,pd.ExcelWriter,pd.ExcelWriter]:
     '''
     Generate the crosstab tables per column values using the multi_choice_crosstab_column function and single_choice_crosstab_column.
 
@@ -16,25 +20,32 @@ def get_column(df:pd.DataFrame, q:str, multi:list[str], name_sort:list[str], dem
         - col_seqs: Order of demographic sequence [list]
         - writer: Engine to write the Excel sheet
         - start: Number to loop [int]
+        - context: Factorized survey shared across tables [CrosstabContext]
+        - counts: Precomputed weighted counts of q across demo [CrosstabCounts]
+        - charts: Draw the clustered bar chart of the table next to it [bool]
 
     Return:
         - start: loop updated counter [int]
         - workbook: Excel workbook.
         - worksheet: Excel worksheet.
     '''
-    if q in multi:
-        table = multi_choice_crosstab_column(df=df, q=q, column=demo, value=weight, column_seq=col_seqs[demo])
-    else:
-        table = single_choice_crosstab_column(df=df, q=q, sorting=name_sort, column=demo, value=weight, column_seq=col_seqs[demo])
+    with stage('write_table.crosstab', tables=1):
+        if q in multi:
+            table = multi_choice_crosstab_column(df=df, q=q, column=demo, value=weight, column_seq=col_seqs[demo], context=context, counts=counts)
+        else:
+            table = single_choice_crosstab_column(df=df, q=q, sorting=name_sort, column=demo, value=weight, column_seq=col_seqs[demo], context=context, counts=counts)
 
-    table.to_excel(writer, index=False, sheet_name=f"{demo}(col)", startrow=start)
+    with stage('write_table.write', rows=len(table)):
+        worksheet = writer.write(table, sheet_name=f"{demo}(col)", startrow=start)
+    if charts:
+        with stage('write_table.chart', charts=1):
+            generate_bar_chart(table, (start, 0), writer.book, worksheet)
     start = start + len(table) + 3
     workbook = writer.book
-    worksheet = writer.sheets[f"{demo}(col)"]
     
     return start, workbook, worksheet
 
-def get_row(df:pd.DataFrame, q:str, multi:list[str], name_sort:list[str], demo:str, weight:str, col_seqs:list[list[str]], writer:pd.ExcelWriter, start_2:int)->tuple[int,pd.ExcelWriter,pd.ExcelWriter]:
+def get_row(df:pd.DataFrame, q:str, multi:list[str], name_sort:list[str], demo:str, weight:str, col_seqs:list[list[str]], writer:TableWriter, start_2:int, context:CrosstabContext=None, counts:CrosstabCounts=None, charts:bool=False)->tuple[int,pd.ExcelWriter,pd.ExcelWriter]:
     '''
     Generate the crosstab tables per row values using the multi_choice_crosstab_row function and single_choice_crosstab_row.
 
@@ -48,20 +59,27 @@ def get_row(df:pd.DataFrame, q:str, multi:list[str], name_sort:list[str], demo:s
         - col_seqs: Order of demographic sequence [list]
         - writer: Engine to write the Excel sheet
         - start: Number to loop [int]
+        - context: Factorized survey shared across tables [CrosstabContext]
+        - counts: Precomputed weighted counts of q across demo [CrosstabCounts]
+        - charts: Draw the clustered bar chart of the table next to it [bool]
 
     Return:
         - start_2: loop updated counter [int]
         - workbook: Excel workbook.
         - worksheet: Excel worksheet.
     '''
-    if q in multi:
-        table_2 = multi_choice_crosstab_row(df=df, q=q, column=demo, value=weight, column_seq=col_seqs[demo])
-    else:
-        table_2 = single_choice_crosstab_row(df=df, q=q, sorting=name_sort, column=demo, value=weight, column_seq=col_seqs[demo])
+    with stage('write_table.crosstab', tables=1):
+        if q in multi:
+            table_2 = multi_choice_crosstab_row(df=df, q=q, column=demo, value=weight, column_seq=col_seqs[demo], context=context, counts=counts)
+        else:
+            table_2 = single_choice_crosstab_row(df=df, q=q, sorting=name_sort, column=demo, value=weight, column_seq=col_seqs[demo], context=context, counts=counts)
 
-    table_2.to_excel(writer, index=False, sheet_name=f"{demo}(row)", startrow=start_2)
+    with stage('write_table.write', rows=len(table_2)):
+        worksheet = writer.write(table_2, sheet_name=f"{demo}(row)", startrow=start_2)
+    if charts:
+        with stage('write_table.chart', charts=1):
+            generate_bar_chart(table_2, (start_2, 0), writer.book, worksheet)
     start_2 = start_2 + len(table_2) + 3
     workbook = writer.book
-    worksheet = writer.sheets[f"{demo}(row)"]
 
     return start_2, workbook, worksheet
\ No newline at end of file
@@ -0,0 +1,154 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any
+import pandas as pd
+from app.utils_module.cache import dataset_fingerprint
+
+# Default bounds of the dataset store
+MAX_DATASETS = 32
+DATASET_TTL = 60 * 60 # seconds since last use
+MAX_BYTES = 2 * 1024**3
+
+class DatasetStore:
+    '''
+    Server-side store of the parsed surveys, so a session uploads and parses its dataset once
+    and refers to it by `dataset_id` afterwards.
+    Datasets are evicted in least recently used order, once they are not used for `ttl` seconds,
+    or once the store holds more than `max_datasets` datasets or `max_bytes` of dataframes.
+
+    Args:
+        - max_datasets: Maximum number of datasets kept [int]
+        - ttl: Seconds a dataset is kept since its last use [float]
+        - max_bytes: Maximum memory of all the datasets kept, in bytes [int]
+    '''
+    def __init__(self, max_datasets:int=MAX_DATASETS, ttl:float=DATASET_TTL, max_bytes:int=MAX_BYTES):
+        self.max_datasets = max_datasets
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._datasets = OrderedDict() # dataset_id: (dataframe, size, last use)
+        self._fingerprints = {}
+        self._cubes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self)->int:
+        with self._lock:
+            self._expire(time.monotonic())
+            return len(self._datasets)
+
+    def put(self, df:pd.DataFrame, fingerprint:str=None, cubes:dict=None)->str:
+        '''
+        Register a dataset in the store.
+
+        Args:
+            - df: Whole dataframe [pandas dataframe]
+            - fingerprint: Hash of the content of the dataset, eg. of its uploaded file [str]
+            - cubes: Weight column name and the CrosstabCube of the dataset [dict]
+
+        Return:
+            - dataset_id: Key to get the dataset back [str]
+        '''
+        dataset_id = uuid.uuid4().hex
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        size += sum(cube.nbytes for cube in (cubes or {}).values())
+        with self._lock:
+            now = time.monotonic()
+            self._datasets[dataset_id] = (df, size, now)
+            self._bytes += size
+            if fingerprint is not None:
+                self._fingerprints[dataset_id] = fingerprint
+            if cubes:
+                self._cubes[dataset_id] = cubes
+            self._expire(now)
+            # The newest dataset is kept even if it is bigger than max_bytes on its own
+            while len(self._datasets) > 1 and (len(self._datasets) > self.max_datasets or self._bytes > self.max_bytes):
+                self._pop(next(iter(self._datasets)))
+        return dataset_id
+
+    def get(self, dataset_id:str)->pd.DataFrame:
+        '''
+        Get a dataset from the store and mark it as recently used.
+        The dataframe is shared between requests, so it must not be modified.
+
+        Args:
+            - dataset_id: Key returned by `put` [str]
+
+        Return:
+            - df: Whole dataframe [pandas dataframe]
+
+        Raise:
+            - KeyError: The dataset is unknown or has been evicted.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            df, size, _ = self._datasets.pop(dataset_id)
+            self._datasets[dataset_id] = (df, size, now)
+        return df
+
+    def fingerprint(self, dataset_id:str)->str:
+        '''
+        Hash of the content of a dataset, computed from the dataframe on first use when it was not given.
+
+        Args:
+            - dataset_id: Key returned by `put` [str]
+
+        Return:
+            - fingerprint: Hash of the content of the dataset [str]
+
+        Raise:
+            - KeyError: The dataset is unknown or has been evicted.
+        '''
+        df = self.get(dataset_id)
+        with self._lock:
+            fingerprint = self._fingerprints.get(dataset_id)
+        if fingerprint is None:
+            fingerprint = dataset_fingerprint(df)
+            with self._lock:
+                if dataset_id in self._datasets:
+                    self._fingerprints[dataset_id] = fingerprint
+        return fingerprint
+
+    def cube(self, dataset_id:str, weight:str)->Any:
+        '''
+        Materialized weighted counts of a dataset for a weight column, if they were built.
+
+        Args:
+            - dataset_id: Key returned by `put` [str]
+            - weight: Column name of the weights [str]
+
+        Return:
+            - cube: CrosstabCube, None when there is none for the weight.
+        '''
+        with self._lock:
+            return self._cubes.get(dataset_id, {}).get(weight)
+
+    def delete(self, dataset_id:str):
+        '''
+        Remove a dataset from the store, if it is still there.
+
+        Args:
+            - dataset_id: Key returned by `put` [str]
+
+        Return:
+            - None
+        '''
+        with self._lock:
+            if dataset_id in self._datasets:
+                self._pop(dataset_id)
+
+    def _pop(self, dataset_id:str):
+        _, size, _ = self._datasets.pop(dataset_id)
+        self._fingerprints.pop(dataset_id, None)
+        self._cubes.pop(dataset_id, None)
+        self._bytes -= size
+
+    def _expire(self, now:float):
+        # Datasets are ordered by last use, so the expired ones are at the front
+        while self._datasets:
+            dataset_id, (_, _, last_use) = next(iter(self._datasets.items()))
+            if now - last_use <= self.ttl:
+                break
+            self._pop(dataset_id)
@@ -0,0 +1,300 @@
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Callable
+
+# Environment variable to turn the timing on ('1'), off by default
+TIMING = 'CROSSTAB_TIMING'
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_enabled = os.environ.get(TIMING, '0') not in ['', '0', 'false', 'False']
+
+# Stages recorded by the current request, None outside of a timed request
+_records = ContextVar('crosstab_timing_records', default=None)
+
+def enabled()->bool:
+    '''
+    Whether the stages are timed.
+    '''
+    return _enabled
+
+def set_enabled(flag:bool):
+    '''
+    Turn the timing on or off, in place of the CROSSTAB_TIMING environment variable.
+
+    Args:
+        - flag: Time the stages [bool]
+
+    Return:
+        - None
+    '''
+    global _enabled
+    _enabled = bool(flag)
+
+class _Counts(dict):
+    # Counts of a stage when the timing is off, everything written to it is dropped
+    def __setitem__(self, key, value):
+        pass
+
+    def update(self, *args, **kwargs):
+        pass
+
+class _Off:
+    # Stage when the timing is off; one shared object, so an untimed stage costs two method calls
+    counts = _Counts()
+
+    def __enter__(self)->dict:
+        return self.counts
+
+    def __exit__(self, *exc)->bool:
+        return False
+
+_OFF = _Off()
+
+class _Stage:
+    def __init__(self, name:str, counts:dict):
+        self.name = name
+        self.counts = counts
+
+    def __enter__(self)->dict:
+        self.begin = time.perf_counter()
+        return self.counts
+
+    def __exit__(self, *exc)->bool:
+        record(self.name, time.perf_counter() - self.begin, self.counts)
+        return False
+
+def stage(name:str, **counts)->Any:
+    '''
+    Context manager timing a stage of the hot path, eg. `with stage('write_table.save'): writer.close()`.
+    It gives a dictionary to count what the stage went through (eg. rows, tables).
+    Nothing is recorded when the timing is off.
+
+    Args:
+        - name: Name of the stage, dotted by the function it is part of [str]
+        - counts: Initial counts of the stage, eg. tables=1 [int]
+
+    Return:
+        - context manager giving the counts of the stage [dict]
+    '''
+    if not _enabled:
+        return _OFF
+    return _Stage(name, counts)
+
+def record(name:str, seconds:float, counts:dict=None):
+    '''
+    Record the duration of a stage into the metrics, and into the stages of the current request.
+
+    Args:
+        - name: Name of the stage [str]
+        - seconds: Duration of the stage [float]
+        - counts: What the stage went through, eg. {'rows': 1000} [dict]
+
+    Return:
+        - None
+    '''
+    counts = counts or {}
+    metrics.observe('crosstab_stage_seconds', {'stage': name}, seconds)
+    for item, value in counts.items():
+        metrics.add('crosstab_stage_items_total', {'stage': name, 'item': item}, value)
+    records = _records.get()
+    if records is not None:
+        records.append((name, seconds, counts))
+
+def start()->list:
+    '''
+    Collect the stages of the current request (or job) from now on, including the ones run in the executor.
+
+    Args:
+        - None
+
+    Return:
+        - records: list filled with the (name, seconds, counts) of the stages [list]
+    '''
+    records = []
+    _records.set(records)
+    return records
+
+def collected(fn:Callable, *args, **kwargs)->tuple[Any, list]:
+    '''
+    Run a function and collect its stages, to bring them back from a process of the executor.
+    The timing is turned on in the process, which may have started before it was turned on in the server.
+
+    Args:
+        - fn: Function to run [callable]
+        - args, kwargs: Arguments of the function
+
+    Return:
+        - result: Return value of the function.
+        - records: (name, seconds, counts) of its stages [list]
+    '''
+    set_enabled(True)
+    records = start()
+    return fn(*args, **kwargs), records
+
+def replay(records:list):
+    '''
+    Record the stages collected in another process.
+
+    Args:
+        - records: (name, seconds, counts) of the stages, from collected [list]
+
+    Return:
+        - None
+    '''
+    for name, seconds, counts in records:
+        record(name, seconds, counts)
+
+def server_timing(records:list, total:float=None)->str:
+    '''
+    Server-Timing header of the stages of a request; the stages run several times (eg. per table) are summed up.
+
+    Args:
+        - records: (name, seconds, counts) of the stages [list]
+        - total: Duration of the whole request in seconds [float]
+
+    Return:
+        - header: eg. 'write_table.save;dur=12.3, total;dur=40.1' [str]
+    '''
+    stages = {}
+    for name, seconds, counts in records:
+        duration, summed = stages.setdefault(name, [0.0, {}])
+        stages[name][0] = duration + seconds
+        for item, value in counts.items():
+            summed[item] = summed.get(item, 0) + value
+    entries = []
+    for name, (seconds, counts) in stages.items():
+        entry = f"{name};dur={seconds * 1000:.1f}"
+        if counts:
+            entry += ';desc="' + ' '.join(f"{item}={value}" for item, value in counts.items()) + '"'
+        entries.append(entry)
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.1f}")
+    return ', '.join(entries)
+
+class ServerTimingMiddleware:
+    '''
+    ASGI middleware of the timed requests: adds the Server-Timing header of their stages, and records their
+    duration into crosstab_http_request_seconds by method, route and status.
+    Requests go straight to the app while the timing is off.
+
+    Args:
+        - app: ASGI application [callable]
+    '''
+    def __init__(self, app:Callable):
+        self.app = app
+
+    async def __call__(self, scope:dict, receive:Callable, send:Callable):
+        if scope['type'] != 'http' or not _enabled:
+            return await self.app(scope, receive, send)
+        records = start()
+        begin = time.perf_counter()
+
+        async def send_timed(message:dict):
+            if message['type'] == 'http.response.start':
+                total = time.perf_counter() - begin
+                # The route is set in the scope by the router
+                route = scope.get('route')
+                labels = {'method': scope['method'], 'route': getattr(route, 'path', 'unmatched'), 'status': message['status']}
+                metrics.observe('crosstab_http_request_seconds', labels, total)
+                header = (b'server-timing', server_timing(records, total).encode('latin-1'))
+                message = {**message, 'headers': [*message.get('headers', []), header]}
+            await send(message)
+
+        await self.app(scope, receive, send_timed)
+
+class Metrics:
+    '''
+    Histograms of durations and counters, by metric name and labels, in the Prometheus text format.
+
+    Args:
+        - buckets: Upper bounds of the histogram buckets in seconds [tuple]
+    '''
+    def __init__(self, buckets:tuple=BUCKETS):
+        self.buckets = buckets
+        self._histograms = {} # (name, labels): [count per bucket..., sum, count]
+        self._counters = {} # (name, labels): value
+        self._lock = threading.Lock()
+
+    def observe(self, name:str, labels:dict, seconds:float):
+        '''
+        Add a duration to a histogram.
+
+        Args:
+            - name: Name of the metric [str]
+            - labels: Labels of the series [dict]
+            - seconds: Duration to add [float]
+
+        Return:
+            - None
+        '''
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def add(self, name:str, labels:dict, value:float):
+        '''
+        Add a value to a counter.
+
+        Args:
+            - name: Name of the metric [str]
+            - labels: Labels of the series [dict]
+            - value: Value to add [float]
+
+        Return:
+            - None
+        '''
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self)->str:
+        '''
+        Metrics in the Prometheus text exposition format.
+
+        Args:
+            - None
+
+        Return:
+            - text: Every series, grouped by metric [str]
+        '''
+        def labels(pairs:tuple, **extra)->str:
+            pairs = list(pairs) + list(extra.items())
+            return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+        with self._lock:
+            histograms = {key: list(series) for key, series in self._histograms.items()}
+            counters = dict(self._counters)
+        lines = []
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, pairs), series in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{name}_bucket{labels(pairs, le=bound)} {count}")
+                lines.append(f"{name}_bucket{labels(pairs, le='+Inf')} {series[-1]}")
+                lines.append(f"{name}_sum{labels(pairs)} {series[-2]}")
+                lines.append(f"{name}_count{labels(pairs)} {series[-1]}")
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (metric, pairs), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{labels(pairs)} {value}")
+        return '\n'.join(lines) + '\n'
+
+def _escape(value:Any)->str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Metrics of this process, served by /metrics
+metrics = Metrics()
@@ -1,5 +1,13 @@
+from io import BytesIO
+from typing import Any
 import pandas as pd
 import re
+from app.utils_module.timing import stage
+
+# Leading bytes of the columnar formats read by read_columnar
+PARQUET_MAGIC = b'PAR1'
+ARROW_FILE_MAGIC = b'ARROW1'
+ARROW_STREAM_MAGIC = b'\xff\xff\xff\xff'
 
 def load(df:pd.DataFrame)->pd.DataFrame:
     '''
@@ -11,15 +19,86 @@ def load(df:pd.DataFrame)->pd.DataFrame:
     Return:
         - df: a pandas dataframe
     '''
-    try:
-        read_df = pd.read_csv(df, na_filter=False)
-    except Exception:
+    with stage('load') as counts:
         try:
-            read_df = pd.read_excel(df, na_filter=False)
+            read_df = read_columnar(df)
         except Exception:
-            read_df = df
+            try:
+                read_df = pd.read_csv(df, na_filter=False)
+            except Exception:
+                try:
+                    read_df = pd.read_excel(df, na_filter=False)
+                except Exception:
+                    read_df = df
+        if isinstance(read_df, pd.DataFrame):
+            counts['rows'] = len(read_df)
     return read_df
 
+def read_columnar(source:Any)->pd.DataFrame:
+    '''
+    A function to read a survey in Arrow IPC (file or stream format) or Parquet into pandas dataframe.
+    The format is detected from the leading bytes, and a buffer is left at its position when it is neither.
+
+    Args:
+        - source: Filepath, buffer or bytes
+
+    Return:
+        - df: a pandas dataframe
+    '''
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        magic = bytes(source[:len(ARROW_FILE_MAGIC)])
+    elif hasattr(source, 'read'):
+        position = source.tell()
+        magic = source.read(len(ARROW_FILE_MAGIC))
+        source.seek(position)
+    else:
+        with open(source, 'rb') as f:
+            magic = f.read(len(ARROW_FILE_MAGIC))
+    if not magic.startswith((PARQUET_MAGIC, ARROW_FILE_MAGIC, ARROW_STREAM_MAGIC)):
+        raise ValueError("Data is neither Arrow IPC nor Parquet")
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data = source
+    elif hasattr(source, 'read'):
+        data = source.read()
+    else:
+        with open(source, 'rb') as f:
+            data = f.read()
+
+    import pyarrow as pa
+    reader = pa.BufferReader(data)
+    if magic.startswith(PARQUET_MAGIC):
+        import pyarrow.parquet as pq
+        table = pq.read_table(reader)
+    elif magic == ARROW_FILE_MAGIC:
+        table = pa.ipc.open_file(reader).read_all()
+    else:
+        table = pa.ipc.open_stream(reader).read_all()
+    # Split blocks let the numeric columns reuse the Arrow buffers instead of being consolidated
+    return table.to_pandas(split_blocks=True)
+
+def export_data(df:pd.DataFrame, fmt:str='csv')->bytes:
+    '''
+    A function to export the raw survey as a compressed file, shipped alongside the crosstabs workbook.
+
+    Args:
+        - df: Whole dataframe [pandas dataframe]
+        - fmt: 'csv' (gzip compressed) or 'parquet' [str]
+
+    Return:
+        - data: exported file in bytes.
+    '''
+    output = BytesIO()
+    if fmt == 'csv':
+        df.to_csv(output, index=False, compression={'method': 'gzip', 'mtime': 0})
+    elif fmt == 'parquet':
+        # Mixed object columns (eg. numbers and blanks) are stored as text
+        text = {column: str for column in df.columns if df[column].dtype == object}
+        df.astype(text).to_parquet(output, index=False)
+    else:
+        raise ValueError(f"fmt should be 'csv' or 'parquet', got '{fmt}'")
+    return output.getvalue()
+
 def demography(df:pd.DataFrame)->list:
     '''
     A function to autoselect the demography columns. 
@@ -0,0 +1,102 @@
+import pandas as pd
+from typing import Any
+
+# Rows converted to python objects at a time when writing a dataframe
+CHUNK_SIZE = 10000
+
+# Names of the raw data sheets of a crosstab workbook, that do not contain crosstab tables
+DATA_SHEET = 'data'
+PREVIEW_SHEET = 'data_preview'
+
+def write_frame(worksheet:Any, df:pd.DataFrame, startrow:int, header_format:Any=None, date_format:Any=None)->int:
+    '''
+    Write a dataframe (without index) into an xlsxwriter worksheet, row by row.
+    Rows are written in increasing order, so it also works on `constant_memory` workbooks.
+
+    Args:
+        - worksheet: Sheet in the Excel workbook [xlsxwriter Worksheet]
+        - df: Table to write [pandas dataframe]
+        - startrow: Row of the header [int]
+        - header_format: Format of the header cells [xlsxwriter Format]
+        - date_format: Format of the datetime cells [xlsxwriter Format]
+
+    Return:
+        - Number of rows written, header included [int]
+    '''
+    worksheet.write_row(startrow, 0, list(df.columns), header_format)
+
+    # Datetime columns are written again over their row with the date format
+    dates = [i for i, dtype in enumerate(df.dtypes) if pd.api.types.is_datetime64_any_dtype(dtype)]
+    row = startrow + 1
+    for begin in range(0, len(df), CHUNK_SIZE):
+        chunk = df.iloc[begin:begin + CHUNK_SIZE]
+        values = chunk.to_numpy(dtype=object)
+        values[chunk.isna().to_numpy()] = None # NaN are written as blank cells
+        values = values.tolist()
+        for record in values:
+            worksheet.write_row(row, 0, record)
+            for i in dates:
+                if record[i] is not None:
+                    worksheet.write_datetime(row, i, record[i].to_pydatetime(), date_format)
+            row += 1
+    return row - startrow
+
+class TableWriter:
+    '''
+    Writer of the crosstab workbook, used in place of pandas ExcelWriter.
+    Tables are written straight into xlsxwriter with shared cached formats,
+    instead of going through the pandas ExcelFormatter for every table.
+
+    Args:
+        - output: Filepath or buffer of the workbook [BytesIO]
+        - constant_memory: Flush every row to disk once it is written, so the memory stays flat [bool]
+    '''
+    def __init__(self, output:Any, constant_memory:bool=False):
+        import xlsxwriter
+        options = {'constant_memory': True} if constant_memory else {'in_memory': True}
+        self.book = xlsxwriter.Workbook(output, {**options, 'nan_inf_to_errors': True})
+        self.sheets = {}
+        self.header_format = self.book.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+        self.date_format = self.book.add_format({'num_format': 'YYYY-MM-DD HH:MM:SS'})
+
+    def sheet(self, sheet_name:str)->Any:
+        '''
+        Get a worksheet by name, adding it to the workbook on first use.
+
+        Args:
+            - sheet_name: Name of the sheet [str]
+
+        Return:
+            - worksheet: Sheet in the Excel workbook [xlsxwriter Worksheet]
+        '''
+        if sheet_name not in self.sheets:
+            self.sheets[sheet_name] = self.book.add_worksheet(sheet_name)
+        return self.sheets[sheet_name]
+
+    def write(self, df:pd.DataFrame, sheet_name:str, startrow:int=0)->Any:
+        '''
+        Write a table into a sheet, like `df.to_excel(writer, index=False, sheet_name=..., startrow=...)`.
+
+        Args:
+            - df: Table to write [pandas dataframe]
+            - sheet_name: Name of the sheet [str]
+            - startrow: Row of the header [int]
+
+        Return:
+            - worksheet: Sheet in the Excel workbook [xlsxwriter Worksheet]
+        '''
+        worksheet = self.sheet(sheet_name)
+        write_frame(worksheet, df, startrow, self.header_format, self.date_format)
+        return worksheet
+
+    def close(self):
+        '''
+        Save the workbook.
+
+        Args:
+            - None
+
+        Return:
+            - None
+        '''
+        self.book.close()
@@ -0,0 +1,116 @@
+'''
+Import time of the entry points of the app, per module, from `python -X importtime`.
+Each entry point is imported in a fresh interpreter, `--repeat` times, keeping the fastest run of every module.
+
+Usage (from the root of the repository):
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py app.endpoint --top 30 --json import_time.json --max-ms 2000
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Entry points of the API and of the Streamlit app
+ENTRY_POINTS = ['app.endpoint', 'component']
+
+def measure(module:str)->dict[str, dict]:
+    '''
+    Import a module in a fresh interpreter and read the import time of every module it loads.
+
+    Args:
+        - module: Dotted name of the module to import [str]
+
+    Return:
+        - timings: dictionary of module name and its self and cumulative import time in milliseconds.
+
+    Raise:
+        - RuntimeError: The module cannot be imported (eg. a missing dependency).
+    '''
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, capture_output=True, text=True
+        )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    timings = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = {'self_ms': int(self_us) / 1000, 'cumulative_ms': int(cumulative_us) / 1000}
+    return timings
+
+def fastest(runs:list[dict[str, dict]])->dict[str, dict]:
+    '''
+    Keep the fastest of several runs for every module, to leave out the noise of the machine.
+
+    Args:
+        - runs: timings of every run, from measure [list]
+
+    Return:
+        - timings: dictionary of module name and its fastest self and cumulative import time.
+    '''
+    timings = {}
+    for run in runs:
+        for name, timing in run.items():
+            if name not in timings:
+                timings[name] = dict(timing)
+            else:
+                for key in ['self_ms', 'cumulative_ms']:
+                    timings[name][key] = min(timings[name][key], timing[key])
+    return timings
+
+def report(module:str, timings:dict[str, dict], top:int):
+    '''
+    Print the total import time of an entry point, its slowest modules and the modules of the app.
+
+    Args:
+        - module: Dotted name of the entry point [str]
+        - timings: Import time of every module, from fastest [dict]
+        - top: Number of slowest modules to print [int]
+
+    Return:
+        - None
+    '''
+    print(f"\n{module}: {timings[module]['cumulative_ms']:.1f} ms")
+    print(f"  {'cumulative':>10}  {'self':>8}  module")
+    slowest = sorted(timings.items(), key=lambda item: -item[1]['cumulative_ms'])
+    own = [item for item in slowest if item[0].split('.')[0] in ['app', 'component']]
+    for name, timing in slowest[:top] + [item for item in own if item not in slowest[:top]]:
+        print(f"  {timing['cumulative_ms']:>10.1f}  {timing['self_ms']:>8.1f}  {name}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', default=ENTRY_POINTS, help='entry points to import')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh imports per entry point')
+    parser.add_argument('--top', type=int, default=15, help='slowest modules to print')
+    parser.add_argument('--json', help='file to write the timings to')
+    parser.add_argument('--max-ms', type=float, help='fail when an entry point takes longer to import')
+    args = parser.parse_args()
+
+    results, failed = {}, False
+    for module in args.modules:
+        try:
+            timings = fastest([measure(module) for _ in range(args.repeat)])
+        except RuntimeError as error:
+            print(f"\n{module}: not imported ({error})")
+            failed = True
+            continue
+        results[module] = {'total_ms': timings[module]['cumulative_ms'], 'modules': timings}
+        report(module, timings, args.top)
+        if args.max_ms is not None and results[module]['total_ms'] > args.max_ms:
+            print(f"  over the budget of {args.max_ms:.0f} ms")
+            failed = True
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+'''
+HTTP load test of the API: concurrent clients run sessions of requests on a synthetic survey,
+and the throughput, latency percentiles and error rate are reported per endpoint.
+
+Scenarios (weighted with --scenario):
+    ui: a UI session; /read, /demography, /demo_sorter per demo, /crosstabs of the dataset_id,
+        /read_crosstabs of the crosstabs, /chart of their tables, then DELETE /read/{dataset_id}.
+    batch: a batch client; /crosstabs/upload of the survey in Parquet with its parameters.
+    chart: the chart generator; /read_crosstabs of a crosstabs file and /chart of its tables.
+
+Usage (from the root of the repository):
+    # One worker process: the datasets of /read and the jobs live in the process that served them,
+    # so with several workers the follow-up requests of a session get 404 (unless routing is sticky)
+    uvicorn app.endpoint:app --port 8000
+    python -m benchmarks.loadtest --url http://127.0.0.1:8000 --clients 16 --duration 60 --scenario ui=3,batch=1 --json load.json
+
+    # Without a server, in this process (no parallelism, to check the scenarios)
+    python -m benchmarks.loadtest --app app.endpoint:app --clients 2 --sessions 2
+'''
+import argparse
+import asyncio
+import importlib
+import json
+import math
+import random
+import sys
+import time
+from collections import defaultdict
+from io import BytesIO
+import httpx
+from benchmarks.synthetic import synthetic_survey, survey_params
+
+PREFIX = '/crossart'
+SCENARIOS = ['ui', 'batch', 'chart']
+
+class Recorder:
+    '''
+    Latency and status of every request, by endpoint.
+    '''
+    def __init__(self):
+        self.requests = defaultdict(list) # endpoint: [(seconds, status)]
+        self.sessions = 0
+
+    async def request(self, client:httpx.AsyncClient, method:str, endpoint:str, path:str=None, **kwargs)->httpx.Response:
+        '''
+        Send a request and record it under its endpoint; a failed request is recorded with status 0 and returns None.
+
+        Args:
+            - client: HTTP client [httpx AsyncClient]
+            - method: HTTP method [str]
+            - endpoint: Route of the request, eg. '/read/{dataset_id}' [str]
+            - path: Path of the request when it differs from the route [str]
+            - kwargs: Arguments of httpx request
+
+        Return:
+            - response: Response of the request, None when it failed or returned an error status.
+        '''
+        begin = time.perf_counter()
+        try:
+            response = await client.request(method, PREFIX + (path or endpoint), **kwargs)
+            code = response.status_code
+        except httpx.HTTPError:
+            response, code = None, 0
+        self.requests[f"{method} {endpoint}"].append((time.perf_counter() - begin, code))
+        return response if code and code < 400 else None
+
+def percentile(values:list[float], q:float)->float:
+    # Nearest rank percentile of sorted values
+    return values[min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))]
+
+def summary(recorder:Recorder, elapsed:float)->dict:
+    '''
+    Throughput, latency percentiles (ms) and error rate of every endpoint, and of all of them.
+
+    Args:
+        - recorder: Requests of the load test [Recorder]
+        - elapsed: Seconds the load test ran [float]
+
+    Return:
+        - summary: dictionary of endpoint and its statistics, with 'all' and the sessions per second.
+    '''
+    endpoints = dict(recorder.requests)
+    endpoints['all'] = [request for requests in recorder.requests.values() for request in requests]
+    stats = {}
+    for endpoint, requests in endpoints.items():
+        latencies = sorted(seconds * 1000 for seconds, _ in requests)
+        statuses = defaultdict(int)
+        for _, code in requests:
+            statuses[str(code)] += 1
+        errors = sum(1 for _, code in requests if not code or code >= 400)
+        stats[endpoint] = {
+            'requests': len(requests),
+            'throughput': len(requests) / elapsed,
+            'p50_ms': percentile(latencies, 50) if latencies else None,
+            'p95_ms': percentile(latencies, 95) if latencies else None,
+            'p99_ms': percentile(latencies, 99) if latencies else None,
+            'error_rate': errors / len(requests) if requests else 0,
+            'statuses': dict(statuses)
+            }
+    return {'elapsed': elapsed, 'sessions': recorder.sessions, 'sessions_per_second': recorder.sessions / elapsed, 'endpoints': stats}
+
+class Workload:
+    '''
+    Files and parameters shared by the sessions: the survey as csv (for /read) and Parquet (for /crosstabs/upload),
+    its crosstab parameters and a crosstabs file.
+
+    Args:
+        - respondents, questions, demos: Shape of the synthetic survey [int]
+        - same_params: Every session asks for all the questions, instead of a random range of them [bool]
+    '''
+    def __init__(self, respondents:int, questions:int, demos:int, same_params:bool):
+        from app.component_module.table import write_table
+        from app.utils_module.utils import export_data
+        df = synthetic_survey(respondents=respondents, questions=questions, demos=demos)
+        self.params = survey_params(df)
+        self.survey = df.to_csv(index=False).encode('utf-8')
+        self.parquet = export_data(df=df, fmt='parquet')
+        self.same_params = same_params
+        self.crosstabs = write_table(df=df, wise='Both', data_sheet='none', **self.params)
+
+    def crosstab_params(self, rng:random.Random)->dict:
+        '''
+        Parameters of a /crosstabs request, on a range of questions picked like a user would.
+
+        Args:
+            - rng: Random generator of the client [random.Random]
+
+        Return:
+            - params: JSON body of the crosstab parameters [dict]
+        '''
+        q_ls = self.params['q_ls']
+        if not self.same_params:
+            first = rng.randrange(len(q_ls))
+            q_ls = q_ls[first:rng.randrange(first, len(q_ls)) + 1]
+        return {
+            **self.params,
+            'q_ls': q_ls,
+            'multi': [q for q in self.params['multi'] if q in q_ls],
+            'name_sort': [q for q in self.params['name_sort'] if q in q_ls],
+            'wise': rng.choice(['% of Column Total', '% of Row Total', 'Both']),
+            'data_sheet': 'none',
+            'stream': True
+            }
+
+async def chart_session(client:httpx.AsyncClient, recorder:Recorder, crosstabs:bytes):
+    # Read the tables of a crosstabs file and draw their charts
+    response = await recorder.request(
+        client, 'POST', '/read_crosstabs', files={'file': ('crosstabs.xlsx', BytesIO(crosstabs))}
+        )
+    if response is None:
+        return
+    tables = response.json()
+    await recorder.request(
+        client, 'POST', '/chart', json={'dfs': tables['df_list'], 'sheet_names': tables['sheet_names'], 'stream': True}
+        )
+
+async def ui_session(client:httpx.AsyncClient, recorder:Recorder, workload:Workload, rng:random.Random):
+    # Upload a survey, pick its demographics, generate crosstabs and draw their charts
+    response = await recorder.request(client, 'POST', '/read', files={'file': ('survey.csv', BytesIO(workload.survey))})
+    if response is None:
+        return
+    dataset_id = response.json()['dataset_id']
+    await recorder.request(client, 'POST', '/demography', json={'dataset_id': dataset_id})
+    for demo in workload.params['demos']:
+        await recorder.request(client, 'POST', '/demo_sorter', json={'dataset_id': dataset_id, 'demo': demo})
+    response = await recorder.request(
+        client, 'POST', '/crosstabs', json={'dataset_id': dataset_id, **workload.crosstab_params(rng)}
+        )
+    if response is not None:
+        await chart_session(client, recorder, response.content)
+    await recorder.request(client, 'DELETE', '/read/{dataset_id}', path=f"/read/{dataset_id}")
+
+async def batch_session(client:httpx.AsyncClient, recorder:Recorder, workload:Workload, rng:random.Random):
+    # Generate crosstabs straight from the survey file
+    await recorder.request(
+        client, 'POST', '/crosstabs/upload',
+        files={'file': ('survey.parquet', BytesIO(workload.parquet))},
+        data={'params': json.dumps(workload.crosstab_params(rng))}
+        )
+
+async def run_client(
+        client:httpx.AsyncClient,
+        recorder:Recorder,
+        workload:Workload,
+        scenarios:dict[str, float],
+        seed:int,
+        deadline:float,
+        sessions:int,
+        think:float
+        ):
+    '''
+    A virtual user running sessions until the deadline, or for a number of sessions.
+
+    Args:
+        - client: HTTP client shared by the virtual users [httpx AsyncClient]
+        - recorder: Requests of the load test [Recorder]
+        - workload: Files and parameters of the sessions [Workload]
+        - scenarios: Scenario name and its weight [dict]
+        - seed: Seed of the random generator of the user [int]
+        - deadline: time.monotonic() to stop at, None to run `sessions` sessions [float]
+        - sessions: Number of sessions when there is no deadline [int]
+        - think: Mean seconds between two sessions [float]
+
+    Return:
+        - None
+    '''
+    rng = random.Random(seed)
+    done = 0
+    while (time.monotonic() < deadline) if deadline is not None else done < sessions:
+        scenario = rng.choices(list(scenarios), weights=list(scenarios.values()))[0]
+        if scenario == 'ui':
+            await ui_session(client, recorder, workload, rng)
+        elif scenario == 'batch':
+            await batch_session(client, recorder, workload, rng)
+        else:
+            await chart_session(client, recorder, workload.crosstabs)
+        recorder.sessions += 1
+        done += 1
+        if think:
+            await asyncio.sleep(rng.expovariate(1 / think))
+
+def parse_scenarios(text:str)->dict[str, float]:
+    '''
+    Parse the scenario weights, eg. 'ui=3,batch=1'.
+
+    Args:
+        - text: Comma separated scenarios, with an optional weight [str]
+
+    Return:
+        - scenarios: dictionary of scenario name and weight.
+    '''
+    scenarios = {}
+    for item in text.split(','):
+        name, _, weight = item.strip().partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"scenario should be one of {SCENARIOS}, got '{name}'")
+        scenarios[name] = float(weight or 1)
+    return scenarios
+
+def client_for(args:argparse.Namespace)->httpx.AsyncClient:
+    # HTTP client to the server, or to the ASGI app in this process
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+    if args.app:
+        module, _, name = args.app.partition(':')
+        transport = httpx.ASGITransport(app=getattr(importlib.import_module(module), name or 'app'))
+        return httpx.AsyncClient(transport=transport, base_url='http://app', timeout=timeout)
+    return httpx.AsyncClient(base_url=args.url, timeout=timeout, limits=limits)
+
+def report(stats:dict):
+    '''
+    Print the statistics of every endpoint.
+
+    Args:
+        - stats: Statistics from summary [dict]
+
+    Return:
+        - None
+    '''
+    print(f"{stats['sessions']} sessions in {stats['elapsed']:.1f} s ({stats['sessions_per_second']:.2f} sessions/s)")
+    print(f"{'endpoint':<32} {'requests':>8} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for endpoint, stat in stats['endpoints'].items():
+        if not stat['requests']:
+            continue
+        print(
+            f"{endpoint:<32} {stat['requests']:>8} {stat['throughput']:>8.2f} {stat['p50_ms']:>9.1f} "
+            f"{stat['p95_ms']:>9.1f} {stat['p99_ms']:>9.1f} {stat['error_rate']:>7.1%}"
+            )
+
+async def main_async(args:argparse.Namespace)->dict:
+    workload = Workload(respondents=args.respondents, questions=args.questions, demos=args.demos, same_params=args.same_params)
+    recorder = Recorder()
+    async with client_for(args) as client:
+        begin = time.monotonic()
+        deadline = None if args.sessions else begin + args.duration
+        await asyncio.gather(*[
+            run_client(client, recorder, workload, args.scenario, args.seed + i, deadline, args.sessions, args.think)
+            for i in range(args.clients)
+            ])
+        elapsed = time.monotonic() - begin
+    return summary(recorder, elapsed)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='base URL of the server')
+    parser.add_argument('--app', help="ASGI app to test in this process instead of a server, eg. 'app.endpoint:app'")
+    parser.add_argument('--scenario', type=parse_scenarios, default={'ui': 1}, help="weighted scenarios, eg. 'ui=3,batch=1'")
+    parser.add_argument('--clients', type=int, default=8, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run')
+    parser.add_argument('--sessions', type=int, help='sessions per user, instead of a duration')
+    parser.add_argument('--think', type=float, default=0, help='mean seconds between the sessions of a user')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds before a request fails')
+    parser.add_argument('--respondents', type=int, default=5000)
+    parser.add_argument('--questions', type=int, default=20)
+    parser.add_argument('--demos', type=int, default=2)
+    parser.add_argument('--same-params', action='store_true', help='ask every session for the same crosstabs (cache hits)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='file to write the results to')
+    args = parser.parse_args()
+
+    stats = asyncio.run(main_async(args))
+    report(stats)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': {key: value for key, value in vars(args).items()}, **stats}, f, indent=2)
+    return 1 if stats['endpoints']['all']['error_rate'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
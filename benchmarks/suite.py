@@ -0,0 +1,175 @@
+'''
+Timed scenarios of every layer of the crosstab and chart engines on a synthetic survey:
+crosstab functions, processor functions, write_table by wise, load_chart, crosstab_reader and draw_chart.
+Results are printed and can be written to JSON, and compared with the JSON of another commit.
+
+Usage (from the root of the repository):
+    python -m benchmarks.suite --respondents 50000 --questions 40 --json bench.json
+    python -m benchmarks.suite --only write_table --compare bench.json
+'''
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from io import BytesIO
+from typing import Callable
+import pandas as pd
+from app.crosstab_module.crosstab import (
+    single_choice_crosstab_column,
+    single_choice_crosstab_row,
+    multi_choice_crosstab_column,
+    multi_choice_crosstab_row
+    )
+from app.crosstab_module.context import CrosstabContext
+from app.utils_module.processor import get_column, get_row
+from app.utils_module.writer import TableWriter
+from app.component_module.table import write_table
+from app.component_module.viz import draw_chart
+from app.chart_module.chart import load_chart, crosstab_reader
+from benchmarks.synthetic import synthetic_survey, survey_params, WEIGHTS
+
+WISES = ['% of Column Total', '% of Row Total', 'Both']
+
+def timed(fn:Callable[[], object], repeat:int)->dict:
+    '''
+    Time a scenario, once to warm up and `repeat` times after.
+
+    Args:
+        - fn: Scenario to run [callable]
+        - repeat: Number of timed runs [int]
+
+    Return:
+        - timing: min, median and mean of the runs in seconds, with the number of runs.
+    '''
+    fn()
+    runs = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - begin)
+    return {'repeat': repeat, 'min': min(runs), 'median': statistics.median(runs), 'mean': statistics.fmean(runs)}
+
+def scenarios(df:pd.DataFrame, params:dict)->dict[str, Callable[[], object]]:
+    '''
+    Scenarios of every layer on a survey, by name ('layer/scenario').
+
+    Args:
+        - df: Synthetic survey [pandas dataframe]
+        - params: Crosstab parameters of the survey, from survey_params [dict]
+
+    Return:
+        - scenarios: dictionary of scenario name and the function running it.
+    '''
+    demo = params['demos'][0]
+    weight = params['weight']
+    column_seq = params['col_seqs'][demo]
+    single = next(q for q in params['q_ls'] if q not in params['multi'])
+    multi = next((q for q in params['q_ls'] if q in params['multi']), None)
+    crosstab = {**params, 'wise': 'Both'}
+    xlsx = write_table(df=df, **crosstab)
+    dfs, sheet_names, _ = load_chart(df_charts=BytesIO(xlsx))
+
+    def processor(fn:Callable)->Callable[[], object]:
+        # Every question across the first demographic, through one shared context like write_table
+        def run():
+            context = CrosstabContext(df=df, weight=weight, columns=params['q_ls'] + [demo], multi=params['multi'])
+            writer = TableWriter(BytesIO())
+            start = 1
+            for q in params['q_ls']:
+                start, _, _ = fn(
+                    df, q, params['multi'], params['name_sort'], demo, weight, params['col_seqs'], writer, start, context=context
+                    )
+            writer.close()
+        return run
+
+    def reader():
+        import xlsxwriter
+        workbook = xlsxwriter.Workbook(BytesIO(), {'in_memory': True})
+        for sheet_df, sheet_name in zip(dfs, sheet_names):
+            crosstab_reader(workbook, sheet_df, sheet_name)
+        workbook.close()
+
+    runs = {
+        'crosstab/single_choice_crosstab_column': lambda: single_choice_crosstab_column(
+            df=df, q=single, sorting=params['name_sort'], column=demo, value=weight, column_seq=column_seq),
+        'crosstab/single_choice_crosstab_row': lambda: single_choice_crosstab_row(
+            df=df, q=single, sorting=params['name_sort'], column=demo, value=weight, column_seq=column_seq),
+        }
+    if multi is not None:
+        runs['crosstab/multi_choice_crosstab_column'] = lambda: multi_choice_crosstab_column(
+            df=df, q=multi, column=demo, value=weight, column_seq=column_seq)
+        runs['crosstab/multi_choice_crosstab_row'] = lambda: multi_choice_crosstab_row(
+            df=df, q=multi, column=demo, value=weight, column_seq=column_seq)
+    runs['processor/get_column'] = processor(get_column)
+    runs['processor/get_row'] = processor(get_row)
+    for wise in WISES:
+        runs[f"write_table/{wise}"] = lambda wise=wise: write_table(df=df, **{**params, 'wise': wise})
+    runs['write_table/Both, no data sheet'] = lambda: write_table(df=df, **crosstab, data_sheet='none')
+    runs['write_table/Both, charts'] = lambda: write_table(df=df, **crosstab, data_sheet='none', charts=True)
+    runs['chart/load_chart'] = lambda: load_chart(df_charts=BytesIO(xlsx))
+    runs['chart/crosstab_reader'] = reader
+    runs['chart/draw_chart'] = lambda: draw_chart(dfs=dfs, sheet_names=sheet_names)
+    return runs
+
+def commit()->str:
+    # Commit of the benchmarked tree, None outside of a git repository
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--respondents', type=int, default=10000)
+    parser.add_argument('--questions', type=int, default=20)
+    parser.add_argument('--answers', type=int, default=5)
+    parser.add_argument('--multi-share', type=float, default=0.2)
+    parser.add_argument('--demos', type=int, default=2)
+    parser.add_argument('--weights', choices=WEIGHTS, default='lognormal')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per scenario')
+    parser.add_argument('--only', help='run the scenarios whose name contains this')
+    parser.add_argument('--json', help='file to write the results to')
+    parser.add_argument('--compare', help='results of another run to compare with')
+    args = parser.parse_args()
+
+    survey = {
+        'respondents': args.respondents, 'questions': args.questions, 'answers': args.answers,
+        'multi_share': args.multi_share, 'demos': args.demos, 'weights': args.weights, 'seed': args.seed
+        }
+    df = synthetic_survey(**survey)
+    runs = scenarios(df=df, params=survey_params(df))
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {result['name']: result for result in json.load(f)['results']}
+
+    results = []
+    print(f"{'scenario':<45} {'median (s)':>11} {'min (s)':>9}" + (f" {'speedup':>12}" if baseline else ''))
+    for name, fn in runs.items():
+        if args.only and args.only not in name:
+            continue
+        result = {'name': name, **timed(fn, args.repeat)}
+        results.append(result)
+        line = f"{name:<45} {result['median']:>11.4f} {result['min']:>9.4f}"
+        if name in baseline:
+            line += f" {baseline[name]['median'] / result['median']:>11.2f}x"
+        print(line)
+
+    if args.json:
+        meta = {
+            'commit': commit(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'machine': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'survey': survey
+            }
+        with open(args.json, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+'''
+Deterministic synthetic surveys, shaped like the surveys the app is used on, to benchmark the crosstab engine at any scale.
+'''
+import numpy as np
+import pandas as pd
+from app.utils_module.utils import sorter
+
+# Demographic columns, named so that demography() and sorter() recognise them, with their values
+DEMOGRAPHICS = {
+    'Gender': ['Male', 'Female'],
+    'IncomeGroup': ['B40', 'M40', 'T20'],
+    'AgeGroup': ['18-24', '25-34', '35-44', '45-54', '55+'],
+    'Ethnicity': ['Malay', 'Chinese', 'Indian', 'Bumiputera', 'Others'],
+    'Urbanicity': ['Urban', 'Semi-urban', 'Rural']
+    }
+
+WEIGHTS = ['unit', 'lognormal', 'trimmed']
+
+def synthetic_survey(
+        respondents:int=10000,
+        questions:int=20,
+        answers:int=5,
+        multi_share:float=0.2,
+        likert_share:float=0.5,
+        demos:int=2,
+        weights:str='lognormal',
+        seed:int=0
+        )->pd.DataFrame:
+    '''
+    Generate a survey with single choice ([LIKERT] or not) and [MULTI] questions, demographics and a weight column.
+    The same arguments always give the same survey.
+
+    Args:
+        - respondents: Number of rows [int]
+        - questions: Number of question columns [int]
+        - answers: Number of answers of every question (options of the multiple answer questions) [int]
+        - multi_share: Share of the questions with multiple answers, separated by ', ' [float]
+        - likert_share: Share of the single choice questions tagged [LIKERT], to sort by name [float]
+        - demos: Number of demographic columns, up to len(DEMOGRAPHICS) [int]
+        - weights: Distribution of the 'weight' column; 'unit', 'lognormal' or 'trimmed' (lognormal clipped to [0.3, 3]) [str]
+        - seed: Seed of the random generator [int]
+
+    Return:
+        - df: Synthetic survey [pandas dataframe]
+    '''
+    if weights not in WEIGHTS:
+        raise ValueError(f"weights should be one of {WEIGHTS}, got '{weights}'")
+    if not 0 < demos <= len(DEMOGRAPHICS):
+        raise ValueError(f"demos should be between 1 and {len(DEMOGRAPHICS)}, got {demos}")
+    rng = np.random.default_rng(seed)
+
+    columns = {}
+    multi = int(round(questions * multi_share))
+    likert = int(round((questions - multi) * likert_share))
+    for i in range(1, questions + 1):
+        # Answers are skewed like real surveys, so the tables are not uniform
+        p = rng.dirichlet(np.ones(answers))
+        if i <= multi:
+            options = np.array([f"Option {a + 1}" for a in range(answers)])
+            chosen = rng.random((respondents, answers)) < p * 2
+            chosen[~chosen.any(axis=1), 0] = True
+            columns[f"{i}. [MULTI] Question {i}"] = [', '.join(options[row]) for row in chosen]
+        else:
+            tag = '[LIKERT] ' if i <= multi + likert else ''
+            labels = np.array([f"{a + 1}) Answer {a + 1}" for a in range(answers)])
+            columns[f"{i}. {tag}Question {i}"] = labels[rng.choice(answers, size=respondents, p=p)]
+
+    for demo in list(DEMOGRAPHICS)[:demos]:
+        values = np.array(DEMOGRAPHICS[demo])
+        columns[demo] = values[rng.choice(len(values), size=respondents, p=rng.dirichlet(np.ones(len(values)) * 4))]
+
+    if weights == 'unit':
+        weight = np.ones(respondents)
+    else:
+        weight = rng.lognormal(mean=0, sigma=0.6, size=respondents)
+        weight /= weight.mean()
+        if weights == 'trimmed':
+            weight = np.clip(weight, 0.3, 3)
+    columns['weight'] = weight
+    return pd.DataFrame(columns)
+
+def survey_params(df:pd.DataFrame)->dict:
+    '''
+    Crosstab parameters of a synthetic survey, as the crosstabs UI would select them: every question across every demographic.
+
+    Args:
+        - df: Synthetic survey [pandas dataframe]
+
+    Return:
+        - params: demos, q_ls, multi, name_sort, weight and col_seqs, as taken by write_table [dict]
+    '''
+    demos = [column for column in df.columns if column in DEMOGRAPHICS]
+    q_ls = [column for column in df.columns if column not in demos and column != 'weight']
+    return {
+        'demos': demos,
+        'q_ls': q_ls,
+        'multi': [q for q in q_ls if '[MULTI]' in q],
+        'name_sort': [q for q in q_ls if '[LIKERT]' in q],
+        'weight': 'weight',
+        'col_seqs': {demo: sorter(demo=demo, df=df) for demo in demos}
+        }
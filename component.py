@@ -1,11 +1,12 @@
 import streamlit as st
 from PIL import Image
 import pandas as pd
-from typing import Any
-from app.utils_module.utils import load, demography, col_search, sorter
-from app.chart_module.chart import load_chart
-from app.component_module.table import write_table
-from app.component_module.viz import draw_chart
+from typing import Any, TYPE_CHECKING
+from app.utils_module.utils import load, demography, col_search, sorter, export_data
+
+# The crosstab and chart stack is imported on first use, so the page renders before it is loaded
+if TYPE_CHECKING:
+    from app.crosstab_module.cube import CrosstabCube
 
 def page_style():
     '''
@@ -56,7 +57,7 @@ def upload_file()->Any:
     Return:
         - df: streamlit dataframe, Uploadedfile sub-class of BytesIO. 
     '''
-    st.subheader("Upload Survey responses (csv/xlsx)")
+    st.subheader("Upload Survey responses (csv/xlsx/parquet/arrow)")
     df = st.file_uploader(
         "Please ensure the data are cleaned and weighted (if need to be) prior to uploading."
         )
@@ -255,6 +256,42 @@ def wise_list()->str:
         )
     return wise
 
+def data_sheet_selection()->str:
+    '''
+    Component for user to choose how the raw data is shipped with the crosstabs.
+
+    Args:
+        - None.
+
+    Return:
+        - data_sheet: 'full', 'preview', 'none', 'csv' or 'parquet'.
+    '''
+    data_sheets = {
+        "Full data sheet": 'full',
+        "Preview data sheet (1000 respondents)": 'preview',
+        "No data sheet": 'none',
+        "Separate CSV file (gzip)": 'csv',
+        "Separate Parquet file": 'parquet'
+        }
+    data_sheet = st.selectbox(
+        "Raw data in the crosstabs file:",
+        list(data_sheets)
+        )
+    return data_sheets[data_sheet]
+
+def charts_selection()->bool:
+    '''
+    Component for user to draw the charts with the crosstabs, instead of in the Chart Generator tab.
+
+    Args:
+        - None.
+
+    Return:
+        - charts: Whether to draw the clustered bar chart next to every table.
+    '''
+    charts = st.checkbox("Draw the charts next to the tables")
+    return charts
+
 def get_multi_answer(df:pd.DataFrame, first_idx:int, last_idx:int)->list[str]:
     '''
     Component for user to select column that contains multiple answer option using keyword `MULTI`.
@@ -274,6 +311,29 @@ def get_multi_answer(df:pd.DataFrame, first_idx:int, last_idx:int)->list[str]:
         )
     return multi
 
+def get_cube(df:pd.DataFrame, weight:str, demos:list[str], q_ls:list[str], multi:list[str])->'CrosstabCube':
+    '''
+    Component to keep the weighted counts of the survey across reruns, so regenerating the crosstabs
+    with other value options, sorting or column sequences does not go through the respondents again.
+
+    Args:
+        - df: pandas dataframe
+        - weight: Name of the selected weight column [str]
+        - demos: List of name of the selected demography columns.
+        - q_ls: List of question column.
+        - multi: List of column that contains multiple answer option.
+
+    Return:
+        - cube: Weighted counts of the survey [CrosstabCube]
+    '''
+    from app.crosstab_module.cube import CrosstabCube
+    from app.utils_module.cache import dataset_fingerprint
+    key = (dataset_fingerprint(df), weight)
+    if st.session_state.get('cube_key') != key:
+        st.session_state['cube'] = CrosstabCube(df=df, weight=weight, demos=demos, q_ls=q_ls, multi=multi)
+        st.session_state['cube_key'] = key
+    return st.session_state['cube']
+
 def init_crossgen_tab():
     '''
     Composite function to run the front-end of the crosstabs streamlit based on logic. 
@@ -320,8 +380,18 @@ def init_crossgen_tab():
                                         first_idx=first_idx,
                                         last_idx=last_idx
                                         )
+                                    data_sheet = data_sheet_selection()
+                                    charts = charts_selection()
                                     button = st.button('Generate Crosstabs')
                                     if button:
+                                        from app.component_module.table import write_table
+                                        cube = get_cube(
+                                            df=df,
+                                            weight=weight,
+                                            demos=demos,
+                                            q_ls=q_ls,
+                                            multi=multi
+                                            )
                                         df_xlsx = write_table(
                                             df=df,
                                             demos=demos,
@@ -330,7 +400,10 @@ def init_crossgen_tab():
                                             multi=multi,
                                             name_sort=name_sort,
                                             weight=weight,
-                                            col_seqs=col_seqs
+                                            col_seqs=col_seqs,
+                                            data_sheet=data_sheet if data_sheet in ['full', 'preview', 'none'] else 'none',
+                                            cube=cube,
+                                            charts=charts
                                             )
                                         df_name = df_name[:df_name.find('.')]
                                         st.balloons()
@@ -340,6 +413,12 @@ def init_crossgen_tab():
                                             data=df_xlsx, 
                                             file_name= df_name + '-crosstabs.xlsx'
                                             )
+                                        if data_sheet in ['csv', 'parquet']:
+                                            st.download_button(
+                                                label='📥 Download data', 
+                                                data=export_data(df=df, fmt=data_sheet), 
+                                                file_name= df_name + ('-data.csv.gz' if data_sheet == 'csv' else '-data.parquet')
+                                                )
                                         
 #--------------------Component for Chart Generator-------------------
 def issue_warning()->Any:
@@ -402,8 +481,10 @@ def init_chart_gen():
     try:
         df_charts = upload_crosstabs()
         if df_charts:
-            dfs, sheet_names, df_chartsname = load_chart(df_charts=df_charts, filename=True)
-            df_charts = draw_chart(dfs=dfs, sheet_names=sheet_names)
+            from app.chart_module.chart import iter_chart_sheets
+            from app.component_module.viz import draw_chart
+            df_chartsname = df_charts.name
+            df_charts = draw_chart(sheets=iter_chart_sheets(df_charts=df_charts))
             df_chartsname = df_chartsname[:df_chartsname.find('.')]
             st.balloons()
             st.header("Charts ready for download!")
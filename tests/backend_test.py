@@ -1,14 +1,28 @@
+from io import BytesIO
 from app.component_module.table import write_table
+from app.crosstab_module.cube import CrosstabCube, build_cubes
+from app.crosstab_module.context import CrosstabContext
+from app.crosstab_module.crosstab import single_choice_crosstab_column, single_choice_crosstab_row
 from pathlib import Path
 import pandas as pd
 import pytest
-from app.chart_module.chart import load_chart
+from app.chart_module.chart import load_chart, iter_chart_sheets, table_regions, crosstab_reader, chart_formats
 from app.component_module.viz import draw_chart
+from app.utils_module.store import DatasetStore
+from app.utils_module.jobs import JobManager, JobQueueFull
+from app.utils_module.executor import Executor, ExecutorSaturated, Admission
+from app.utils_module.cache import ResultCache, dataset_fingerprint
+from app.utils_module import timing
+from app.utils_module.memory import MemoryBudget, MemoryBudgetExceeded, estimate_crosstabs, survey_cells
+import asyncio
+import threading
+import numpy as np
 from app.utils_module.utils import (
     load, 
     demography,
     col_search,
-    sorter
+    sorter,
+    export_data
 )
 
 # --------------------------- Crosstabs Generator ------------------------------------------
@@ -70,6 +84,327 @@ def test_write_table():
         df_xlsx, bytes
         ), "Output is not in bytes"
 
+def test_write_table_column_total():
+    '''
+    Test that every demography column of a % of Column Total table adds up to 1.
+    '''
+    file_path = Path.cwd() / 'tests' / 'test_crosstabs.csv'
+
+    df = pd.read_csv(file_path)
+    df_xlsx = write_table(
+        df=df,
+        demos=['Gender'],
+        wise='% of Column Total',
+        q_ls=['2. What is your dream job field?'],
+        multi=[],
+        name_sort=[],
+        weight='untrimmed_weight',
+        col_seqs={'Gender': ['Male', 'Female']}
+    )
+    table = pd.read_excel(BytesIO(df_xlsx), sheet_name='Gender(col)', skiprows=1)
+    answers = table[table.iloc[:, 0] != 'Grand Total']
+
+    assert list(table.columns[1:]) == ['Male', 'Female', 'Grand Total'], "Columns are not in the expected order"
+    assert all(
+        abs(answers[col].sum() - 1) < 1e-3 for col in ['Male', 'Female', 'Grand Total']
+        ), "Column percentages do not add up to 1"
+
+def test_write_table_row_total():
+    '''
+    Test that every answer of a % of Row Total table adds up to 1 across the demography.
+    '''
+    file_path = Path.cwd() / 'tests' / 'test_crosstabs.csv'
+
+    df = pd.read_csv(file_path)
+    df_xlsx = write_table(
+        df=df,
+        demos=['IncomeGroup'],
+        wise='% of Row Total',
+        q_ls=['2. What is your dream job field?'],
+        multi=[],
+        name_sort=[],
+        weight='untrimmed_weight',
+        col_seqs={'IncomeGroup': ['B40', 'M40', 'T20']}
+    )
+    table = pd.read_excel(BytesIO(df_xlsx), sheet_name='IncomeGroup(row)', skiprows=1)
+
+    assert all(
+        abs(total - 1) < 1e-3 for total in table[['B40', 'M40', 'T20']].sum(axis=1)
+        ), "Row percentages do not add up to 1"
+    assert (table['Grand Total'] == 1).all(), "Grand Total column is not 1"
+
+def _random_survey(seed:int, n:int=200)->pd.DataFrame:
+    '''
+    Random single choice survey with 1 decimal weights, where the weighted percentages often land on half ties.
+    '''
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'q': rng.choice(['Yes', 'No', 'Maybe', ''], n),
+        'demo': rng.choice(['A', 'B'], n),
+        'weight': np.round(rng.uniform(0.1, 2, n), 1)
+    })
+
+def _original_column(df:pd.DataFrame, answers:list[str], demos:list[str])->dict:
+    '''
+    % of Column Total of q across demo, computed like the original loops of single_choice_crosstab_column.
+    '''
+    table = {}
+    for demo in demos:
+        total_sum = 0
+        for j in df[df['demo'] == demo]['q'].replace('', np.nan).dropna().index:
+            total_sum += df['weight'][j]
+        table[demo] = [
+            round(df[(df['demo'] == demo) & (df['q'] == row)]['weight'].sum() / total_sum, 4) for row in answers
+            ]
+    total_sum = 0
+    for j in df['q'].replace('', np.nan).dropna().index:
+        total_sum += df['weight'][j]
+    table['Grand Total'] = [round(df[df['q'] == row]['weight'].sum() / total_sum, 4) for row in answers]
+    return table
+
+def _original_row(df:pd.DataFrame, answers:list[str], demos:list[str])->dict:
+    '''
+    % of Row Total of q across demo, computed like the original loops of single_choice_crosstab_row.
+    '''
+    return {
+        demo: [
+            round(df[(df['demo'] == demo) & (df['q'] == row)]['weight'].sum() / df[df['q'] == row]['weight'].sum(), 4)
+            for row in answers
+            ]
+        for demo in demos
+        }
+
+def test_single_choice_original_values():
+    '''
+    Test that the % of Column Total and % of Row Total tables are the exact values of the original loops,
+    which sum the weights of every cell and answer pairwise with pandas, so half ties round the same way.
+    '''
+    answers, demos = ['Yes', 'No', 'Maybe'], ['A', 'B']
+    for seed in [176, 226, 334, 514, 698, 928] + list(range(20)):
+        df = _random_survey(seed)
+        context = CrosstabContext(df=df, weight='weight')
+        column_total = _original_column(df=df, answers=answers, demos=demos)
+        row_total = _original_row(df=df, answers=answers, demos=demos)
+        for counts in [context.counts(q='q', column='demo'), context.batch_counts(q_ls=['q'], column='demo')['q']]:
+            table = single_choice_crosstab_column(
+                df=df, q='q', sorting=[], column='demo', value='weight',
+                column_seq=demos, row_seq=answers, context=context, counts=counts
+                )
+            for demo in demos + ['Grand Total']:
+                assert list(table[demo])[:-1] == column_total[demo], f"% of Column Total of {demo} differs from the original (seed {seed})"
+
+            table = single_choice_crosstab_row(
+                df=df, q='q', sorting=[], column='demo', value='weight',
+                column_seq=demos, row_seq=answers, context=context, counts=counts
+                )
+            for demo in demos:
+                assert list(table[demo])[:-1] == row_total[demo], f"% of Row Total of {demo} differs from the original (seed {seed})"
+
+def test_write_table_multi_answer():
+    '''
+    Test that a single answer question processed as multiple answer
+    gives the same Grand Total as the single answer table.
+    '''
+    file_path = Path.cwd() / 'tests' / 'test_crosstabs.csv'
+
+    df = pd.read_csv(file_path)
+    q = '2. What is your dream job field?'
+    tables = []
+    for multi in [[], [q]]:
+        df_xlsx = write_table(
+            df=df,
+            demos=['Gender'],
+            wise='% of Column Total',
+            q_ls=[q],
+            multi=multi,
+            name_sort=[],
+            weight='untrimmed_weight',
+            col_seqs={'Gender': ['Male', 'Female']}
+        )
+        table = pd.read_excel(BytesIO(df_xlsx), sheet_name='Gender(col)', skiprows=1)
+        tables.append(table[table[q] != 'Grand Total'].set_index(q))
+
+    single, multiple = tables
+    assert list(multiple['Grand Total']) == sorted(multiple['Grand Total'], reverse=True), "Options are not sorted by Grand Total"
+    assert single.loc[multiple.index].equals(multiple), "Multiple answer table does not match the single answer table"
+
+def test_write_table_workers():
+    '''
+    Test that the parallel write_table() writes the same tables as the sequential one.
+    '''
+    file_path = Path.cwd() / 'tests' / 'test_crosstabs.csv'
+
+    df = pd.read_csv(file_path)
+    sheets = []
+    for workers in [1, 2]:
+        df_xlsx = write_table(
+            df=df,
+            demos=['Gender', 'IncomeGroup'],
+            wise='Both',
+            q_ls=['1. [LIKERT] Opinions', '2. What is your dream job field?'],
+            multi=['2. What is your dream job field?'],
+            name_sort=['1. [LIKERT] Opinions'],
+            weight='untrimmed_weight',
+            col_seqs={'Gender': ['Male', 'Female'], 'IncomeGroup': ['B40', 'M40', 'T20']},
+            workers=workers
+        )
+        sheets.append(pd.read_excel(BytesIO(df_xlsx), sheet_name=None, header=None))
+
+    sequential, parallel = sheets
+    assert list(sequential) == list(parallel), "Sheets are not in the same order"
+    assert all(
+        sequential[name].equals(parallel[name]) for name in sequential
+        ), "Parallel tables do not match the sequential tables"
+
+def test_write_table_constant_memory():
+    '''
+    Test that the constant memory write_table() writes the same workbook content.
+    '''
+    file_path = Path.cwd() / 'tests' / 'test_crosstabs.csv'
+
+    df = pd.read_csv(file_path)
+    sheets = []
+    for constant_memory in [False, True]:
+        df_xlsx = write_table(
+            df=df,
+            demos=['Gender'],
+            wise='Both',
+            q_ls=['1. [LIKERT] Opinions', '2. What is your dream job field?'],
+            multi=[],
+            name_sort=['1. [LIKERT] Opinions'],
+            weight='untrimmed_weight',
+            col_seqs={'Gender': ['Male', 'Female']},
+            constant_memory=constant_memory
+        )
+        sheets.append(pd.read_excel(BytesIO(df_xlsx), sheet_name=None, header=None))
+
+    in_memory, flushed = sheets
+    assert list(in_memory) == ['data', 'Gender(col)', 'Gender(row)'], "Sheets are not in the expected order"
+    assert all(
+        in_memory[name].equals(flushed[name]) for name in in_memory
+        ), "Constant memory workbook does not match"
+
+def test_write_table_cube():
+    '''
+    Test that write_table() renders the same crosstabs from a cube, without the respondents,
+    whatever the value options and column sequences.
+    '''
+    file_path = Path.cwd() / 'tests' / 'test_crosstabs.csv'
+
+    df = pd.read_csv(file_path)
+    cubes = build_cubes(df)
+    assert list(cubes) == ['untrimmed_weight', 'trimmed_weight'], "Cubes are not built for every weight column"
+    cube = CrosstabCube(
+        df=df,
+        weight='untrimmed_weight',
+        demos=['Gender', 'IncomeGroup'],
+        multi=['2. What is your dream job field?']
+    )
+    cube.df = None # the tables must be rendered from the materialized counts only
+
+    for wise, gender in [('Both', ['Male', 'Female']), ('% of Row Total', ['Female', 'Male'])]:
+        params = dict(
+            df=df,
+            demos=['Gender', 'IncomeGroup'],
+            wise=wise,
+            q_ls=['1. [LIKERT] Opinions', '2. What is your dream job field?'],
+            multi=['2. What is your dream job field?'],
+            name_sort=['1. [LIKERT] Opinions'],
+            weight='untrimmed_weight',
+            col_seqs={'Gender': gender, 'IncomeGroup': ['T20', 'M40', 'B40']}
+        )
+        expected = pd.read_excel(BytesIO(write_table(**params)), sheet_name=None)
+        rendered = pd.read_excel(BytesIO(write_table(**params, cube=cube)), sheet_name=None)
+        assert list(rendered) == list(expected), "Cube does not render the same sheets"
+        assert all(
+            rendered[name].equals(expected[name]) for name in expected
+            ), f"Cube does not render the same crosstabs for {wise}"
+
+def test_write_table_charts():
+    '''
+    Test that write_table() draws the same charts as the chart generator does from its output.
+    '''
+    import zipfile
+
+    file_path = Path.cwd() / 'tests' / 'test_crosstabs.csv'
+
+    df = pd.read_csv(file_path)
+    params = dict(
+        demos=['Gender', 'IncomeGroup'],
+        wise='Both',
+        q_ls=['1. [LIKERT] Opinions', '2. What is your dream job field?'],
+        multi=[],
+        name_sort=['1. [LIKERT] Opinions'],
+        weight='untrimmed_weight',
+        col_seqs={'Gender': ['Male', 'Female'], 'IncomeGroup': ['B40', 'M40', 'T20']}
+        )
+
+    def chart_parts(xlsx:bytes)->list[str]:
+        return [name for name in zipfile.ZipFile(BytesIO(xlsx)).namelist() if name.startswith('xl/charts/')]
+
+    df_xlsx = write_table(df=df, charts=True, **params)
+    dfs, sheet_names, _ = load_chart(df_charts=BytesIO(write_table(df=df, **params)))
+
+    assert len(chart_parts(df_xlsx)) == 8, "A chart is not drawn for every table"
+    assert chart_parts(df_xlsx) == chart_parts(draw_chart(dfs=dfs, sheet_names=sheet_names)), "Charts differ from the chart generator"
+    assert not chart_parts(write_table(df=df, **params)), "Charts are drawn without the charts option"
+
+def test_write_table_data_sheet():
+    '''
+    Test the raw data sheet options of write_table(), and that the chart reader skips the raw data in every layout.
+    '''
+    file_path = Path.cwd() / 'tests' / 'test_crosstabs.csv'
+
+    df = pd.read_csv(file_path)
+    layouts = {'full': 'data', 'preview': 'data_preview', 'none': None}
+    for data_sheet, raw_sheet in layouts.items():
+        df_xlsx = write_table(
+            df=df,
+            demos=['Gender'],
+            wise='% of Column Total',
+            q_ls=['1. [LIKERT] Opinions', '2. What is your dream job field?'],
+            multi=[],
+            name_sort=['1. [LIKERT] Opinions'],
+            weight='untrimmed_weight',
+            col_seqs={'Gender': ['Male', 'Female']},
+            data_sheet=data_sheet
+        )
+        sheet_names = pd.ExcelFile(BytesIO(df_xlsx)).sheet_names
+        assert sheet_names == [raw_sheet, 'Gender(col)'][raw_sheet is None:], f"Unexpected sheets for data_sheet='{data_sheet}'"
+        if raw_sheet:
+            raw = pd.read_excel(BytesIO(df_xlsx), sheet_name=raw_sheet)
+            assert len(raw) == min(len(df), 1000), "Raw data sheet does not have the expected number of respondents"
+
+        _, chart_sheets, _ = load_chart(df_charts=BytesIO(df_xlsx))
+        assert chart_sheets == ['Gender(col)'], "Chart reader does not skip the raw data sheet"
+
+    with pytest.raises(ValueError):
+        write_table(
+            df=df,
+            demos=['Gender'],
+            wise='Both',
+            q_ls=['1. [LIKERT] Opinions'],
+            multi=[],
+            name_sort=[],
+            weight='untrimmed_weight',
+            col_seqs={'Gender': ['Male', 'Female']},
+            data_sheet='csv'
+        )
+
+def test_synthetic_survey():
+    '''
+    Test that the benchmark survey generator is deterministic and gives a survey the crosstabs can be written from.
+    '''
+    from benchmarks.synthetic import synthetic_survey, survey_params
+
+    df = synthetic_survey(respondents=300, questions=6, demos=3, seed=1)
+    params = survey_params(df)
+
+    assert df.equals(synthetic_survey(respondents=300, questions=6, demos=3, seed=1)), "Survey is not deterministic"
+    assert demography(df=df) == params['demos'], "Demographics are not detected"
+    assert col_search(df=df, key='[MULTI]') == params['multi'], "Multiple answer questions are not detected"
+    assert isinstance(write_table(df=df, wise='Both', **params), bytes), "Output is not in bytes"
+
 # --------------------------- Chart Generator ------------------------------------------
 '''
 NOTE: 
@@ -104,6 +439,57 @@ def test_draw_chart():
         df_charts, bytes
         ), "Output is not in bytes"
 
+def test_iter_chart_sheets():
+    '''
+    Test that the crosstab sheets are read lazily, without the raw data sheet, and drawn as they are read.
+    '''
+    file_path = Path.cwd() / 'tests' / 'test_chartgen.xlsx'
+    sheets = iter_chart_sheets(df_charts=file_path)
+    dfs, sheet_names, _ = load_chart(df_charts=file_path)
+
+    assert not isinstance(sheets, list), "Sheets are not read lazily"
+    assert 'data' not in sheet_names, "Raw data sheet is read"
+    assert isinstance(draw_chart(sheets=sheets), bytes), "Output is not in bytes"
+
+def test_crosstab_reader_formats():
+    '''
+    Test that the chart sheets of a workbook share one bold format.
+    '''
+    import xlsxwriter
+
+    file_path = Path.cwd() / 'tests' / 'test_chartgen.xlsx'
+    dfs, sheet_names, _ = load_chart(df_charts=file_path)
+    output = BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'in_memory': True})
+    bold = chart_formats(workbook)['bold']
+    formats = len(workbook.formats)
+    for df, sheet_name in zip(dfs, sheet_names):
+        workbook, _ = crosstab_reader(workbook, df, sheet_name)
+    workbook.close()
+
+    assert chart_formats(workbook)['bold'] is bold, "The bold format is not cached"
+    assert len(workbook.formats) == formats, "A format is added for every table"
+
+def test_table_regions():
+    '''
+    Test that the table detector finds the same tables as the scikit-image labeling,
+    on the crosstab sheets and on an irregular layout that falls back to the labeling.
+    '''
+    from skimage.measure import label, regionprops
+    import numpy as np
+
+    file_path = Path.cwd() / 'tests' / 'test_chartgen.xlsx'
+    irregular = np.array([
+        [1, 1, 1, 0, 0],
+        [1, 0, 0, 0, 1],
+        [0, 1, 0, 0, 1],
+        [0, 0, 0, 1, 1]
+        ], dtype=bool)
+    masks = [np.array(df.notnull()) for df in pd.read_excel(file_path, sheet_name=None, header=None).values()]
+    for mask in masks + [irregular]:
+        expected = [tuple(region.bbox) for region in regionprops(label(mask.astype("int")))]
+        assert table_regions(mask) == expected, "Table regions differ from the scikit-image labeling"
+
 # --------------------------- Utils Function ------------------------------------------
 @pytest.fixture
 def get_test_file_path()->Path:
@@ -153,6 +539,228 @@ def test_col_search(get_test_df_crosstabs:pd.DataFrame):
         'LIKERT' in col for col in col_with_keyword
         ), "No keyword 'LIKERT' exists in the list"
 
+def test_export_data(get_test_df_crosstabs:pd.DataFrame):
+    '''
+    Test that the raw data exported as gzip CSV and Parquet reads back the same.
+    '''
+    csv = pd.read_csv(BytesIO(export_data(df=get_test_df_crosstabs, fmt='csv')), compression='gzip')
+    assert csv.equals(get_test_df_crosstabs), "CSV export does not match the data"
+
+    parquet = pd.read_parquet(BytesIO(export_data(df=get_test_df_crosstabs, fmt='parquet')))
+    assert list(parquet.columns) == list(get_test_df_crosstabs.columns), "Parquet export does not have the same columns"
+    assert len(parquet) == len(get_test_df_crosstabs), "Parquet export does not have the same rows"
+
+def test_dataset_store(get_test_df_crosstabs:pd.DataFrame):
+    '''
+    Test that the dataset store evicts the least recently used and the expired datasets.
+    '''
+    store = DatasetStore(max_datasets=2)
+    first = store.put(get_test_df_crosstabs)
+    second = store.put(get_test_df_crosstabs)
+    assert store.get(first) is get_test_df_crosstabs, "Stored dataset is not returned"
+
+    third = store.put(get_test_df_crosstabs)
+    assert len(store) == 2, "Store holds more than max_datasets"
+    with pytest.raises(KeyError):
+        store.get(second)
+    store.get(first)
+    store.get(third)
+
+    store.max_bytes = 0
+    fourth = store.put(get_test_df_crosstabs)
+    assert len(store) == 1, "Store holds more than max_bytes"
+    assert store.get(fourth) is get_test_df_crosstabs, "Newest dataset is evicted"
+
+    store.ttl = 0
+    with pytest.raises(KeyError):
+        store.get(fourth)
+
+def test_job_manager():
+    '''
+    Test that the job manager runs, cancels and times out jobs through their progress callback.
+    '''
+    manager = JobManager(max_workers=1)
+    started = threading.Event()
+
+    def run(progress):
+        started.set()
+        for done in range(1000):
+            progress(done, 1000)
+            threading.Event().wait(0.01)
+        return 'result'
+
+    running = manager.submit(run)
+    queued = manager.submit(lambda progress: 'queued')
+    started.wait(5)
+    manager.cancel(queued.id)
+    manager.cancel(running.id)
+    running.future.exception(5)
+    assert queued.state == 'cancelled', "Queued job is not cancelled"
+    assert running.state == 'cancelled', "Running job is not cancelled"
+    assert 0 < running.done < 1000, "Progress of the job is not recorded"
+
+    timed_out = manager.submit(run, timeout=0.05)
+    done = manager.submit(lambda progress: 'result')
+    done.future.result(5)
+    assert timed_out.state == 'timeout', "Job does not time out"
+    assert done.state == 'done' and done.result == 'result', "Job result is not stored"
+    manager.shutdown()
+
+def test_job_manager_bounds():
+    '''
+    Test that the job manager rejects jobs beyond max_pending, and drops finished jobs by bytes and TTL.
+    '''
+    manager = JobManager(max_workers=1, max_pending=1, max_result_bytes=10)
+    release = threading.Event()
+    blocked = manager.submit(lambda progress: release.wait(5))
+    with pytest.raises(JobQueueFull):
+        manager.submit(lambda progress: b'result')
+    release.set()
+    blocked.future.result(5)
+
+    first = manager.submit(lambda progress: b'x' * 6)
+    first.future.result(5)
+    second = manager.submit(lambda progress: b'x' * 6)
+    second.future.result(5)
+    with pytest.raises(KeyError):
+        manager.get(first.id)
+    assert manager.get(second.id).result == b'x' * 6, "Newest result is dropped"
+
+    manager.result_ttl = 0
+    with pytest.raises(KeyError):
+        manager.get(second.id)
+    manager.shutdown()
+
+def test_executor_admission():
+    '''
+    Test that the executor rejects the calls beyond max_in_flight once the queue timeout is over.
+    '''
+    executor = Executor(workers=1, max_in_flight=1, queue_timeout=0.05)
+    release = threading.Event()
+
+    async def run_both():
+        first = asyncio.ensure_future(executor.run(release.wait, 5))
+        await asyncio.sleep(0.01)
+        with pytest.raises(ExecutorSaturated):
+            await executor.run(sum, [1, 2])
+        release.set()
+        assert await first is True, "Admitted call does not return its result"
+        assert await executor.run(sum, [1, 2]) == 3, "Call is not admitted once a slot is free"
+
+    asyncio.run(run_both())
+    assert executor.in_flight == 0, "Slots are not released"
+    executor.shutdown()
+
+def test_admission_order():
+    '''
+    Test that the admission serves the queued calls in arrival order, across coroutines and threads.
+    '''
+    admission = Admission(capacity=2)
+    order = []
+
+    async def call(name:str, size:int):
+        assert await admission.acquire(size, timeout=5), f"{name} is not admitted"
+        order.append(name)
+
+    async def run_all():
+        assert await admission.acquire(2, timeout=0), "Free capacity is not admitted right away"
+        large = asyncio.ensure_future(call('large', 2))
+        await asyncio.sleep(0.01)
+        small = asyncio.ensure_future(call('small', 1))
+        await asyncio.sleep(0.01)
+        assert not await admission.acquire(1, timeout=0.01), "Call overtakes the queued calls"
+        admission.release(2)
+        await large
+        await asyncio.sleep(0.01)
+        assert order == ['large'], "Small call overtakes the large call queued before it"
+        thread = threading.Thread(target=admission.wait, args=(1,))
+        thread.start()
+        admission.release(2)
+        await small
+        await asyncio.to_thread(thread.join, 5)
+        assert order == ['large', 'small'], "Calls are not admitted in arrival order"
+
+    asyncio.run(run_all())
+    assert admission.used == 2, "Thread is not admitted next to the small call"
+
+def test_result_cache(get_test_df_crosstabs:pd.DataFrame, tmp_path:Path):
+    '''
+    Test the LRU eviction of the result cache in memory and its disk tier.
+    '''
+    cache = ResultCache(max_bytes=10, directory=str(tmp_path), max_disk_bytes=10**6)
+    cache.put('first', (b'12345', None))
+    cache.put('second', (b'12345', b'6'))
+    assert cache.get('first') == (b'12345', None), "Result is not cached"
+    assert len(cache._memory) == 1, "Memory tier holds more than max_bytes"
+
+    restarted = ResultCache(max_bytes=10, directory=str(tmp_path))
+    assert restarted.get('second') == (b'12345', b'6'), "Result is not read back from disk"
+    assert restarted.get('third') is None, "Unknown key returns a result"
+
+    df = get_test_df_crosstabs
+    assert dataset_fingerprint(df) == dataset_fingerprint(df.copy()), "Same dataset has different fingerprints"
+    changed = df.copy()
+    changed.iloc[0, -1] += 1
+    assert dataset_fingerprint(df) != dataset_fingerprint(changed), "Changed dataset has the same fingerprint"
+
+def test_timing():
+    '''
+    Test that the stages are only recorded when the timing is on, and summed up in the Server-Timing header and metrics.
+    '''
+    metrics = timing.Metrics()
+    records = timing.start()
+    enabled = timing.enabled()
+    timing.set_enabled(False)
+    try:
+        with timing.stage('test.off') as counts:
+            counts['rows'] = 1
+        timing.set_enabled(True)
+        for _ in range(2):
+            with timing.stage('test.on', tables=1) as counts:
+                counts['rows'] = 10
+                metrics.observe('test_seconds', {'stage': 'test.on'}, 0.002)
+    finally:
+        timing.set_enabled(enabled)
+
+    assert [name for name, _, _ in records] == ['test.on', 'test.on'], "Stages are recorded while the timing is off"
+    assert timing.server_timing(records).endswith(';desc="tables=2 rows=20"'), "Stages are not summed up in Server-Timing"
+    assert 'test_seconds_bucket{stage="test.on",le="0.005"} 2' in metrics.render(), "Histogram buckets are not cumulative"
+    assert 'test_seconds_bucket{stage="test.on",le="0.001"} 0' in metrics.render(), "Histogram buckets are not cumulative"
+
+def test_memory_budget(get_test_df_crosstabs:pd.DataFrame):
+    '''
+    Test that the memory budget counts the survey cells, routes large crosstabs to a constant memory workbook
+    and rejects the requests that do not fit.
+    '''
+    df = get_test_df_crosstabs
+    cells = df.shape[0] * df.shape[1]
+    assert survey_cells(export_data(df=df, fmt='parquet')) == cells, "Parquet cells are not read from the metadata"
+    assert survey_cells(str(Path.cwd() / 'tests' / 'test_crosstabs.csv')) >= cells, "csv cells are undercounted"
+
+    q_ls, demos = ['1. [LIKERT] Opinions'], ['Gender']
+    normal = estimate_crosstabs(len(df), len(df.columns), q_ls, demos)
+    flat = estimate_crosstabs(len(df), len(df.columns), q_ls, demos, constant_memory=True)
+    assert flat < normal, "Constant memory estimate is not lower"
+    assert MemoryBudget(budget=normal).plan(len(df), len(df.columns), q_ls, demos) == ('normal', normal)
+    assert MemoryBudget(budget=flat).plan(len(df), len(df.columns), q_ls, demos) == ('constant_memory', flat)
+    with pytest.raises(MemoryBudgetExceeded) as error:
+        MemoryBudget(budget=flat - 1).plan(len(df), len(df.columns), q_ls, demos)
+    assert error.value.status_code == 413, "Too large crosstabs are not rejected with 413"
+
+    budget = MemoryBudget(budget=100, queue_timeout=0.05)
+
+    async def reserve_both():
+        async with budget.reserve(60):
+            with pytest.raises(MemoryBudgetExceeded) as error:
+                async with budget.reserve(60):
+                    pass
+            assert error.value.status_code == 503, "Queued request does not time out with 503"
+        async with budget.reserve(60):
+            assert budget.reserved == 60, "Request is not admitted once the memory is released"
+
+    asyncio.run(reserve_both())
+    assert budget.reserved == 0, "Memory is not released"
+
 def test_sorter(get_test_df_crosstabs:pd.DataFrame):
     '''
     Test the sorter function to sort the selected demography column.
@@ -1,8 +1,13 @@
 from fastapi.testclient import TestClient
 from app.endpoint import app
+from app.utils_module.executor import Executor
+import app.endpoint as endpoint
 from pathlib import Path
 import pandas as pd
 import json
+import base64
+import io
+import time
 
 client = TestClient(app)
 
@@ -11,11 +16,40 @@ API_ROUTER_PREFIX = "crossart"
 survey_file_path = Path.cwd() / 'tests' / 'test_crosstabs.csv'
 crosstab_file_path = Path.cwd() / 'tests' / 'test_chartgen.xlsx'
 
+def test_lazy_imports():
+    # The crosstab and chart stack is only imported by the endpoints that use it
+    import subprocess
+    import sys
+    heavy = ['xlsxwriter', 'app.component_module.table', 'app.chart_module.chart', 'app.crosstab_module.cube', 'concurrent.futures.process']
+    code = f"import sys, app.endpoint; print([m for m in {heavy} if m in sys.modules])"
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "[]", f"Imported with the app: {result.stdout.strip()}"
+
 def test_root():
     response = client.get(f"/{API_ROUTER_PREFIX}")
     assert response.status_code == 200, "Response 404, failed"
     assert response.json() == {"status": "ok", "type": "crosstabsgen"}, "No response"
 
+def test_server_timing():
+    from app.utils_module import timing
+    enabled = timing.enabled()
+    timing.set_enabled(True)
+    try:
+        with open(survey_file_path, 'rb') as f:
+            response = client.post(f"/{API_ROUTER_PREFIX}/read", files={"file": f})
+        metrics = client.get("/metrics")
+        timing.set_enabled(False)
+        untimed = client.get(f"/{API_ROUTER_PREFIX}")
+    finally:
+        timing.set_enabled(enabled)
+    assert response.status_code == 200, "Response 404, failed"
+    # Stages run in the executor are reported with the request
+    assert 'load;dur=' in response.headers["server-timing"], "Stages are not in the Server-Timing header"
+    assert 'total;dur=' in response.headers["server-timing"], "Request duration is not in the Server-Timing header"
+    assert 'crosstab_stage_seconds_count{stage="load"}' in metrics.text, "Stages are not in the metrics"
+    assert 'route="/crossart/read",status="200"' in metrics.text, "Requests are not in the metrics"
+    assert "server-timing" not in untimed.headers, "Requests are timed while the timing is off"
+
 # --------------------------- Crosstab Generator Endpoint ------------------------------------------
 def test_read_data():
     with open(survey_file_path, 'rb') as f:
@@ -94,6 +128,310 @@ def test_generate_crosstabs():
     json_data = json.loads(json.dumps(response.json()))
     assert "crosstabs" in json_data
 
+def test_crosstabs_workers_limit():
+    from app.utils_module.executor import MAX_CROSSTAB_WORKERS
+    crosstabs = {
+        "df": pd.read_csv(survey_file_path).to_json(orient="records"),
+        "demos": ["Gender"],
+        "wise": "% of Column Total",
+        "q_ls": ["1. [LIKERT] Opinions"],
+        "weight": "untrimmed_weight",
+        "col_seqs": {"Gender": ["Male", "Female"]}
+    }
+    for workers in [0, MAX_CROSSTAB_WORKERS + 1]:
+        response = client.post(f"/{API_ROUTER_PREFIX}/crosstabs", json={**crosstabs, "workers": workers})
+        assert response.status_code == 422, f"{workers} workers are not rejected"
+
+def test_dataset_id():
+    with open(survey_file_path, 'rb') as f:
+        response = client.post(
+            f"/{API_ROUTER_PREFIX}/read", 
+            files={
+                "file": f
+            })
+    assert response.status_code == 200, "Response 404, failed"
+    dataset_id = response.json()["dataset_id"]
+
+    response = client.post(
+        f"/{API_ROUTER_PREFIX}/demography",
+        json={
+            "dataset_id": dataset_id
+        }
+    )
+    assert response.status_code == 200, "Response 404, failed"
+    assert response.json()["demo_list"] == ["Gender","IncomeGroup"], "Expected output is wrong."
+
+    crosstabs = {
+        "demos": ["Gender"],
+        "wise": "% of Column Total",
+        "q_ls": ["1. [LIKERT] Opinions", "2. What is your dream job field?"],
+        "multi": [],
+        "name_sort": [],
+        "weight": "untrimmed_weight",
+        "col_seqs": {"Gender": ["Male", "Female"]}
+    }
+    df_json = test_read_data().to_json(orient="records")
+    by_id = client.post(f"/{API_ROUTER_PREFIX}/crosstabs", json={"dataset_id": dataset_id, **crosstabs})
+    by_df = client.post(f"/{API_ROUTER_PREFIX}/crosstabs", json={"df": df_json, **crosstabs})
+    assert by_id.status_code == 200, "Response 404, failed"
+    # The workbook bytes hold their creation time, so the cell values are compared
+    by_id_sheets, by_df_sheets = [
+        pd.read_excel(io.BytesIO(base64.b64decode(response.json()["crosstabs"])), sheet_name=None, header=None)
+        for response in [by_id, by_df]
+    ]
+    assert list(by_id_sheets) == list(by_df_sheets), "Sheets of the dataset_id do not match the sheets of the df"
+    # The raw data sheet differs in the last digits of the weights, which the JSON of the df rounds
+    assert all(
+        by_id_sheets[name].equals(by_df_sheets[name]) for name in by_id_sheets if name != "data"
+        ), "Crosstabs of the dataset_id do not match the crosstabs of the df"
+
+    response = client.delete(f"/{API_ROUTER_PREFIX}/read/{dataset_id}")
+    assert response.status_code == 200, "Response 404, failed"
+    response = client.post(
+        f"/{API_ROUTER_PREFIX}/demography",
+        json={
+            "dataset_id": dataset_id
+        }
+    )
+    assert response.status_code == 404, "Deleted dataset is still available"
+
+def test_dataset_id_dtypes():
+    # A Parquet survey registered by /read keeps its column types, and an explicit null df is accepted
+    df = pd.DataFrame({"code": ["001", "002"], "Gender": ["Male", "Female"]})
+    parquet = io.BytesIO()
+    df.to_parquet(parquet)
+    response = client.post(f"/{API_ROUTER_PREFIX}/read", files={"file": ("survey.parquet", parquet.getvalue())})
+    assert response.status_code == 200, "Response 404, failed"
+    dataset_id = response.json()["dataset_id"]
+    assert endpoint.datasets.get(dataset_id)["code"].tolist() == ["001", "002"], "Column types of the file are not kept"
+
+    response = client.post(
+        f"/{API_ROUTER_PREFIX}/colsearch",
+        json={"df": None, "dataset_id": dataset_id, "key": "code"}
+    )
+    assert response.status_code == 200, "Explicit null df is rejected"
+    assert response.json()["column_with_string"] == ["code"], "Expected output is wrong."
+
+def test_read_data_cube():
+    # The cubes are only built at /read when asked for
+    with open(survey_file_path, 'rb') as f:
+        content = f.read()
+    by_default = client.post(f"/{API_ROUTER_PREFIX}/read", files={"file": content}).json()["dataset_id"]
+    with_cube = client.post(f"/{API_ROUTER_PREFIX}/read", params={"cube": True}, files={"file": content}).json()["dataset_id"]
+    assert endpoint.datasets.cube(by_default, "untrimmed_weight") is None, "Cubes are built by default"
+    assert endpoint.datasets.cube(with_cube, "untrimmed_weight") is not None, "Cubes are not built when asked for"
+
+def test_generate_crosstabs_stream():
+    df = test_read_data()
+    crosstabs = {
+        "df": df.to_json(orient="records"),
+        "demos": ["Gender"],
+        "wise": "Both",
+        "q_ls": ["1. [LIKERT] Opinions", "2. What is your dream job field?"],
+        "multi": [],
+        "name_sort": [],
+        "weight": "untrimmed_weight",
+        "col_seqs": {"Gender": ["Male", "Female"]}
+    }
+    response = client.post(f"/{API_ROUTER_PREFIX}/crosstabs", json={**crosstabs, "stream": True})
+    assert response.status_code == 200, "Response 404, failed"
+    assert response.headers["content-type"] == "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    encoded = client.post(f"/{API_ROUTER_PREFIX}/crosstabs", json=crosstabs).json()["crosstabs"]
+    assert response.content == base64.b64decode(encoded), "Streamed workbook does not match the JSON workbook"
+
+def test_generate_crosstabs_upload():
+    df = pd.read_csv(survey_file_path)
+    params = {
+        "demos": ["Gender"],
+        "wise": "Both",
+        "q_ls": ["1. [LIKERT] Opinions", "2. What is your dream job field?"],
+        "multi": [],
+        "name_sort": [],
+        "weight": "untrimmed_weight",
+        "col_seqs": {"Gender": ["Male", "Female"]},
+        "data_sheet": "none"
+    }
+    expected = client.post(
+        f"/{API_ROUTER_PREFIX}/crosstabs",
+        json={"df": df.to_json(orient="records"), **params}
+    ).json()["crosstabs"]
+    expected = pd.read_excel(io.BytesIO(base64.b64decode(expected)), sheet_name=None)
+
+    parquet = io.BytesIO()
+    df.to_parquet(parquet)
+    arrow = io.BytesIO()
+    df.to_feather(arrow)
+    for file in [parquet, arrow]:
+        response = client.post(
+            f"/{API_ROUTER_PREFIX}/crosstabs/upload",
+            files={"file": file.getvalue()},
+            data={"params": json.dumps(params)}
+        )
+        assert response.status_code == 200, "Response 404, failed"
+        sheets = pd.read_excel(io.BytesIO(base64.b64decode(response.json()["crosstabs"])), sheet_name=None)
+        assert list(sheets) == list(expected), "Uploaded survey does not give the same sheets"
+        assert all(sheets[name].equals(expected[name]) for name in expected), "Uploaded survey does not give the same crosstabs"
+
+    response = client.post(
+        f"/{API_ROUTER_PREFIX}/crosstabs/upload",
+        files={"file": parquet.getvalue()},
+        data={"params": json.dumps({"demos": ["Gender"]})}
+    )
+    assert response.status_code == 422, "Invalid parameters are not rejected"
+
+def test_crosstabs_key_parser():
+    # The same bytes read by /read and sent to /crosstabs/upload are cached apart
+    params = {
+        "demos": ["Gender"],
+        "wise": "Both",
+        "q_ls": ["1. [LIKERT] Opinions"],
+        "multi": [],
+        "name_sort": [],
+        "weight": "untrimmed_weight",
+        "col_seqs": {"Gender": ["Male", "Female"]},
+        "data_sheet": "none"
+    }
+    with open(survey_file_path, 'rb') as f:
+        content = f.read()
+    dataset_id = client.post(f"/{API_ROUTER_PREFIX}/read", files={"file": content}).json()["dataset_id"]
+    by_id = client.post(f"/{API_ROUTER_PREFIX}/crosstabs", json={"dataset_id": dataset_id, **params})
+    assert by_id.status_code == 200, "Response 404, failed"
+    response = client.post(
+        f"/{API_ROUTER_PREFIX}/crosstabs/upload",
+        files={"file": content},
+        data={"params": json.dumps(params)}
+    )
+    assert response.status_code == 400, "csv upload is answered from the crosstabs of /read"
+    assert response.headers.get("etag") != by_id.headers["etag"], "/read and /crosstabs/upload share an ETag"
+
+def test_crosstabs_job():
+    df = test_read_data()
+    crosstabs = {
+        "df": df.to_json(orient="records"),
+        "demos": ["Gender", "IncomeGroup"],
+        "wise": "Both",
+        "q_ls": ["1. [LIKERT] Opinions", "2. What is your dream job field?"],
+        "multi": [],
+        "name_sort": [],
+        "weight": "untrimmed_weight",
+        "col_seqs": {"Gender": ["Male", "Female"], "IncomeGroup": ["B40", "M40", "T20"]},
+        "stream": True
+    }
+    response = client.post(f"/{API_ROUTER_PREFIX}/crosstabs/jobs", json=crosstabs)
+    assert response.status_code == 202, "Job is not accepted"
+    job_id = response.json()["job_id"]
+
+    for _ in range(100):
+        status = client.get(f"/{API_ROUTER_PREFIX}/crosstabs/jobs/{job_id}").json()
+        if status["state"] not in ["queued", "running"]:
+            break
+        time.sleep(0.1)
+    assert status["state"] == "done", f"Job did not finish: {status}"
+    assert status["done"] == status["total"] == 4, "Job progress is not reported per question"
+
+    response = client.get(f"/{API_ROUTER_PREFIX}/crosstabs/jobs/{job_id}/result")
+    assert response.status_code == 200, "Response 404, failed"
+    sheets = pd.read_excel(io.BytesIO(response.content), sheet_name=None)
+    assert list(sheets) == ["data", "Gender(col)", "Gender(row)", "IncomeGroup(col)", "IncomeGroup(row)"], "Job result is not the crosstabs"
+
+    response = client.get(f"/{API_ROUTER_PREFIX}/crosstabs/jobs/unknown")
+    assert response.status_code == 404, "Unknown job is not reported"
+
+    from app.utils_module.jobs import JobManager
+    jobs = endpoint.jobs
+    endpoint.jobs = JobManager(max_pending=0)
+    try:
+        response = client.post(f"/{API_ROUTER_PREFIX}/crosstabs/jobs", json=crosstabs)
+    finally:
+        endpoint.jobs = jobs
+    assert response.status_code == 429, "Full job queue does not answer 429"
+
+def test_saturated_executor():
+    df_json = pd.read_csv(survey_file_path).to_json(orient="records")
+    executor = endpoint.executor
+    endpoint.executor = Executor(max_in_flight=0, queue_timeout=0)
+    try:
+        response = client.post(
+            f"/{API_ROUTER_PREFIX}/colsearch",
+            json={
+                "df": df_json,
+                "key": "LIKERT"
+                }
+        )
+        assert response.status_code == 429, "Saturated executor does not answer 429"
+        assert response.headers["retry-after"] == "1"
+        test_root()
+    finally:
+        endpoint.executor = executor
+
+def test_memory_budget():
+    from app.utils_module.memory import MemoryBudget, estimate_crosstabs
+    df = pd.read_csv(survey_file_path)
+    with open(survey_file_path, 'rb') as f:
+        dataset_id = client.post(f"/{API_ROUTER_PREFIX}/read", files={"file": f}).json()["dataset_id"]
+    crosstabs = {
+        "dataset_id": dataset_id,
+        "demos": ["Gender"],
+        "wise": "Both",
+        "q_ls": ["1. [LIKERT] Opinions", "2. What is your dream job field?"],
+        "multi": [],
+        "name_sort": [],
+        "weight": "untrimmed_weight",
+        "col_seqs": {"Gender": ["Male", "Female"]}
+    }
+    flat = estimate_crosstabs(len(df), len(df.columns), crosstabs["q_ls"], crosstabs["demos"], constant_memory=True)
+    budget = endpoint.budget
+    endpoint.budget = MemoryBudget(budget=flat)
+    try:
+        with open(survey_file_path, 'rb') as f:
+            response = client.post(f"/{API_ROUTER_PREFIX}/read", files={"file": f})
+        assert response.status_code == 413, "Survey over the memory budget is not rejected"
+        assert "memory budget" in response.json()["detail"], "Rejection does not explain the memory budget"
+
+        # Over the budget with an in memory workbook, so the crosstabs are written with a constant memory one
+        response = client.post(f"/{API_ROUTER_PREFIX}/crosstabs", json={**crosstabs, "stream": True})
+        metrics = client.get("/metrics").text
+    finally:
+        endpoint.budget = budget
+    assert response.status_code == 200, "Crosstabs within the constant memory budget are rejected"
+    assert 'crosstab_memory_requests_total{mode="constant_memory"}' in metrics, "Crosstabs are not routed to constant memory"
+    # Generated in memory from the stored survey, as the crosstabs of the dataset_id are cached
+    expected, _ = endpoint.crosstabs_files(
+        df=endpoint.datasets.get(dataset_id),
+        crosstabs=endpoint.CrosstabParams(**{key: value for key, value in crosstabs.items() if key != "dataset_id"})
+    )
+    flushed = pd.read_excel(io.BytesIO(response.content), sheet_name=None, header=None)
+    in_memory = pd.read_excel(io.BytesIO(expected), sheet_name=None, header=None)
+    assert all(in_memory[name].equals(flushed[name]) for name in in_memory), "Constant memory crosstabs do not match"
+
+def test_crosstabs_etag():
+    df = test_read_data()
+    crosstabs = {
+        "df": df.to_json(orient="records"),
+        "demos": ["IncomeGroup"],
+        "wise": "% of Row Total",
+        "q_ls": ["2. What is your dream job field?"],
+        "multi": [],
+        "name_sort": [],
+        "weight": "trimmed_weight",
+        "col_seqs": {"IncomeGroup": ["B40", "M40", "T20"]}
+    }
+    first = client.post(f"/{API_ROUTER_PREFIX}/crosstabs", json=crosstabs)
+    assert first.status_code == 200, "Response 404, failed"
+    etag = first.headers["etag"]
+
+    without_multi = {key: value for key, value in crosstabs.items() if key != "multi"}
+    second = client.post(f"/{API_ROUTER_PREFIX}/crosstabs", json={**without_multi, "workers": 1})
+    assert second.headers["etag"] == etag, "Same crosstabs do not have the same ETag"
+    assert second.json() == first.json(), "Cached crosstabs are not returned"
+
+    response = client.post(f"/{API_ROUTER_PREFIX}/crosstabs", json=crosstabs, headers={"If-None-Match": etag})
+    assert response.status_code == 304, "Matching ETag does not answer 304"
+    assert response.content == b""
+
+    response = client.post(f"/{API_ROUTER_PREFIX}/crosstabs", json={**crosstabs, "wise": "Both"})
+    assert response.headers["etag"] != etag, "Different crosstabs have the same ETag"
+
 # --------------------------- Chart Generator Endpoint ------------------------------------------
 def test_read_crosstabs():
     with open(crosstab_file_path, "rb") as f:
@@ -123,3 +461,35 @@ def test_generate_chart():
     assert response.status_code == 200,"Response 404, failed"
     json_data = json.loads(json.dumps(response.json()))
     assert "charts" in json_data
+
+def test_generate_chart_stream():
+    dfs, sheet_names = test_read_crosstabs()
+    dfs_json = [df.to_json(orient="records") for df in dfs]
+    response = client.post(
+        f"/{API_ROUTER_PREFIX}/chart",
+        json={
+            "dfs": dfs_json,
+            "sheet_names": sheet_names,
+            "stream": True
+        })
+    assert response.status_code == 200,"Response 404, failed"
+    assert response.headers["content-disposition"] == 'attachment; filename="charts.xlsx"'
+    assert response.content[:2] == b"PK", "Streamed charts are not an xlsx file"
+
+def test_loadtest_scenarios():
+    # The load test sessions keep up with the API, every request succeeds
+    import asyncio
+    import httpx
+    from benchmarks.loadtest import Recorder, Workload, run_client, summary, percentile
+    assert [percentile(list(range(1, 101)), q) for q in [50, 95, 99]] == [50, 95, 99], "Percentiles are not nearest rank"
+
+    async def run()->Recorder:
+        recorder = Recorder()
+        workload = Workload(respondents=300, questions=4, demos=2, same_params=False)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://app') as http:
+            await run_client(http, recorder, workload, {'ui': 1, 'batch': 1, 'chart': 1}, seed=0, deadline=None, sessions=6, think=0)
+        return recorder
+
+    stats = summary(asyncio.run(run()), elapsed=1)
+    assert stats['sessions'] == 6, "Sessions are not run"
+    assert stats['endpoints']['all']['error_rate'] == 0, f"Requests failed: {stats['endpoints']['all']['statuses']}"